@@ -0,0 +1,242 @@
+import numpy as np
+from collections import namedtuple
+
+from cep_engine import Cep_engine, default_schemas_dir, default_patterns_dir
+from symptom_registry import Symptom_registry
+
+# Columnar re-scoring of whole patient populations with the Manchester rules of the patterns directory.
+# The lookup tables are not written by hand: the numeric thresholds are read from the compiled .epl
+# statements and every region between them is probed once through Cep_engine, so a batch result is the
+# same as publishing each patient through the per-event path.
+#
+# Missing values: negative ids for life_threat, consciousness, haemorrhage, pain_level and age_months,
+# NaN for temperature. Specific symptoms are bitsets over `vocabulary` (uint64, or (n, words) for more
+# than 64 symptoms). Classification ties go to the class that reached the winning count first, as in
+# Triage.cep_pattern_cb, assuming the symptoms are published in vocabulary order right after the
+# patient's Patient event.
+
+Batch_result = namedtuple("Batch_result", ["patient", "level", "classification", "factors"])
+
+# Batch column: (event type, field)
+general_columns = {
+    "life_threat": ("LifeThreat", "type"),
+    "consciousness": ("ConsciousLevel", "type"),
+    "haemorrhage": ("Haemorrhage", "type"),
+    "temperature": ("Temperature", "value"),
+    "pain_level": ("Pain", "type"),
+}
+
+def numeric_constants(node, field, found):
+    if not isinstance(node, tuple):
+        return found
+    if node[0] == "cmp" and node[2] == ("ident", field) and node[3][0] == "const" and isinstance(node[3][1], (int, float)):
+        found.add(node[3][1])
+    elif node[0] == "in" and node[1] == ("ident", field):
+        found.update(value[1] for value in node[2] if value[0] == "const" and isinstance(value[1], (int, float)))
+    for child in node[1:]:
+        if isinstance(child, tuple):
+            numeric_constants(child, field, found)
+        elif isinstance(child, list):
+            for c in child:
+                numeric_constants(c, field, found)
+    return found
+
+class Piecewise:
+    # Splits the real line at the breakpoints b0 < ... < bn-1 into 2n+1 pieces:
+    # (-inf, b0), {b0}, (b0, b1), {b1}, ..., (bn-1, inf). Every rule comparison is constant on a piece.
+    def __init__(self, breakpoints):
+        self.breakpoints = np.array(sorted(breakpoints), dtype=np.float64)
+        b = list(self.breakpoints)
+        if not b:
+            self.representatives = [0.0]
+            return
+        self.representatives = [b[0] - 1]
+        for i, value in enumerate(b):
+            self.representatives.append(value)
+            self.representatives.append((value + b[i + 1]) / 2 if i + 1 < len(b) else value + 1)
+
+    def __len__(self):
+        return len(self.representatives)
+
+    def index(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        n = len(self.breakpoints)
+        if n == 0:
+            return np.zeros(values.shape, dtype=np.intp)
+        i = np.searchsorted(self.breakpoints, values, side="left")
+        exact = self.breakpoints[np.minimum(i, n - 1)] == values
+        return 2 * i + exact
+
+class Batch_triage:
+    def __init__(self, schemas_dir=default_schemas_dir, patterns_dir=default_patterns_dir, vocabulary=None):
+        self.schemas_dir = schemas_dir
+        self.patterns_dir = patterns_dir
+
+        statements = [s for s in Cep_engine.load_dir(patterns_dir) if s[0] == "on"]
+        wheres = dict() # event type: [where ast]
+        for _, stream, _, clauses, _ in statements:
+            wheres.setdefault(stream, []).extend(where for _, _, where in clauses if where is not None)
+
+        def breakpoints(event_type, field):
+            found = set()
+            for where in wheres.get(event_type, []):
+                numeric_constants(where, field, found)
+            return found
+
+        if vocabulary is None:
+            # Symptom ids as in symptom_registry.py, which is also the order symptom_state publishes in
+            vocabulary = Symptom_registry(patterns_dir).names
+        self.vocabulary = list(vocabulary)
+        self.symptom_ids = {name: i for i, name in enumerate(self.vocabulary)}
+        self.words = max(1, (len(self.vocabulary) + 63) // 64)
+
+        self.age_pieces = Piecewise(breakpoints("Patient", "age"))
+        self.pieces = {column: Piecewise(breakpoints(*general_columns[column])) for column in general_columns}
+
+        self.build_tables()
+
+    def probe(self, events, age):
+        # Publishes the events for a fresh patient and returns (max level, [classification rows]).
+        self.next_probe += 1
+        patient = self.next_probe
+        levels, classes = [0], []
+
+        def collect(pattern):
+            if pattern["patient"] != patient:
+                return
+            if pattern["stream"] == "Level":
+                levels.append(pattern["level"])
+            elif pattern["stream"] == "Classification":
+                classes.append(pattern["class"])
+        self.engine.set_output(collect)
+
+        self.engine.send({"eventTypeName": "Patient", "patient": patient, "age": age}, timestamp=0)
+        for event_type, field, value in events:
+            self.engine.send({"eventTypeName": event_type, "patient": patient, field: value}, timestamp=0)
+        return max(levels), classes
+
+    def build_tables(self):
+        self.engine = Cep_engine(self.schemas_dir, self.patterns_dir, clock=lambda: 0)
+        self.next_probe = 0
+
+        ages = list(self.age_pieces.representatives) + [None]
+
+        # tables[column][age piece, value piece] -> level
+        self.tables = dict()
+        for column, (event_type, field) in general_columns.items():
+            pieces = self.pieces[column]
+            table = np.zeros((len(ages), len(pieces)), dtype=np.uint8)
+            for a, age in enumerate(ages):
+                for v, value in enumerate(pieces.representatives):
+                    table[a, v] = self.probe([(event_type, field, value)], age)[0]
+            self.tables[column] = table
+
+        self.class_names = []
+        symptom_levels = []
+        symptom_classes = []
+        for name in self.vocabulary:
+            level, classes = self.probe([("Symptom", "name", name)], None)
+            for c in classes:
+                if c not in self.class_names:
+                    self.class_names.append(c)
+            symptom_levels.append(level)
+            symptom_classes.append([self.class_names.index(c) for c in classes])
+        self.symptom_levels = symptom_levels
+        self.symptom_classes = symptom_classes
+
+        # level: mask of every symptom with that level, highest level first
+        self.level_masks = []
+        for level in sorted(set(symptom_levels), reverse=True):
+            if level:
+                self.level_masks.append((level, self.mask(i for i, l in enumerate(symptom_levels) if l == level)))
+
+        self.engine = None
+
+    def mask(self, ids):
+        words = np.zeros(self.words, dtype=np.uint64)
+        for i in ids:
+            words[i // 64] |= np.uint64(1) << np.uint64(i % 64)
+        return words
+
+    def encode(self, symptom_lists):
+        # [[symptom name, ...], ...] -> bitsets accepted by triage()
+        bits = np.zeros((len(symptom_lists), self.words), dtype=np.uint64)
+        for row, names in enumerate(symptom_lists):
+            for name in names:
+                i = self.symptom_ids[name]
+                bits[row, i // 64] |= np.uint64(1) << np.uint64(i % 64)
+        return bits[:, 0] if self.words == 1 else bits
+
+    def triage(self, patient, life_threat, consciousness, haemorrhage, temperature, pain_level, specific, age_months):
+        patient = np.asarray(patient)
+        n = len(patient)
+        columns = {
+            "life_threat": life_threat,
+            "consciousness": consciousness,
+            "haemorrhage": haemorrhage,
+            "temperature": temperature,
+            "pain_level": pain_level,
+        }
+
+        age_months = np.asarray(age_months)
+        age = np.where(age_months < 0, len(self.age_pieces), self.age_pieces.index(age_months))
+
+        level = np.zeros(n, dtype=np.uint8)
+        for column, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind == "f":
+                missing = np.isnan(values)
+            else:
+                missing = values < 0
+            column_level = self.tables[column][age, self.pieces[column].index(values)]
+            np.maximum(level, np.where(missing, 0, column_level).astype(np.uint8), out=level)
+
+        specific = np.asarray(specific, dtype=np.uint64).reshape(n, self.words)
+        for symptom_level, mask in self.level_masks:
+            hit = np.bitwise_and(specific, mask).any(axis=1)
+            np.maximum(level, np.where(hit, symptom_level, 0).astype(np.uint8), out=level)
+
+        classification, factors = self.classify(specific)
+        return Batch_result(patient=patient, level=level, classification=classification, factors=factors)
+
+    def classify(self, specific):
+        n = specific.shape[0]
+        counts = np.zeros((len(self.class_names), n), dtype=np.int16)
+        best = np.zeros(n, dtype=np.int16)
+        best_class = np.full(n, -1, dtype=np.int8)
+
+        for i, classes in enumerate(self.symptom_classes):
+            if not classes:
+                continue
+            word = specific[:, i // 64]
+            has = ((word >> np.uint64(i % 64)) & np.uint64(1)).astype(np.int16)
+            if not has.any():
+                continue
+            for c in classes:
+                count = counts[c]
+                count += has
+                improved = count > best
+                np.copyto(best, count, where=improved)
+                np.copyto(best_class, c, where=improved)
+        return best_class, best
+
+if __name__ == "__main__":
+    import time
+
+    batch = Batch_triage()
+    n = 1_000_000
+    rng = np.random.default_rng(0)
+    patient = np.arange(n)
+    life_threat = rng.integers(-1, 4, n)
+    consciousness = rng.integers(-1, 4, n)
+    haemorrhage = rng.integers(-1, 3, n)
+    temperature = np.where(rng.random(n) < 0.3, np.nan, np.round(rng.uniform(33, 43, n), 1))
+    pain_level = rng.integers(-1, 4, n)
+    specific = rng.integers(0, 2 ** 63, n, dtype=np.uint64) & rng.integers(0, 2 ** 63, n, dtype=np.uint64) & rng.integers(0, 2 ** 63, n, dtype=np.uint64)
+    specific &= batch.mask(range(len(batch.vocabulary)))[0]
+    age_months = rng.integers(-1, 1200, n)
+
+    start = time.perf_counter()
+    result = batch.triage(patient, life_threat, consciousness, haemorrhage, temperature, pain_level, specific, age_months)
+    elapsed = time.perf_counter() - start
+    print(str(n) + " patients in " + str(round(elapsed, 3)) + "s (" + str(int(n / elapsed)) + " patients/s)")
@@ -0,0 +1,78 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+
+import mule_format
+import wire_format
+from cep_manager import Cep_manager
+from fake_broker import Fake_broker
+
+# How fast a station drains a burst of matches from MuleOut: acking every match on arrival against a
+# prefetch window acked in batches (see cep_manager.PikaSubscriber). The matches sit on a Fake_broker
+# whose acks block for --ack-delay seconds, standing in for the round trip to a real broker.
+#
+#   python bench_consumer.py --matches 20000 --ack-delay 0.0005 --output bench_consumer.json
+
+def burst(count, binary):
+    bodies = []
+    for i in range(count):
+        pattern = {"stream": "Level", "patient": i, "level": 1 + i % 5}
+        bodies.append(wire_format.shared().encode_matches([pattern]) if binary else mule_format.encode({"stmt0_out0": pattern}))
+    return bodies
+
+def drain(bodies, ack_delay, prefetch, ack_batch, timeout=120):
+    broker = Fake_broker(ack_delay=ack_delay)
+    for body in bodies:
+        broker.publish('MuleOut', body)
+    received = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cep_manager = Cep_manager(connect=broker.connection_factory, prefetch=prefetch, ack_batch=ack_batch)
+        start = time.perf_counter()
+        cep_manager.start_consuming(received.append)
+        while (len(received) < len(bodies) or broker.acked < len(bodies)) and time.perf_counter() - start < timeout:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        cep_manager.consumer.close()
+    return {
+        "prefetch": prefetch,
+        "ack_batch": ack_batch if prefetch else 1,
+        "received": len(received),
+        "acked": broker.acked,
+        "seconds": elapsed,
+        "matches_per_second": len(received) / elapsed,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match consumer throughput, per-message against batched acks")
+    parser.add_argument("--matches", type=int, default=5000)
+    parser.add_argument("--ack-delay", type=float, default=0.0005, help="Seconds per ack (broker round trip)")
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--ack-batch", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--binary", action="store_true", help="Binary match bodies (see wire_format.py)")
+    parser.add_argument("--output", default="bench_consumer.json")
+    args = parser.parse_args()
+
+    bodies = burst(args.matches, args.binary)
+    runs = [(None, 1)] + [(prefetch, ack_batch) for prefetch in args.prefetch for ack_batch in args.ack_batch if ack_batch <= prefetch]
+    results = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "matches": args.matches,
+        "ack_delay": args.ack_delay,
+        "binary": args.binary,
+        "runs": [],
+    }
+    for prefetch, ack_batch in runs:
+        run = drain(bodies, args.ack_delay, prefetch, ack_batch)
+        results["runs"].append(run)
+        print(("ack each" if prefetch is None else "prefetch " + str(prefetch) + ", ack every " + str(ack_batch)) + ": " +
+              str(round(run["matches_per_second"])) + " matches/s (" + str(run["received"]) + " received, " + str(run["acked"]) + " acked)")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + args.output)
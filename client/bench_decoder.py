@@ -0,0 +1,34 @@
+import json
+import re
+import timeit
+
+import mule_format
+
+# Per-message cost of mule_format.decode next to the regex chain PikaSubscriber.consume used before.
+# Run from the client directory: python bench_decoder.py
+
+messages = [
+    b"{stmt0_out0={stream=Level, patient=3, level=4}}",
+    b"{stmt0_out0={stream=Classification, patient=1284, class=diarrvomit, factors=3}}",
+    b"{stmt0_out0={stream=Classification, patient=7, class=self-harm high risk, factors=1}}",
+]
+
+def regex_decode(body):
+    s = body.decode("utf-8")
+    s = re.sub(r'\s', '', s)
+    s = re.sub(r'(\w+)', r'"\g<1>"', s)
+    s = re.sub('=', ':', s)
+    return json.loads(s)
+
+if __name__ == "__main__":
+    number = 100000
+    for body in messages:
+        print(body.decode("utf-8"))
+        for name, decode in (("regex + json", regex_decode), ("mule_format", mule_format.decode)):
+            try:
+                result = decode(body)
+            except ValueError as e:
+                print("    " + name.ljust(14) + "fails: " + str(e))
+                continue
+            seconds = min(timeit.repeat(lambda: decode(body), number=number, repeat=3))
+            print("    " + name.ljust(14) + str(round(seconds / number * 1e6, 2)).rjust(6) + " us/message  " + str(result))
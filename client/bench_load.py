@@ -0,0 +1,266 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import symptom_registry
+import symptom_state
+import triage_options
+from cep_engine import Cep_engine
+from cep_manager import Cep_manager
+from fake_broker import Fake_broker
+from metrics import Metrics
+from triage_core import Symptoms
+from ui_queue import Coalescing_queue
+
+# Synthetic emergency department load against Cep_manager, without the Tk UI. Patients arrive as a
+# Poisson process with an age/sex mix, get a first assessment and are then re-assessed a few times
+# (temperature drifting, symptoms added or cleared). Each submit publishes only what changed, with
+# retractions, like Triage_core.publish_to_cep. Everything runs through the fake broker and the in-process engine.
+#
+# Every configuration of the suite is run twice with the same seed: once for throughput and latency, once
+# under tracemalloc for memory per patient. Results go to a JSON file.
+#
+#   python bench_load.py --patients 2000 --rate 50 --speed 100 --output bench_load.json
+
+class Load_patient:
+    # What Cep_manager.publish_patient reads, plus the symptoms as the UI would hold them
+    def __init__(self, id, age, is_male):
+        self.id = id
+        self.ssn = ""
+        self.age = str(age)
+        self.is_male = is_male
+        self.latitude = ""
+        self.longitude = ""
+        self.symptoms = Symptoms(temperature=None)
+        self.published = Symptoms(temperature=None)
+        self.published_mask = 0
+
+class Scenario:
+    # Deterministic for a seed: a list of (time, kind, patient) actions
+    age_mix = ((0.15, 0, 15), (0.60, 16, 64), (0.25, 65, 95)) # share, youngest, oldest
+    male_share = 0.5
+    complaint_width = 6 # symptoms are drawn from a window of related entries of the symptom map
+
+    def __init__(self, patients=1000, rate=20.0, resubmits=3.0, resubmit_interval=120.0, seed=0):
+        self.random = random.Random(seed)
+        self.symptoms = list(symptom_registry.shared().label_names.values())
+        self.life_threats = [v for v in triage_options.life_threat_options.values() if v is not None]
+        self.consciousness = [v for v in triage_options.consciousness_options.values() if v is not None]
+        self.haemorrhages = [v for v in triage_options.haemorrhage_options.values() if v is not None]
+        self.pain_levels = [v for v in triage_options.pain_level_options.values() if v is not None]
+
+        self.patients = []
+        self.actions = []
+        clock = 0.0
+        for id in range(patients):
+            clock += self.random.expovariate(rate)
+            patient = Load_patient(id, self.age(), self.random.random() < self.male_share)
+            patient.complaint = self.random.randrange(max(1, len(self.symptoms) - self.complaint_width))
+            patient.fever = self.random.random() < 0.2
+            self.patients.append(patient)
+            self.actions.append((clock, "arrive", patient))
+            at = clock + self.random.uniform(1.0, 10.0)
+            self.actions.append((at, "assess", patient))
+            for _ in range(self.poisson(resubmits)):
+                at += self.random.expovariate(1.0 / resubmit_interval)
+                self.actions.append((at, "reassess", patient))
+        self.actions.sort(key=lambda action: action[0])
+
+    def age(self):
+        pick = self.random.random()
+        for share, youngest, oldest in self.age_mix:
+            if pick < share:
+                return self.random.randint(youngest, oldest)
+            pick -= share
+        return self.random.randint(youngest, oldest)
+
+    def poisson(self, mean):
+        # Knuth's method, means are small
+        limit = 2.718281828459045 ** -mean
+        k, product = 0, self.random.random()
+        while product > limit:
+            k += 1
+            product *= self.random.random()
+        return k
+
+    def maybe(self, probability, choices):
+        return self.random.choice(choices) if self.random.random() < probability else None
+
+    def assess(self, patient):
+        symptoms = patient.symptoms
+        symptoms.life_threat = self.maybe(0.03, self.life_threats)
+        symptoms.consciousness = self.maybe(0.05, self.consciousness)
+        symptoms.haemorrhage = self.maybe(0.08, self.haemorrhages)
+        symptoms.pain_level = self.maybe(0.6, self.pain_levels)
+        if patient.fever:
+            symptoms.temperature = round(self.random.gauss(38.8, 0.7), 1)
+        else:
+            symptoms.temperature = round(self.random.gauss(36.8, 0.4), 1)
+        window = self.symptoms[patient.complaint:patient.complaint + self.complaint_width]
+        symptoms.specific = self.random.sample(window, self.random.randint(0, 3))
+
+    def reassess(self, patient):
+        symptoms = patient.symptoms
+        symptoms.temperature = round(symptoms.temperature + self.random.gauss(0.1 if patient.fever else 0.0, 0.3), 1)
+        if self.random.random() < 0.2:
+            symptoms.pain_level = self.random.choice(self.pain_levels)
+        window = self.symptoms[patient.complaint:patient.complaint + self.complaint_width]
+        if self.random.random() < 0.3:
+            missing = [name for name in window if name not in symptoms.specific]
+            if missing:
+                symptoms.specific = symptoms.specific + [self.random.choice(missing)]
+        elif self.random.random() < 0.1 and symptoms.specific:
+            symptoms.specific = symptoms.specific[1:]
+
+def publish_changes(cep_manager, patient):
+    # Same diff as Triage_core.publish_to_cep
+    patient.published_mask = symptom_state.publish_changes(cep_manager, patient.id, patient.symptoms, patient.published, patient.published_mask)
+
+def run(config, scenario_args, speed, trace_memory=False):
+    scenario = Scenario(**scenario_args)
+    metrics = Metrics()
+    broker = Fake_broker(Cep_engine())
+    patterns = Coalescing_queue()
+    levels = dict()
+
+    def drain():
+        drained = patterns.drain()
+        for pattern in drained:
+            if pattern["stream"] == "Level":
+                levels[int(pattern["patient"])] = int(pattern["level"] or 0)
+        if drained:
+            cep_manager.patterns_displayed([int(pattern["patient"]) for pattern in drained])
+
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cep_manager = Cep_manager(connect=broker.connection_factory, metrics=metrics, **config)
+        cep_manager.start_consuming(patterns.put)
+
+        start = time.perf_counter()
+        first = scenario.actions[0][0] if scenario.actions else 0.0
+        next_drain = start
+        for at, kind, patient in scenario.actions:
+            if speed:
+                delay = (at - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if kind == "arrive":
+                cep_manager.publish_patient(patient)
+            else:
+                if kind == "assess":
+                    scenario.assess(patient)
+                else:
+                    scenario.reassess(patient)
+                with cep_manager.batch():
+                    publish_changes(cep_manager, patient)
+            now = time.perf_counter()
+            if now >= next_drain:
+                drain()
+                next_drain = now + 0.016
+        cep_manager.flush()
+        sent = time.perf_counter() - start
+
+        # Let the last matches come back
+        quiet_since = time.perf_counter()
+        while time.perf_counter() - quiet_since < 0.2:
+            if len(patterns):
+                drain()
+                quiet_since = time.perf_counter()
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        cep_manager.__exit__(None, None, None)
+
+    if trace_memory:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return {"bytes_per_patient": (current - baseline) / len(scenario.patients)}
+
+    snapshot = metrics.snapshot()
+    counters = dict()
+    for counter in snapshot["counters"]:
+        counters[counter["name"]] = counters.get(counter["name"], 0) + counter["value"]
+    events = counters.get("cep_events_published_total", 0)
+    matches = counters.get("cep_matches_received_total", 0)
+    latency = dict()
+    for histogram in snapshot["histograms"]:
+        stage = histogram["name"].replace("cep_", "").replace("_latency_seconds", "")
+        latency.setdefault(stage, dict())[histogram["labels"]["type"]] = {
+            "count": histogram["count"],
+            "p50_ms": histogram["p50"] * 1000,
+            "p99_ms": histogram["p99"] * 1000,
+            "p999_ms": histogram["p999"] * 1000,
+            "max_ms": histogram["max"] * 1000,
+        }
+    return {
+        "patients": len(scenario.patients),
+        "submits": sum(1 for action in scenario.actions if action[1] != "arrive"),
+        "events": events,
+        "matches": matches,
+        "publish_seconds": sent,
+        "seconds": elapsed,
+        "events_per_second": events / sent if sent else None,
+        "matches_per_second": matches / elapsed if elapsed else None,
+        "patients_with_level": sum(1 for level in levels.values() if level),
+        "latency": latency,
+    }
+
+suite = {
+    "per_event": dict(),
+    "batched": dict(batch_size=32, batch_interval=0.05),
+    "envelope": dict(batch_size=32, batch_interval=0.05, envelope=True),
+    "async": dict(async_publish=True),
+    "async_envelope": dict(async_publish=True, batch_size=32, batch_interval=0.05, envelope=True),
+    "binary": dict(binary=True),
+    "async_binary_envelope": dict(async_publish=True, batch_size=32, batch_interval=0.05, envelope=True, binary=True),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic ED load against Cep_manager")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=20.0, help="Mean patient arrivals per second")
+    parser.add_argument("--resubmits", type=float, default=3.0, help="Mean re-assessments per patient")
+    parser.add_argument("--resubmit-interval", type=float, default=120.0, help="Mean seconds between re-assessments")
+    parser.add_argument("--speed", type=float, default=None, help="Time compression (1 is real time); as fast as possible when omitted")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", action="append", choices=sorted(suite), help="Configurations to run (all by default)")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--output", default="bench_load.json")
+    args = parser.parse_args()
+
+    scenario_args = dict(patients=args.patients, rate=args.rate, resubmits=args.resubmits, resubmit_interval=args.resubmit_interval, seed=args.seed)
+    results = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "scenario": dict(scenario_args, speed=args.speed),
+        "configs": dict(),
+    }
+    for name in args.config or list(suite):
+        result = run(suite[name], scenario_args, args.speed)
+        if not args.no_memory:
+            result.update(run(suite[name], scenario_args, args.speed, trace_memory=True))
+        result["config"] = suite[name]
+        results["configs"][name] = result
+
+        match = result["latency"].get("match", dict())
+        p99 = max((stats["p99_ms"] for stats in match.values()), default=None)
+        line = name.ljust(16) + str(round(result["events_per_second"])).rjust(8) + " events/s" + str(round(result["matches_per_second"])).rjust(8) + " matches/s"
+        line += "   worst p99 match " + ("-" if p99 is None else str(round(p99, 3)) + " ms")
+        if "bytes_per_patient" in result:
+            line += "   " + str(round(result["bytes_per_patient"])) + " B/patient"
+        print(line)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + args.output)
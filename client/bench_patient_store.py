@@ -0,0 +1,103 @@
+import gc
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+from patient_store import Patient_store, EmergencyType
+import symptom_registry
+
+# Patient_store against the dataclass per patient layout it replaced (kept below for the comparison):
+# memory per patient with both symptom sets filled in, counting the strings each layout keeps, and
+# whole table scans. Run from the client directory: python bench_patient_store.py
+
+@dataclass
+class Patient:
+    id: int
+    ssn: str
+    age: int
+    is_male: bool
+    longitude: float = None
+    latitude: float = None
+    emergency_level: int = 0
+    emergency_category: EmergencyType = EmergencyType.Generic
+    category_factors: int = 0
+
+@dataclass
+class Symptoms:
+    life_threat: int = None
+    consciousness: int = None
+    haemorrhage: int = None
+    temperature: float = 36.1
+    pain_level: int = None
+    specific: list = field(default_factory=list)
+
+@dataclass
+class Patient_unit:
+    patient: Patient
+    symptoms: Symptoms
+    published: Symptoms
+    published_mask: int = 0
+    class_factors: dict = field(default_factory=dict)
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(label.ljust(40) + str(round(elapsed / count * 1e6, 2)).rjust(12) + " us/op")
+    return result
+
+def measured(label, n, build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(label.ljust(40) + str(round(used / n)).rjust(12) + " bytes/patient")
+    return table
+
+if __name__ == "__main__":
+    n = 100000
+    random.seed(0)
+    names = symptom_registry.shared().names
+    rows = []
+    for id in range(n):
+        symptoms = dict(life_threat=random.choice((None, 0, 1)), consciousness=random.choice((None, 1, 2)), haemorrhage=None,
+                        temperature=round(random.uniform(35, 41), 1), pain_level=random.choice((None, 1, 2, 3)), specific=random.sample(names, random.randint(0, 3)))
+        rows.append((id, 100000000000 + id, random.randint(0, 99), id % 2 == 0, round(random.uniform(-1, 0), 5), round(random.uniform(39, 40), 5), random.randint(0, 5), symptoms))
+
+    def build_dataclasses():
+        table = dict()
+        for id, ssn, age, is_male, longitude, latitude, level, symptoms in rows:
+            # The fields come in as text from the edit panel or the HTTP service
+            patient = Patient(id=id, ssn=str(ssn), age=str(age), is_male=is_male, longitude=str(longitude), latitude=str(latitude), emergency_level=level)
+            table[id] = Patient_unit(patient=patient, symptoms=Symptoms(**symptoms), published=Symptoms(**dict(symptoms, specific=list(symptoms["specific"]))))
+        return table
+
+    def build_store():
+        store = Patient_store()
+        for id, ssn, age, is_male, longitude, latitude, level, symptoms in rows:
+            unit = store.add(id, str(ssn), str(age), is_male, str(longitude), str(latitude))
+            unit.patient.emergency_level = level
+            view = Symptoms(**symptoms)
+            unit.symptoms = view
+            unit.published = view
+        return store
+
+    table = measured("dataclasses", n, build_dataclasses)
+    store = measured("Patient_store", n, build_store)
+
+    timed("build dataclasses", n, build_dataclasses)
+    timed("build Patient_store", n, build_store)
+
+    queries = 20
+    level_5 = timed("all level 5 (dataclass scan)", queries, lambda: [[id for id, unit in table.items() if unit.patient.emergency_level == 5] for _ in range(queries)])[0]
+    timed("all level 5 (Patient_store.select)", queries, lambda: [store.select(level=5) for _ in range(queries)])
+    assert list(store.select(level=5)) == level_5
+    chest_pain = timed("with chest pain (dataclass scan)", queries, lambda: [[id for id, unit in table.items() if "chest pain" in unit.published.specific] for _ in range(queries)])[0]
+    timed("with chest pain (Patient_store.select)", queries, lambda: [store.select(symptom="chest pain") for _ in range(queries)])
+    assert list(store.select(symptom="chest pain")) == chest_pain
+    timed("count by level (Patient_store)", queries, lambda: [store.level_counts() for _ in range(queries)])
+    timed("read a patient's fields (view)", n, lambda: [(unit.patient.emergency_level, unit.symptoms.temperature) for unit in store.values()])
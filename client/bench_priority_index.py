@@ -0,0 +1,54 @@
+import random
+import time
+
+from priority_index import Priority_index
+
+# Priority_index against scanning the patients dict, with 100k patients and random level raises.
+# Run from the client directory: python bench_priority_index.py
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(label.ljust(34) + str(round(elapsed / count * 1e6, 2)).rjust(10) + " us/op")
+
+if __name__ == "__main__":
+    n = 100000
+    updates = 100000
+    random.seed(0)
+
+    index = Priority_index()
+    levels = dict() # id: level, what Triage.patients holds
+    arrival = dict()
+
+    def add_all():
+        for id in range(n):
+            index.add(id, 0)
+            levels[id] = 0
+            arrival[id] = id
+    timed("add", n, add_all)
+
+    raises = [(random.randrange(n), random.randint(1, 5)) for _ in range(updates)]
+    def raise_levels():
+        for id, level in raises:
+            if level > levels[id]:
+                levels[id] = level
+                index.update(id, level)
+    timed("level update", updates, raise_levels)
+
+    queries = 1000
+    scan_key = lambda id: (-levels[id], arrival[id])
+    timed("next patient (index)", queries, lambda: [index.peek() for _ in range(queries)])
+    timed("next patient (dict scan)", 10, lambda: [min(levels, key=scan_key) for _ in range(10)])
+    assert index.peek() == min(levels, key=scan_key)
+
+    timed("top 20 (index)", queries, lambda: [index.top(20) for _ in range(queries)])
+    timed("rank of a patient (index)", queries, lambda: [index.index(random.randrange(n)) for _ in range(queries)])
+    timed("full urgency order (sorted)", 1, lambda: sorted(levels, key=scan_key))
+
+    def pop_half():
+        for _ in range(n // 2):
+            id = index.pop()
+            del levels[id]
+    timed("pop next", n // 2, pop_half)
+    assert index.peek() == min(levels, key=scan_key)
@@ -0,0 +1,61 @@
+import random
+import time
+
+from spatial_index import Spatial_index, distance_km
+
+# Spatial_index against scanning every patient, with 100k patients spread over about 100 x 100 km
+# around a city, a few of them raised to each level. Run from the client directory:
+# python bench_spatial_index.py
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(label.ljust(40) + str(round(elapsed / count * 1e6, 2)).rjust(10) + " us/op")
+    return result
+
+if __name__ == "__main__":
+    n = 100000
+    queries = 1000
+    random.seed(0)
+    center = (39.47, -0.38)
+
+    index = Spatial_index(latitude=center[0])
+    points = dict() # id: (latitude, longitude, level), what a scan would go through
+    def random_point():
+        return center[0] + random.uniform(-0.45, 0.45), center[1] + random.uniform(-0.6, 0.6)
+
+    def add_all():
+        for id in range(n):
+            latitude, longitude = random_point()
+            index.add(id, latitude, longitude)
+            points[id] = (latitude, longitude, 0)
+    timed("add", n, add_all)
+
+    raises = [(random.randrange(n), random.choice((1, 1, 2, 2, 3, 4, 5))) for _ in range(n)]
+    def raise_levels():
+        for id, level in raises:
+            index.update(id, level)
+            points[id] = points[id][:2] + (level,)
+    timed("level update", n, raise_levels)
+
+    probes = [random_point() for _ in range(queries)]
+    def scan_within(latitude, longitude, radius, min_level):
+        return sorted((distance_km(latitude, longitude, lat, lon), id) for id, (lat, lon, level) in points.items() if level >= min_level and distance_km(latitude, longitude, lat, lon) <= radius)
+
+    timed("level >= 4 within 5 km (index)", queries, lambda: [index.within(lat, lon, 5, 4) for lat, lon in probes])
+    timed("level >= 4 within 5 km (scan)", 10, lambda: [scan_within(lat, lon, 5, 4) for lat, lon in probes[:10]])
+    timed("any level within 1 km (index)", queries, lambda: [index.within(lat, lon, 1) for lat, lon in probes])
+    timed("nearest (index)", queries, lambda: [index.nearest(lat, lon) for lat, lon in probes])
+    timed("nearest 10 (index)", queries, lambda: [index.nearest(lat, lon, 10) for lat, lon in probes])
+    timed("nearest level 5 (index)", queries, lambda: [index.nearest(lat, lon, 1, 5) for lat, lon in probes])
+    timed("nearest (scan)", 10, lambda: [min((distance_km(lat, lon, p[0], p[1]), id) for id, p in points.items()) for lat, lon in probes[:10]])
+
+    for lat, lon in probes[:10]:
+        assert [id for _, id in index.within(lat, lon, 5, 4)] == [id for _, id in scan_within(lat, lon, 5, 4)]
+        assert index.nearest(lat, lon)[0][1] == min((distance_km(lat, lon, p[0], p[1]), id) for id, p in points.items())[1]
+
+    def remove_half():
+        for id in range(0, n, 2):
+            index.remove(id)
+    timed("remove", n // 2, remove_half)
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Cold start of the triage client: import time of its heavy dependencies, each in a fresh interpreter,
+# and the startup stages of run.py (see run.Startup_report): imports done, Cep_manager built, window
+# built, first paint and broker connected, in seconds since the process was spawned. Arguments after
+# -- go to run.py, e.g. the brokers to connect to (with --local, "connected" is immediate).
+#
+#   python bench_startup.py --runs 5 --target 2.0 -- --brokers rabbit1,rabbit2
+#
+# Exits with 1 when the median time to first paint is over --target. Painting needs a display.
+
+here = os.path.dirname(os.path.abspath(__file__))
+modules = ("tkinter", "customtkinter", "pika", "numpy", "cep_engine", "cep_manager", "triage_core", "run")
+
+def import_time(module):
+    code = "import time; start = time.perf_counter(); import " + module + "; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+def startup(run_args, timeout):
+    # Stages of one run.py start, from the spawn of the process
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "startup.json")
+        spawned = time.time()
+        result = subprocess.run([sys.executable, "run.py", "--startup-report", path] + run_args, cwd=here, capture_output=True, text=True, timeout=timeout)
+        if not os.path.exists(path):
+            error = (result.stderr.strip().splitlines() or ["exit code " + str(result.returncode)])[-1]
+            return {"error": error}
+        with open(path) as f:
+            report = json.load(f)
+    stages = {"interpreter": report["started"] - spawned}
+    stages.update({stage: seconds + stages["interpreter"] for stage, seconds in report["stages"].items()})
+    return stages
+
+def summary(samples):
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return None
+    return {"median": statistics.median(samples), "min": min(samples), "max": max(samples)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time of the triage client")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", type=float, default=None, help="Seconds the median time to first paint must stay under")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds one start may take")
+    parser.add_argument("--output", default="bench_startup.json")
+    parser.add_argument("run_args", nargs=argparse.REMAINDER, help="-- then arguments for run.py")
+    args = parser.parse_args()
+    run_args = args.run_args[1:] if args.run_args[:1] == ["--"] else args.run_args
+    if not run_args:
+        run_args = ["--local"]
+
+    results = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "run_args": run_args,
+        "imports": {},
+        "startup": {},
+    }
+    for module in modules:
+        results["imports"][module] = summary([import_time(module) for _ in range(args.runs)])
+        stats = results["imports"][module]
+        print("import " + module + ": " + (str(round(stats["median"] * 1000)) + " ms" if stats else "failed"))
+
+    runs = [startup(run_args, args.timeout) for _ in range(args.runs)]
+    errors = [run["error"] for run in runs if "error" in run]
+    runs = [run for run in runs if "error" not in run]
+    if errors:
+        results["errors"] = errors
+        print(str(len(errors)) + " of " + str(args.runs) + " starts failed: " + errors[0])
+    for stage in ("interpreter", "imports", "cep_manager", "window", "first_paint", "connected"):
+        results["startup"][stage] = summary([run.get(stage) for run in runs])
+        stats = results["startup"][stage]
+        if stats:
+            print(stage + ": " + str(round(stats["median"], 3)) + " s (" + str(round(stats["min"], 3)) + "-" + str(round(stats["max"], 3)) + ")")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + args.output)
+
+    first_paint = results["startup"]["first_paint"]
+    if args.target is not None:
+        if first_paint is None or first_paint["median"] > args.target:
+            print("First paint over the " + str(args.target) + " s target")
+            sys.exit(1)
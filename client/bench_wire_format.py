@@ -0,0 +1,116 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+
+import mule_format
+from bench_load import Scenario, publish_changes
+from cep_manager import Cep_manager
+from metrics import Metrics
+from wire_format import Wire_format
+
+# Bytes per event and encode/decode time of the binary wire format against JSON, for single events
+# and envelopes, and of the binary matches against the engine's map format. The events and matches are
+# those of a bench_load.py scenario run through the in-process engine (with correlation ids).
+#
+#   python bench_wire_format.py --patients 2000 --output bench_wire_format.json
+
+class Collector:
+    # Stands in for cep_recorder.Recorder: Cep_manager(local=True) hands it every event and match
+    def __init__(self):
+        self.events = []
+        self.matches = []
+
+    def record_out(self, queue, body):
+        self.events.append(json.loads(body))
+
+    def record_in(self, queue, body):
+        self.matches.append(mule_format.decode(body)["stmt0_out0"])
+
+def collect(scenario_args):
+    scenario = Scenario(**scenario_args)
+    collector = Collector()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cep_manager = Cep_manager(local=True, recorder=collector, metrics=Metrics())
+        cep_manager.start_consuming(lambda pattern: None)
+        for at, kind, patient in scenario.actions:
+            if kind == "arrive":
+                cep_manager.publish_patient(patient)
+            else:
+                if kind == "assess":
+                    scenario.assess(patient)
+                else:
+                    scenario.reassess(patient)
+                publish_changes(cep_manager, patient)
+    return collector.events, collector.matches
+
+def timed(fn, items, repeat):
+    # Best of `repeat` passes, in µs per item
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(items) * 1e6 if items else None
+
+def compare(name, items, count, codecs, repeat):
+    # codecs: format: (encode, decode); count events per item
+    result = dict()
+    for format, (encode, decode) in codecs.items():
+        bodies = [encode(item) for item in items]
+        size = sum(len(body) for body in bodies)
+        result[format] = {
+            "bytes_per_event": size / count,
+            "encode_us_per_event": timed(encode, items, repeat) * len(items) / count,
+            "decode_us_per_event": timed(decode, bodies, repeat) * len(items) / count,
+        }
+    json_size = result["json"]["bytes_per_event"]
+    for format in result:
+        result[format]["size_vs_json"] = result[format]["bytes_per_event"] / json_size
+    print(name + ": " + ", ".join(format + " " + str(round(stats["bytes_per_event"], 1)) + " B " +
+                                  str(round(stats["encode_us_per_event"], 2)) + "/" + str(round(stats["decode_us_per_event"], 2)) + " µs" for format, stats in result.items()))
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binary wire format against JSON")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--envelope", type=int, default=32, help="Events per envelope")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing passes, the best one counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_wire_format.json")
+    args = parser.parse_args()
+
+    wire = Wire_format()
+    events, matches = collect(dict(patients=args.patients, seed=args.seed))
+    envelopes = [events[i:i + args.envelope] for i in range(0, len(events), args.envelope)]
+
+    results = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "events": len(events),
+        "matches": len(matches),
+        "event_types": {name: sum(1 for event in events if event["eventTypeName"] == name) for name in sorted(set(event["eventTypeName"] for event in events))},
+    }
+    results["single"] = compare("single events", events, len(events), {
+        "json": (json.dumps, json.loads),
+        "binary": (lambda event: wire.encode_events([event]), wire.decode_events),
+    }, args.repeat)
+    results["envelope"] = compare("envelopes of " + str(args.envelope), envelopes, len(events), {
+        "json": (json.dumps, json.loads),
+        "binary": (wire.encode_events, wire.decode_events),
+    }, args.repeat)
+    results["matches"] = compare("matches", matches, len(matches), {
+        "json": (json.dumps, json.loads),
+        "map": (lambda pattern: mule_format.encode({"stmt0_out0": pattern}), mule_format.decode),
+        "binary": (lambda pattern: wire.encode_matches([pattern]), wire.decode_matches),
+    }, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + args.output)
@@ -0,0 +1,225 @@
+import json
+import os
+import random
+import struct
+from collections import deque
+from threading import Lock
+
+import pika # RabbitMQ
+
+# Connections to RabbitMQ that survive the broker going away.
+#
+# Connection_pool.connect() has the signature of connection_factory: it returns (connection, channel),
+# trying the endpoints of a cluster in turn, starting with the last one that worked, and raises
+# ConnectionError when none answers. Backoff spaces the reconnect attempts of the publisher and the
+# subscriber (see cep_manager.py) exponentially, with jitter so several clients do not hammer a recovering
+# broker together.
+#
+# Retry_buffer keeps the messages published while the broker is unreachable, in order, until a reconnect
+# lets them out. It holds `capacity` messages in memory; with a path, the overflow (and whatever is left on
+# close) goes to an append-only file, read back in order and picked up again by the next start. Without a
+# path, or past max_disk_bytes, the newest messages are dropped and counted. Messages may be sent twice
+# around a reconnect, never lost or reordered while they fit.
+
+# We are using WSL - the IP to connect to RabbitMQ on the host machine is not localhost. Use cat /etc/resolv.conf to know which (nameserver).
+# Manager at http://localhost:15672/. Endpoint at http://172.31.144.1:5672 (smartdata:smartdata). Queue 'Messages'. Routing 'Messages'.
+# (Please don't store actual passwords in source code)
+default_endpoints = [("172.31.144.1", 5672)]
+default_credentials = ("smartdata", "smartdata")
+
+# What a dropped connection raises from any pika call
+connection_failures = (pika.exceptions.AMQPError, OSError)
+
+class ConnectionError(Exception):
+    pass
+
+def parse_endpoints(text, default_port=5672):
+    # "host1:5672,host2" -> [("host1", 5672), ("host2", 5672)]
+    endpoints = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.rpartition(":") if ":" in item else (item, "", "")
+        endpoints.append((host, int(port) if port else default_port))
+    return endpoints
+
+class Backoff:
+    def __init__(self, initial=0.5, maximum=30.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = initial
+
+    def next(self):
+        # Full jitter over [delay/2, delay], then the next delay doubles
+        delay = random.uniform(self.delay / 2, self.delay)
+        self.delay = min(self.delay * 2, self.maximum)
+        return delay
+
+    def reset(self):
+        self.delay = self.initial
+
+class Connection_pool:
+    def __init__(self, endpoints=default_endpoints, credentials=default_credentials, virtual_host='/', open_connection=None):
+        if not endpoints:
+            raise ValueError("No RabbitMQ endpoints")
+        self.endpoints = list(endpoints)
+        self.credentials = credentials
+        self.virtual_host = virtual_host
+        # open_connection(host, port) -> connection; pika by default, Fake_broker.open_connection in tests
+        self.open_connection = open_connection or self._pika_connection
+        self.lock = Lock()
+        self.current = 0 # Index of the last endpoint that worked
+        self.failures = 0
+
+    def _pika_connection(self, host, port):
+        return pika.BlockingConnection(pika.ConnectionParameters(host, port, self.virtual_host, pika.PlainCredentials(*self.credentials), heartbeat=600, blocked_connection_timeout=300))
+
+    def connect(self):
+        with self.lock:
+            start = self.current
+        errors = []
+        for i in range(len(self.endpoints)):
+            index = (start + i) % len(self.endpoints)
+            host, port = self.endpoints[index]
+            try:
+                connection = self.open_connection(host, port)
+                channel = connection.channel()
+            except connection_failures as e:
+                errors.append(host + ":" + str(port) + " (" + (str(e) or type(e).__name__) + ")")
+                with self.lock:
+                    self.failures += 1
+                continue
+            with self.lock:
+                self.current = index
+            return connection, channel
+        raise ConnectionError("Could not connect to RabbitMQ at " + ", ".join(errors) + ". Is it running?")
+
+default_pool = Connection_pool()
+
+# Retry buffer items: (routing key, bodies, properties, transactional, exchange)
+length_struct = struct.Struct("<I")
+
+def encode_item(item):
+    queue, bodies, properties, transactional, exchange = item
+    header = {
+        "queue": queue,
+        "exchange": exchange,
+        "transactional": transactional,
+        "content_type": properties.content_type if properties else None,
+        "headers": properties.headers if properties else None,
+        "text": [isinstance(body, str) for body in bodies],
+    }
+    parts = [json.dumps(header).encode("utf-8")]
+    parts.extend(body.encode("utf-8") if isinstance(body, str) else bytes(body) for body in bodies)
+    return b"".join(length_struct.pack(len(part)) + part for part in [length_struct.pack(len(parts))] + parts)
+
+def read_item(f):
+    # Returns the next item, or None at the end of the file (or of a torn last record)
+    def part():
+        head = f.read(length_struct.size)
+        if len(head) < length_struct.size:
+            return None
+        (length,) = length_struct.unpack(head)
+        data = f.read(length)
+        return data if len(data) == length else None
+    count = part()
+    header = part() if count is not None else None
+    if header is None:
+        return None
+    header = json.loads(header)
+    bodies = []
+    for is_text in header["text"]:
+        body = part()
+        if body is None:
+            return None
+        bodies.append(body.decode("utf-8") if is_text else body)
+    properties = None
+    if header["content_type"] is not None or header["headers"] is not None:
+        properties = pika.BasicProperties(content_type=header["content_type"], headers=header["headers"])
+    return (header["queue"], bodies, properties, header["transactional"], header["exchange"])
+
+class Retry_buffer:
+    def __init__(self, capacity=10000, path=None, max_disk_bytes=64 * 1024 * 1024):
+        self.capacity = capacity
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = deque()
+        self.dropped = 0
+        self.disk_items = 0 # Unread items in the spill file, which holds the newest ones
+        self.read_offset = 0
+        if path and os.path.exists(path):
+            # Left over from the last run: sent first
+            with open(path, "rb") as f:
+                while read_item(f) is not None:
+                    self.disk_items += 1
+            if self.disk_items:
+                print(str(self.disk_items) + " unsent messages from the last run in " + path)
+            else:
+                os.remove(path)
+
+    def __len__(self):
+        return len(self.memory) + self.disk_items
+
+    def append(self, item):
+        # Once items are on disk, newer ones go there too so the order holds
+        if len(self.memory) < self.capacity and not self.disk_items:
+            self.memory.append(item)
+            return
+        if self.path:
+            data = encode_item(item)
+            size = os.path.getsize(self.path) if self.disk_items else 0
+            if size + len(data) <= self.max_disk_bytes:
+                with open(self.path, "ab" if self.disk_items else "wb") as f:
+                    f.write(data)
+                self.disk_items += 1
+                return
+        self.dropped += len(item[1])
+
+    def peek(self):
+        if not self.memory:
+            self._load()
+        return self.memory[0]
+
+    def pop(self):
+        if not self.memory:
+            self._load()
+        return self.memory.popleft()
+
+    def _load(self):
+        # Moves the next items from disk to memory; the file is removed once fully read
+        with open(self.path, "rb") as f:
+            f.seek(self.read_offset)
+            while self.disk_items and len(self.memory) < max(1, self.capacity // 2):
+                item = read_item(f)
+                if item is None:
+                    self.disk_items = 0 # Torn tail
+                    break
+                self.memory.append(item)
+                self.disk_items -= 1
+            self.read_offset = f.tell()
+        if not self.disk_items:
+            os.remove(self.path)
+            self.read_offset = 0
+
+    def close(self):
+        # With a path, what is left is kept in order for the next run
+        if not self.memory and not self.read_offset:
+            return
+        if not self.path:
+            print(str(sum(len(item[1]) for item in self.memory)) + " unsent messages lost")
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            for item in self.memory:
+                f.write(encode_item(item))
+            if self.disk_items:
+                with open(self.path, "rb") as rest:
+                    rest.seek(self.read_offset)
+                    f.write(rest.read())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self.disk_items += len(self.memory)
+        self.memory.clear()
+        self.read_offset = 0
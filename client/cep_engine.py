@@ -0,0 +1,796 @@
+import os
+import re
+import time
+from collections import deque
+
+# In-process CEP engine for the subset of EPL used in the schemas and patterns directories:
+#   create json schema X as (field Type, ...)
+#   create window W.win:time(...)|win:length(...) as X
+#   insert into W select * from X [where ...]
+#   on X insert into Y select ... where ... [insert into ...] output first|all
+#   select ... from X.win:time(...)|win:length(...) group by ...   (or from W, with the named window's view)
+#   on X delete from W where ... (removes rows from named window W)
+# A named window is kept as the windows of the select statements over it, which all have its view: a
+# delete removes the rows from each of them and outputs the groups it touched again.
+# Every statement is compiled once into Python closures and registered in a dispatch table keyed by
+# event type, so sending an event never looks at the rule text again.
+
+base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+default_schemas_dir = os.path.join(base_dir, "schemas")
+default_patterns_dir = os.path.join(base_dir, "patterns")
+
+# Clients before cep_events.py published ConsciousnessLevel, schemas/ConsciousLevel.epl declares ConsciousLevel;
+# still accepted for their recordings and queued messages.
+event_type_aliases = {"ConsciousnessLevel": "ConsciousLevel"}
+
+time_units = {
+    "msec": 0.001, "millisecond": 0.001, "milliseconds": 0.001,
+    "sec": 1, "second": 1, "seconds": 1,
+    "min": 60, "minute": 60, "minutes": 60,
+    "hour": 3600, "hours": 3600,
+    "day": 86400, "days": 86400,
+}
+
+class EplError(Exception):
+    pass
+
+token_re = re.compile(r"""
+    \s+
+  | (?P<comment>//[^\n]*)
+  | (?P<number>\d+\.\d*|\d+)
+  | (?P<string>"[^"]*"|'[^']*')
+  | (?P<annotation>@\w+)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op><=|>=|!=|<>|[=<>(),.;:*])
+""", re.VERBOSE)
+
+keywords = {"on", "insert", "into", "delete", "select", "where", "output", "first", "all", "from", "group", "by", "as", "and", "or", "not", "in", "create", "json", "schema", "true", "false", "null"}
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = token_re.match(text, pos)
+        if m is None:
+            raise EplError("Unexpected character " + repr(text[pos]) + " at offset " + str(pos))
+        pos = m.end()
+        kind = m.lastgroup
+        if kind is None or kind in ("comment", "annotation"):
+            continue
+        value = m.group(kind)
+        if kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "string":
+            value = value[1:-1]
+        elif kind == "name" and value.lower() in keywords:
+            kind, value = "keyword", value.lower()
+        tokens.append((kind, value))
+    tokens.append(("end", None))
+    return tokens
+
+class Parser:
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            raise EplError("Expected " + (repr(value) if value is not None else kind) + " but found " + repr(self.peek()[1]))
+        return token[1]
+
+    def statements(self):
+        statements = []
+        while self.peek()[0] != "end":
+            if self.accept("keyword", "create"):
+                statements.append(self.window() if self.accept("name", "window") else self.schema())
+            elif self.accept("keyword", "insert"):
+                statements.append(self.insert_statement())
+            elif self.accept("keyword", "on"):
+                statements.append(self.on_statement())
+            elif self.accept("keyword", "select"):
+                statements.append(self.select_statement())
+            else:
+                raise EplError("Unexpected token " + repr(self.peek()[1]))
+            self.accept("op", ";")
+        return statements
+
+    def schema(self):
+        self.expect("keyword", "json")
+        self.expect("keyword", "schema")
+        name = self.expect("name")
+        self.expect("keyword", "as")
+        self.expect("op", "(")
+        fields = []
+        while True:
+            field_name = self.next()[1]
+            field_type = self.expect("name")
+            fields.append((field_name, field_type))
+            if not self.accept("op", ","):
+                break
+        self.expect("op", ")")
+        return ("schema", name, fields)
+
+    def window(self):
+        name, view = self.stream_view()
+        if view is None:
+            raise EplError("Window " + name + " has no view")
+        self.expect("keyword", "as")
+        if self.accept("keyword", "select"):
+            self.expect("op", "*")
+            self.expect("keyword", "from")
+        return ("window", name, view, self.expect("name"))
+
+    def insert_statement(self):
+        self.expect("keyword", "into")
+        target = self.expect("name")
+        self.expect("keyword", "select")
+        self.expect("op", "*")
+        self.expect("keyword", "from")
+        stream = self.expect("name")
+        where = self.expr() if self.accept("keyword", "where") else None
+        return ("insert", target, stream, where)
+
+    def on_statement(self):
+        stream = self.expect("name")
+        alias = self.optional_alias()
+        if self.accept("keyword", "delete"):
+            self.expect("keyword", "from")
+            target, _, target_alias = self.stream_source()
+            where = self.expr() if self.accept("keyword", "where") else None
+            return ("delete", stream, alias, target, target_alias, where)
+        clauses = []
+        while self.accept("keyword", "insert"):
+            self.expect("keyword", "into")
+            target = self.expect("name")
+            self.expect("keyword", "select")
+            items = self.select_items()
+            where = self.expr() if self.accept("keyword", "where") else None
+            clauses.append((target, items, where))
+        if not clauses:
+            raise EplError("on " + stream + " has no insert into clauses")
+        self.expect("keyword", "output")
+        mode = self.next()[1]
+        if mode not in ("first", "all"):
+            raise EplError("Unsupported output mode " + repr(mode))
+        return ("on", stream, alias, clauses, mode)
+
+    def select_statement(self):
+        items = self.select_items()
+        self.expect("keyword", "from")
+        stream, view, alias = self.stream_source()
+        where = self.expr() if self.accept("keyword", "where") else None
+        group_by = []
+        if self.accept("keyword", "group"):
+            self.expect("keyword", "by")
+            group_by.append(self.expr())
+            while self.accept("op", ","):
+                group_by.append(self.expr())
+        return ("select", items, stream, view, alias, where, group_by)
+
+    def select_items(self):
+        items = [self.select_item()]
+        while self.accept("op", ","):
+            items.append(self.select_item())
+        return items
+
+    def select_item(self):
+        expr = self.expr()
+        if self.accept("keyword", "as"):
+            name = self.next()[1]
+        elif expr[0] == "ident":
+            name = expr[1]
+        else:
+            raise EplError("Select expressions need an 'as' name")
+        return (name, expr)
+
+    def stream_source(self):
+        stream, view = self.stream_view()
+        return stream, view, self.optional_alias()
+
+    def stream_view(self):
+        stream = self.expect("name")
+        view = None
+        if self.accept("op", "."):
+            namespace = self.expect("name")
+            self.expect("op", ":")
+            view_name = self.expect("name")
+            self.expect("op", "(")
+            view = self.view(namespace + ":" + view_name)
+            self.expect("op", ")")
+        return stream, view
+
+    def view(self, name):
+        if name == "win:time":
+            amount = self.expect("number")
+            unit = self.accept("name")
+            seconds = amount * time_units[unit[1]] if unit else amount
+            return ("time", seconds)
+        if name == "win:length":
+            return ("length", self.expect("number"))
+        raise EplError("Unsupported view " + name)
+
+    def optional_alias(self):
+        if self.accept("keyword", "as"):
+            return self.expect("name")
+        token = self.peek()
+        if token[0] == "name":
+            self.pos += 1
+            return token[1]
+        return None
+
+    def expr(self):
+        left = self.and_expr()
+        while self.accept("keyword", "or"):
+            left = ("or", left, self.and_expr())
+        return left
+
+    def and_expr(self):
+        left = self.not_expr()
+        while self.accept("keyword", "and"):
+            left = ("and", left, self.not_expr())
+        return left
+
+    def not_expr(self):
+        if self.accept("keyword", "not"):
+            return ("not", self.not_expr())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.primary()
+        token = self.peek()
+        if token[0] == "op" and token[1] in ("=", "!=", "<>", "<", ">", "<=", ">="):
+            self.pos += 1
+            return ("cmp", "!=" if token[1] == "<>" else token[1], left, self.primary())
+        negated = bool(self.accept("keyword", "not"))
+        if self.accept("keyword", "in"):
+            self.expect("op", "(")
+            values = [self.expr()]
+            while self.accept("op", ","):
+                values.append(self.expr())
+            self.expect("op", ")")
+            return ("in", left, values, negated)
+        if negated:
+            raise EplError("Expected 'in' after 'not'")
+        return left
+
+    def primary(self):
+        kind, value = self.next()
+        if kind in ("number", "string"):
+            return ("const", value)
+        if kind == "keyword" and value in ("true", "false", "null"):
+            return ("const", {"true": True, "false": False, "null": None}[value])
+        if kind == "op" and value == "*":
+            return ("star",)
+        if kind == "op" and value == "(":
+            if self.accept("keyword", "select"):
+                items = self.select_items()
+                self.expect("keyword", "from")
+                stream, view, alias = self.stream_source()
+                where = self.expr() if self.accept("keyword", "where") else None
+                self.expect("op", ")")
+                return ("subquery", items, stream, view, alias, where)
+            inner = self.expr()
+            self.expect("op", ")")
+            return inner
+        if kind == "name" or (kind == "keyword" and value in ("first", "all")):
+            if self.accept("op", "("):
+                args = []
+                if not self.accept("op", ")"):
+                    args.append(self.expr())
+                    while self.accept("op", ","):
+                        args.append(self.expr())
+                    self.expect("op", ")")
+                return ("call", value.lower(), args)
+            if self.accept("op", "."):
+                return ("prop", value, self.next()[1])
+            return ("ident", value)
+        raise EplError("Unexpected token " + repr(value))
+
+def parse(text):
+    return Parser(text).statements()
+
+# Every expression compiles to a closure f(ev, sub): ev is the triggering event and sub the row of a
+# subquery being filtered (None outside subqueries). Null follows SQL: comparisons against None are false.
+
+aggregate_functions = ("max", "min", "count", "sum", "avg")
+
+comparisons = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+def has_aggregate(node):
+    if node[0] == "call" and node[1] in aggregate_functions:
+        return True
+    return any(isinstance(child, tuple) and has_aggregate(child) for child in node[1:]) or \
+        any(isinstance(child, list) and any(has_aggregate(c) for c in child) for child in node[1:])
+
+class Compiler:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def expr(self, node, sub_alias=None, inner=False):
+        # Inside a subquery, qualified properties (a.patient) read the subquery row. Unqualified ones
+        # read the subquery row in its select list (inner=True) and the triggering event elsewhere.
+        kind = node[0]
+        if kind == "const":
+            value = node[1]
+            return lambda ev, sub: value
+        if kind == "ident":
+            name = node[1]
+            if inner:
+                return lambda ev, sub: sub.get(name)
+            return lambda ev, sub: ev.get(name)
+        if kind == "prop":
+            alias, name = node[1], node[2]
+            if sub_alias is not None and alias == sub_alias:
+                return lambda ev, sub: sub.get(name)
+            return lambda ev, sub: ev.get(name)
+        if kind == "and":
+            a, b = self.expr(node[1], sub_alias), self.expr(node[2], sub_alias)
+            return lambda ev, sub: a(ev, sub) and b(ev, sub)
+        if kind == "or":
+            a, b = self.expr(node[1], sub_alias), self.expr(node[2], sub_alias)
+            return lambda ev, sub: a(ev, sub) or b(ev, sub)
+        if kind == "not":
+            a = self.expr(node[1], sub_alias)
+            return lambda ev, sub: not a(ev, sub)
+        if kind == "cmp":
+            return self.comparison(node, sub_alias)
+        if kind == "in":
+            return self.membership(node, sub_alias)
+        if kind == "subquery":
+            return self.subquery(node)
+        if kind == "call":
+            raise EplError("Function " + node[1] + " is only supported as an aggregate in select statements")
+        raise EplError("Unsupported expression " + repr(node))
+
+    def comparison(self, node, sub_alias):
+        op, left, right = node[1], node[2], node[3]
+        fn = comparisons[op]
+        a = self.expr(left, sub_alias)
+        if right[0] == "const":
+            value = right[1]
+            if op == "=":
+                return lambda ev, sub: a(ev, sub) == value
+            return lambda ev, sub: (lambda x: x is not None and fn(x, value))(a(ev, sub))
+        b = self.expr(right, sub_alias)
+        def compare(ev, sub):
+            x, y = a(ev, sub), b(ev, sub)
+            return x is not None and y is not None and fn(x, y)
+        return compare
+
+    def membership(self, node, sub_alias):
+        a = self.expr(node[1], sub_alias)
+        negated = node[3]
+        if all(value[0] == "const" for value in node[2]):
+            values = frozenset(value[1] for value in node[2])
+            if negated:
+                return lambda ev, sub: (lambda x: x is not None and x not in values)(a(ev, sub))
+            return lambda ev, sub: a(ev, sub) in values
+        fns = [self.expr(value, sub_alias) for value in node[2]]
+        def contains(ev, sub):
+            x = a(ev, sub)
+            if x is None:
+                return False
+            found = any(x == f(ev, sub) for f in fns)
+            return not found if negated else found
+        return contains
+
+    def subquery(self, node):
+        items, stream, view, alias, where = node[1], node[2], node[3], node[4], node[5]
+        if len(items) != 1:
+            raise EplError("Subqueries must select exactly one value")
+        window = self.engine.named_window(stream, view)
+        value = self.expr(items[0][1], alias or stream, inner=True)
+        condition = self.expr(where, alias or stream) if where is not None else None
+        rows = window.rows
+
+        # Esper returns null when the subquery window holds no matching row.
+        def evaluate(ev, sub):
+            result = None
+            for row in rows:
+                if condition is None or condition(ev, row):
+                    result = value(ev, row)
+            return result
+        return evaluate
+
+    def row(self, items):
+        names = tuple(name for name, _ in items)
+        fns = tuple(self.expr(expr) for _, expr in items)
+        return lambda ev: dict(zip(names, [f(ev, None) for f in fns]))
+
+    def aggregate(self, node):
+        # Returns (factory, value): factory() builds the per-group accumulator (or None for plain
+        # expressions) and value(ev, accumulator) reads the item for the current event.
+        kind = node[0]
+        if kind == "call" and node[1] in aggregate_functions:
+            name, args = node[1], node[2]
+            if args and args[0][0] != "star" and has_aggregate(args[0]):
+                # An aggregate of an aggregate (e.g. max(count(*))) only sees one value per group.
+                return self.aggregate(args[0])
+            a = self.expr(args[0]) if args and args[0][0] != "star" else None
+            if name == "count":
+                return (lambda: Count_accumulator(a)), (lambda ev, acc: acc.count)
+            if name in ("max", "min"):
+                return (lambda: Extreme_accumulator(a, name == "max")), (lambda ev, acc: acc.value())
+            if name == "sum":
+                return (lambda: Sum_accumulator(a)), (lambda ev, acc: acc.total if acc.count else None)
+            return (lambda: Sum_accumulator(a)), (lambda ev, acc: acc.total / acc.count if acc.count else None)
+        if has_aggregate(node):
+            raise EplError("Aggregates can only be combined through nesting")
+        a = self.expr(node)
+        return None, (lambda ev, acc: a(ev, None))
+
+# Group accumulators see rows in window order: add() on arrival and remove() on eviction of the oldest.
+class Count_accumulator:
+    def __init__(self, expr):
+        self.expr = expr
+        self.count = 0
+
+    def add(self, row):
+        if self.expr is None or self.expr(row, None) is not None:
+            self.count += 1
+
+    def remove(self, row):
+        if self.expr is None or self.expr(row, None) is not None:
+            self.count -= 1
+
+class Sum_accumulator:
+    def __init__(self, expr):
+        self.expr = expr
+        self.total = 0
+        self.count = 0
+
+    def add(self, row):
+        value = self.expr(row, None)
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def remove(self, row):
+        value = self.expr(row, None)
+        if value is not None:
+            self.total -= value
+            self.count -= 1
+
+class Extreme_accumulator:
+    # Monotonic deque: amortised O(1) max/min over a FIFO window.
+    def __init__(self, expr, is_max):
+        self.expr = expr
+        self.is_max = is_max
+        self.candidates = deque() # (sequence, value)
+        self.added = 0
+        self.removed = 0
+
+    def add(self, row):
+        value = self.expr(row, None)
+        sequence = self.added
+        self.added += 1
+        if value is None:
+            return
+        candidates = self.candidates
+        if self.is_max:
+            while candidates and candidates[-1][1] <= value:
+                candidates.pop()
+        else:
+            while candidates and candidates[-1][1] >= value:
+                candidates.pop()
+        candidates.append((sequence, value))
+
+    def remove(self, row):
+        if self.candidates and self.candidates[0][0] == self.removed:
+            self.candidates.popleft()
+        self.removed += 1
+
+    def value(self):
+        return self.candidates[0][1] if self.candidates else None
+
+class Window:
+    def __init__(self, view):
+        self.kind, self.size = view if view is not None else ("length", None)
+        self.rows = deque(maxlen=self.size if self.kind == "length" else None)
+        self.times = deque()
+
+    def insert(self, row, timestamp):
+        if self.kind == "time":
+            self.expire(timestamp)
+            self.times.append(timestamp)
+        self.rows.append(row)
+
+    def expire(self, timestamp):
+        limit = timestamp - self.size
+        while self.times and self.times[0] <= limit:
+            self.times.popleft()
+            self.rows.popleft()
+
+class Grouped_window:
+    # One global window whose rows are also bucketed per group key; eviction keeps both in FIFO order.
+    # Deleted rows stay in entries as tombstones (ids in deleted) until they reach the front.
+    def __init__(self, view, key, factories):
+        self.kind, self.size = view if view is not None else ("length", None)
+        self.key = key
+        self.factories = factories
+        self.entries = deque() # (timestamp, key, row)
+        self.groups = dict() # key: [row count, accumulators, rows]
+        self.by_first = dict() # first key value: {key}, to find a patient's groups without a scan
+        self.deleted = set()
+
+    def accumulators(self, rows):
+        accumulators = [factory() if factory else None for factory in self.factories]
+        for row in rows:
+            for accumulator in accumulators:
+                if accumulator is not None:
+                    accumulator.add(row)
+        return accumulators
+
+    def insert(self, row, timestamp):
+        key = self.key(row)
+        self.entries.append((timestamp, key, row))
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [0, self.accumulators(()), deque()]
+            if key:
+                self.by_first.setdefault(key[0], set()).add(key)
+        group[0] += 1
+        group[2].append(row)
+        for accumulator in group[1]:
+            if accumulator is not None:
+                accumulator.add(row)
+
+        if self.kind == "time":
+            limit = timestamp - self.size
+            while self.entries[0][0] <= limit:
+                self.evict()
+        elif self.size is not None:
+            while len(self.entries) - len(self.deleted) > self.size:
+                self.evict()
+        return group[1]
+
+    def evict(self):
+        _, key, row = self.entries.popleft()
+        if self.deleted and id(row) in self.deleted:
+            self.deleted.discard(id(row))
+            return
+        group = self.groups[key]
+        group[0] -= 1
+        group[2].popleft()
+        if group[0] == 0:
+            self.drop(key)
+            return
+        for accumulator in group[1]:
+            if accumulator is not None:
+                accumulator.remove(row)
+
+    def drop(self, key):
+        del self.groups[key]
+        if key:
+            keys = self.by_first[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.by_first[key[0]]
+
+    def delete(self, match, first=None):
+        # Removes the rows match(row) accepts, from the groups whose first key is `first` (all groups for
+        # None), and rebuilds the accumulators of the groups it touched from their remaining rows. Returns
+        # (accumulators, the last removed row) per touched group, so columns outside the aggregates and the
+        # group key describe what was deleted, as in a remove stream; emptied groups get fresh accumulators.
+        keys = self.groups if first is None else self.by_first.get(first, ())
+        changed = []
+        for key in list(keys):
+            group = self.groups[key]
+            kept = deque()
+            removed = None
+            for row in group[2]:
+                if match(row):
+                    self.deleted.add(id(row))
+                    removed = row
+                else:
+                    kept.append(row)
+            if removed is None:
+                continue
+            accumulators = self.accumulators(kept)
+            if kept:
+                group[0], group[1], group[2] = len(kept), accumulators, kept
+            else:
+                self.drop(key)
+            changed.append((accumulators, removed))
+        return changed
+
+class Cep_engine:
+    def __init__(self, schemas_dir=default_schemas_dir, patterns_dir=default_patterns_dir, clock=time.monotonic):
+        self.clock = clock
+        self.output_cb = None
+
+        self.schemas = dict() # event type: [(field, type)]
+        self.coercers = dict() # event type: f(raw event) -> typed event
+        self.handlers = dict() # event type: [f(event, timestamp)]
+        self.windows = dict() # event type: [Window]
+        self.retractors = dict() # event type: [f(match, first key)] of the select statements over it
+        self.named_windows = dict() # window: (view, event type)
+        self.compiler = Compiler(self)
+
+        for statement in self.load_dir(schemas_dir):
+            self.add_schema(statement)
+        for statement in self.load_dir(patterns_dir):
+            self.add_statement(statement)
+
+    @staticmethod
+    def load_dir(path):
+        statements = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".epl"):
+                with open(os.path.join(path, filename)) as f:
+                    try:
+                        statements.extend(parse(f.read()))
+                    except EplError as e:
+                        raise EplError(filename + ": " + str(e)) from e
+        return statements
+
+    def set_output(self, output_cb):
+        self.output_cb = output_cb
+
+    def add_schema(self, statement):
+        _, name, fields = statement
+        self.schemas[name] = fields
+        casts = {"Integer": int, "Long": int, "Float": float, "Double": float, "Boolean": bool, "String": str}
+        converters = tuple((field, casts.get(field_type)) for field, field_type in fields)
+
+        def coerce(raw):
+            event = dict()
+            for field, cast in converters:
+                value = raw.get(field)
+                if value is not None and cast is not None:
+                    try:
+                        value = cast(value)
+                    except ValueError:
+                        value = None
+                event[field] = value
+            return event
+        self.coercers[name] = coerce
+
+    def add_statement(self, statement):
+        kind = statement[0]
+        if kind == "schema":
+            self.add_schema(statement)
+        elif kind == "on":
+            self.add_on_statement(statement)
+        elif kind == "select":
+            self.add_select_statement(statement)
+        elif kind == "delete":
+            self.add_delete_statement(statement)
+        elif kind == "window":
+            _, name, view, stream = statement
+            self.named_windows[name] = (view, stream)
+            self.schemas[name] = self.schemas.get(stream)
+        elif kind == "insert":
+            self.add_insert_statement(statement)
+
+    def add_handler(self, stream, handler):
+        self.handlers.setdefault(stream, []).append(handler)
+
+    def named_window(self, stream, view):
+        window = Window(view)
+        self.windows.setdefault(stream, []).append(window)
+        return window
+
+    def add_on_statement(self, statement):
+        _, stream, _, clauses, mode = statement
+        compiled = tuple(
+            (target, self.compiler.row(items), self.compiler.expr(where) if where is not None else None)
+            for target, items, where in clauses
+        )
+        route = self.route
+        first = mode == "first"
+
+        def handle(ev, timestamp):
+            for target, row, where in compiled:
+                if where is None or where(ev, None):
+                    route(target, row(ev), timestamp)
+                    if first:
+                        return
+        self.add_handler(stream, handle)
+
+    def add_insert_statement(self, statement):
+        _, target, stream, where = statement
+        if target not in self.named_windows:
+            raise EplError("insert into " + target + ": no such window")
+        condition = self.compiler.expr(where) if where is not None else None
+        route = self.route
+
+        def handle(ev, timestamp):
+            if condition is None or condition(ev, None):
+                route(target, ev, timestamp)
+        self.add_handler(stream, handle)
+
+    def add_select_statement(self, statement):
+        _, items, stream, view, alias, where, group_by = statement
+        if stream in self.named_windows:
+            if view is not None:
+                raise EplError("select from window " + stream + " cannot add a view")
+            view = self.named_windows[stream][0]
+        condition = self.compiler.expr(where) if where is not None else None
+        names = tuple(name for name, _ in items)
+        factories, values = zip(*[self.compiler.aggregate(expr) for _, expr in items])
+        key_fns = tuple(self.compiler.expr(expr) for expr in group_by)
+        window = Grouped_window(view, lambda row: tuple([f(row, None) for f in key_fns]), factories)
+        items = tuple(zip(names, values))
+        first_field = group_by[0][1] if group_by and group_by[0][0] == "ident" else None
+
+        def handle(ev, timestamp):
+            if condition is not None and not condition(ev, None):
+                return
+            accumulators = window.insert(ev, timestamp)
+            if self.output_cb is not None:
+                self.output_cb({name: value(ev, acc) for (name, value), acc in zip(items, accumulators)})
+        self.add_handler(stream, handle)
+
+        def retract(match, probe):
+            # probe: (field, value) the deleted rows all have, or None. Every touched group is output again.
+            first = probe[1] if probe is not None and probe[0] == first_field else None
+            for accumulators, row in window.delete(match, first):
+                if self.output_cb is not None:
+                    self.output_cb({name: value(row, acc) for (name, value), acc in zip(items, accumulators)})
+        self.retractors.setdefault(stream, []).append(retract)
+
+    def add_delete_statement(self, statement):
+        _, stream, alias, target, target_alias, where = statement
+        if target not in self.named_windows:
+            raise EplError("on " + stream + " delete from " + target + ": no such window")
+        row_alias = target_alias or target
+        condition = self.compiler.expr(where, row_alias) if where is not None else None
+        probe = self.key_probe(where, row_alias)
+
+        def handle(ev, timestamp):
+            match = (lambda row: condition(ev, row)) if condition is not None else (lambda row: True)
+            found = (probe[0], probe[1](ev, None)) if probe else None
+            for retract in self.retractors.get(target, ()):
+                retract(match, found)
+        self.add_handler(stream, handle)
+
+    def key_probe(self, where, row_alias):
+        # A top-level 'row.field = <trigger expression>' conjunct lets the windows grouped by that field
+        # look up the affected groups instead of scanning every row: (field, f(ev, sub)) or None.
+        if where is None:
+            return None
+        if where[0] == "and":
+            return self.key_probe(where[1], row_alias) or self.key_probe(where[2], row_alias)
+        if where[0] == "cmp" and where[1] == "=":
+            for side, other in ((where[2], where[3]), (where[3], where[2])):
+                if side[0] == "prop" and side[1] == row_alias and not (other[0] == "prop" and other[1] == row_alias):
+                    return (side[2], self.compiler.expr(other, row_alias))
+        return None
+
+    def route(self, stream, event, timestamp):
+        for window in self.windows.get(stream, ()):
+            window.insert(event, timestamp)
+        for handler in self.handlers.get(stream, ()):
+            handler(event, timestamp)
+
+    def send(self, event, timestamp=None):
+        event_type = event["eventTypeName"]
+        event_type = event_type_aliases.get(event_type, event_type)
+        coerce = self.coercers.get(event_type)
+        if coerce is None:
+            raise EplError("Unknown event type " + event_type)
+        self.route(event_type, coerce(event), self.clock() if timestamp is None else timestamp)
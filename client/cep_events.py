@@ -0,0 +1,123 @@
+import keyword
+import math
+from json.encoder import encode_basestring_ascii
+
+from cep_engine import Cep_engine, default_schemas_dir
+
+# The events Cep_manager publishes, as classes generated from the 'create json schema' statements of
+# schemas/*.epl: one __slots__ class per event type with the schema's fields, in order, plus the
+# correlation id (see metrics.Latency_tracker). The event type names and field names are the schema's,
+# so the JSON the engine receives matches its schemas by construction.
+#
+# Every field type is resolved when the classes are generated, an unknown one fails then. to_bytes() is
+# generated source too: the body as json.dumps would write it, built from precomputed key text and the
+# formatter of each field's type, without a dict or the generic encoder. Schema field names that are
+# Python keywords ('class') get a trailing underscore as attributes.
+#
+#   events = cep_events.shared()
+#   events.Temperature(patient=3, value=38.5).to_bytes()
+#     b'{"eventTypeName": "Temperature", "patient": 3, "value": 38.5}'
+
+class EventError(Exception):
+    pass
+
+def float_text(value):
+    # As json.dumps writes floats, NaN and infinities included
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    return repr(value)
+
+# Schema type: expression formatting the non-null value v as JSON
+formatters = {
+    "Integer": "str(int(v))",
+    "Long": "str(int(v))",
+    "Float": "float_text(v)",
+    "Double": "float_text(v)",
+    "Boolean": "('true' if v else 'false')",
+    "String": "encode_basestring_ascii(v)",
+}
+
+class Event:
+    __slots__ = ()
+    event_type = None
+    fields = () # ((schema field, attribute, schema type), ...)
+
+    def __repr__(self):
+        return self.event_type + "(" + ", ".join(attribute + "=" + repr(getattr(self, attribute)) for _, attribute, _ in self.fields) + ")"
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+def attribute_name(field):
+    if not field.isidentifier():
+        raise EventError("Field " + repr(field) + " is not usable as an attribute")
+    return field + "_" if keyword.iskeyword(field) else field
+
+def event_source(name, fields):
+    # Source of the class for the event type `name` with the schema fields [(field, type)]
+    if not name.isidentifier() or keyword.iskeyword(name):
+        raise EventError("Event type " + repr(name) + " is not usable as a class name")
+    resolved = []
+    for field, field_type in fields:
+        if field_type not in formatters:
+            raise EventError(name + "." + field + " has the unsupported type " + field_type)
+        resolved.append((field, attribute_name(field), field_type))
+    attributes = [attribute for _, attribute, _ in resolved]
+    if "cid" in attributes:
+        raise EventError(name + " has a field named cid")
+
+    lines = [
+        "class " + name + "(Event):",
+        "    __slots__ = " + repr(tuple(attributes) + ("cid",)),
+        "    event_type = " + repr(name),
+        "    fields = " + repr(tuple(resolved)),
+        "",
+        "    def __init__(self, " + "".join(attribute + "=None, " for attribute in attributes) + "cid=None):",
+    ]
+    lines += ["        self." + attribute + " = " + attribute for attribute in attributes + ["cid"]]
+
+    # to_bytes: key text and formatter of every field fixed here
+    lines += ["", "    def to_bytes(self):"]
+    parts = [repr('{"eventTypeName": ' + encode_basestring_ascii(name))]
+    for field, attribute, field_type in resolved:
+        lines.append("        v = self." + attribute)
+        lines.append("        " + attribute + "_text = 'null' if v is None else " + formatters[field_type])
+        parts.append(repr(", " + encode_basestring_ascii(field) + ": "))
+        parts.append(attribute + "_text")
+    lines.append("        tail = '}' if self.cid is None else ', \"cid\": ' + str(int(self.cid)) + '}'")
+    lines.append("        return (" + " + ".join(parts + ["tail"]) + ").encode('ascii')")
+
+    # as_dict: the event as the engine and the binary wire format take it
+    lines += ["", "    def as_dict(self):"]
+    lines.append("        event = {'eventTypeName': " + repr(name) + "".join(", " + repr(field) + ": self." + attribute for field, attribute, _ in resolved) + "}")
+    lines += ["        if self.cid is not None:", "            event['cid'] = self.cid", "        return event"]
+    return "\n".join(lines) + "\n"
+
+class Event_types:
+    def __init__(self, schemas_dir=default_schemas_dir):
+        self.types = dict() # event type: class
+        namespace = {"Event": Event, "float_text": float_text, "encode_basestring_ascii": encode_basestring_ascii}
+        for statement in Cep_engine.load_dir(schemas_dir):
+            if statement[0] != "schema":
+                continue
+            _, name, fields = statement[:3]
+            exec(event_source(name, fields), namespace)
+            self.types[name] = namespace[name]
+            setattr(self, name, namespace[name])
+
+    def __getitem__(self, name):
+        return self.types[name]
+
+    def __contains__(self, name):
+        return name in self.types
+
+shared_types = None
+
+def shared():
+    global shared_types
+    if shared_types is None:
+        shared_types = Event_types()
+    return shared_types
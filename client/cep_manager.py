@@ -1,138 +1,694 @@
 import pika # RabbitMQ
-import json
-from threading import Thread
-import re
+import time
+import queue
+from threading import Thread, Lock, Event
+from contextlib import contextmanager
+
+import mule_format
+from cep_engine import Cep_engine
+from metrics import Latency_tracker
+import stations
+import wire_format
+import cep_events
+from broker_pool import ConnectionError, Backoff, Retry_buffer, connection_failures, default_pool
 
 def connection_factory():
-    # These classes will publish events to a RabbitMQ server and sub to them. Right now it is local and unsecured. (Please don't store actual passwords in source code)
-    # We are using WSL - the IP to connect to RabbitMQ on the host machine is not localhost. Use cat /etc/resolv.conf to know which (nameserver).
-    # Manager at http://localhost:15672/. Endpoint at http://172.31.144.1:5672 (smartdata:smartdata). Queue 'Messages'. Routing 'Messages'.
-    try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters('172.31.144.1', 5672, '/', pika.PlainCredentials('smartdata', 'smartdata'), heartbeat=600, blocked_connection_timeout=300))
-        channel = connection.channel()
-    except pika.exceptions.AMQPConnectionError as e:
-        raise ConnectionError("Could not connect to RabbitMQ. Is it running?") from e
-
-    return connection, channel
-
-class ConnectionError(Exception):
-    pass
+    # These classes will publish events to a RabbitMQ server and sub to them. Right now it is local and unsecured.
+    # The default server is in broker_pool.py; broker_pool.Connection_pool(endpoints).connect for a cluster.
+    return default_pool.connect()
 
 class PikaSubscriber():
     exchange_name = ''
 
-    def __init__(self, *args, **kwargs):
-        self.conn, self.channel = connection_factory()
+    # By default every match is acked on arrival, before it is handled. With a prefetch, the broker keeps at
+    # most that many matches unacked in flight, a dispatcher thread decodes and hands them out, and only
+    # then are they acked, ack_batch at a time with a single multiple=True ack (or sooner once the
+    # dispatcher has caught up). A crash loses nothing: the unacked matches are redelivered. A match whose
+    # callback raises is requeued once, then dropped.
+    def __init__(self, connect=connection_factory, recorder=None, routing=None, prefetch=None, ack_batch=100, lag_interval=1.0):
+        self.connect = connect
+        self.recorder = recorder
+        self.routing = routing
+        self.prefetch = prefetch
+        self.ack_batch = ack_batch
+        self.lag_interval = lag_interval # Seconds between broker queue depth checks
+        self.stopped = Event()
+        self.backoff = Backoff()
+        self.reconnects = 0
+        self.conn = self.channel = None # Connected by consume(), on the subscriber thread
+        self.queue = None
+        self.generation = 0 # Delivery tags belong to one channel, counted up on every reconnect
+
+        # Consumer lag: messages received but not dispatched yet, how long the last one waited for the
+        # dispatcher, and the messages still on the broker (refreshed every lag_interval)
+        self.backlog = queue.Queue() # (generation, delivery tag, redelivered, body, received)
+        self.dispatch_delay = 0.0
+        self.queue_depth = 0
+        self.dispatched = 0
+
+    def _declare(self):
+        # A station only consumes its own match queue; without stations everything comes from MuleOut
+        return self.routing.declare_station_queue(self.channel) if self.routing else 'MuleOut'
+
+    def lag(self):
+        return {"backlog": self.backlog.qsize(), "dispatch_delay": self.dispatch_delay, "queue_depth": self.queue_depth, "dispatched": self.dispatched}
 
     def consume(self, callback):
-        for method_frame, properties, body in self.channel.consume('MuleOut'):
+        # Runs until close(); a lost connection is reopened (with backoff) and consuming resumes
+        if not self._reconnect(first=True):
+            return
+        dispatcher = None
+        if self.prefetch:
+            dispatcher = Thread(target=self._dispatch, args=(callback,), daemon=True)
+            dispatcher.start()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    if self.prefetch:
+                        self._receive()
+                    else:
+                        self._consume_each(callback)
+                    return
+                except connection_failures as e:
+                    if self.stopped.is_set():
+                        return
+                    print("Subscriber lost its connection to RabbitMQ: " + str(e))
+                    if not self._reconnect():
+                        return
+        finally:
+            if dispatcher:
+                self.backlog.put(None)
+                dispatcher.join(timeout=5)
+
+    def _consume_each(self, callback):
+        for method_frame, properties, body in self.channel.consume(self.queue):
             self.channel.basic_ack(method_frame.delivery_tag)
+            if self.recorder:
+                self.recorder.record_in(self.queue, body)
+
+            # A binary match message may hold several patterns (see wire_format.py)
+            for pattern in wire_format.patterns_of(body):
+                callback(pattern)
+
+    def _receive(self):
+        # Only queues the messages for the dispatcher; the acks come back through add_callback_threadsafe
+        generation = self.generation
+        check_depth_at = 0.0
+        for method_frame, properties, body in self.channel.consume(self.queue, inactivity_timeout=self.lag_interval):
+            now = time.monotonic()
+            if method_frame is not None:
+                self.backlog.put((generation, method_frame.delivery_tag, method_frame.redelivered, body, now))
+            if now >= check_depth_at:
+                self.queue_depth = self.channel.queue_declare(queue=self.queue, passive=True).method.message_count
+                check_depth_at = now + self.lag_interval
 
-            s = body.decode("utf-8") # Cursed JSON: https://stackoverflow.com/questions/68682209/parse-json-without-quotes-in-python
-            s = re.sub('\s', '', s) # Remove whitespace
-            s = re.sub('(\w+)', '"\g<1>"', s) # Add quotes around keys and vals
-            s = re.sub('=', ':', s) # Replace = with :
+    def _dispatch(self, callback):
+        last = None # (generation, delivery tag) of the newest dispatched message not acked yet
+        unacked = 0
+        while True:
+            item = self.backlog.get()
+            if item is None:
+                break
+            generation, tag, redelivered, body, received = item
+            if generation != self.generation:
+                continue # Received on a channel that is gone, the broker redelivers it
+            self.dispatch_delay = time.monotonic() - received
+            try:
+                if self.recorder:
+                    self.recorder.record_in(self.queue, body)
+                for pattern in wire_format.patterns_of(body):
+                    callback(pattern)
+            except Exception as e:
+                print("Match message failed (" + ("dropped" if redelivered else "requeued") + "): " + repr(e))
+                if last:
+                    self._ack(*last)
+                    last, unacked = None, 0
+                self._reject(generation, tag, not redelivered)
+                continue
+            self.dispatched += 1
+            last = (generation, tag)
+            unacked += 1
+            if unacked >= self.ack_batch or self.backlog.empty():
+                self._ack(*last)
+                last, unacked = None, 0
+        if last:
+            self._ack(*last)
 
-            callback(json.loads(s)["stmt0_out0"])
+    def _on_channel(self, generation, action):
+        # pika channels are not thread safe, the consuming thread runs the action between deliveries
+        def run():
+            if generation == self.generation and self.channel.is_open:
+                action(self.channel)
+        try:
+            self.conn.add_callback_threadsafe(run)
+        except connection_failures:
+            pass # Lost, the broker redelivers what was not acked
+
+    def _ack(self, generation, tag):
+        self._on_channel(generation, lambda channel: channel.basic_ack(tag, multiple=True))
+
+    def _reject(self, generation, tag, requeue):
+        self._on_channel(generation, lambda channel: channel.basic_reject(tag, requeue=requeue))
+
+    def _reconnect(self, first=False):
+        while not self.stopped.is_set():
+            try:
+                self.conn, self.channel = self.connect()
+                self.queue = self._declare()
+                if self.prefetch:
+                    self.channel.basic_qos(prefetch_count=self.prefetch)
+            except (ConnectionError,) + connection_failures as e:
+                delay = self.backoff.next()
+                print("Subscriber could not reconnect: " + str(e) + " Retrying in " + str(round(delay, 1)) + " s")
+                self.stopped.wait(delay)
+                continue
+            self.generation += 1
+            if not first:
+                self.reconnects += 1
+                print("Subscriber reconnected to RabbitMQ")
+            self.backoff.reset()
+            return True
+        return False
 
     def close(self):
-        self.conn.add_callback_threadsafe(self._close_callback)
+        self.stopped.set()
+        try:
+            if self.conn:
+                self.conn.add_callback_threadsafe(self._close_callback)
+        except connection_failures:
+            pass # Already gone, consume() sees stopped
 
     def _close_callback(self):
         self.channel.stop_consuming()
         self.channel.close()
         self.conn.close()
 
+connect_poll_interval = 0.1 # Seconds between checks of a connect in progress
+
+class Blocking_publisher:
+    # Keeps its connection and channels across publishes. When the broker goes away the messages wait in
+    # the retry buffer, in order, and go out once a reconnect succeeds. publish() and retry() start the
+    # reconnect, no sooner than the backoff allows, on a thread of its own and only check whether it has
+    # finished: opening a connection blocks, and this may run on the Tk thread. With required=False a
+    # failed first connect is retried the same way instead of raising; with background=True the first
+    # connect is made from that thread too, so the caller does not even wait for that (publishes are
+    # buffered until it succeeds).
+    def __init__(self, connect=connection_factory, retry_buffer=None, required=True, background=False):
+        self.connect = connect
+        self.retry_buffer = retry_buffer if retry_buffer is not None else Retry_buffer()
+        self.backoff = Backoff()
+        self.conn = self.channel = self.tx_channel = None
+        self.retry_at = 0.0
+        self.error = None
+        self.sent = 0
+        self.reconnects = 0
+        self.connecting = False
+        self.connected = False # Once connected, later connects count as reconnects
+        self.closing = Event()
+        if required and not background:
+            self.conn, self.channel = connect()
+            self.connected = True
+        else:
+            self._start_connecting()
+
+    def _start_connecting(self):
+        self.connecting = True
+        Thread(target=self._connect_in_background, name="cep-connect", daemon=True).start()
+
+    def _connect_in_background(self):
+        while not self.closing.is_set():
+            try:
+                conn, channel = self.connect()
+            except ConnectionError as e:
+                self.error = e
+                self.closing.wait(self.backoff.next())
+                continue
+            if self.closing.is_set():
+                conn.close()
+                break
+            if self.connected:
+                self.reconnects += 1
+                print("Publisher reconnected to RabbitMQ, " + str(len(self.retry_buffer)) + " messages to resend")
+            self.connected = True
+            self.error = None
+            self.backoff.reset()
+            self.conn = conn
+            self.channel = channel # Last: publish() starts using the connection once this is set
+            if self.closing.is_set():
+                self._close_connection() # close() ran meanwhile
+            break
+        self.connecting = False
+
+    def publish(self, queue, bodies, properties=None, transactional=False, exchange=''):
+        item = (queue, bodies, properties, transactional, exchange)
+        if self.channel is not None and not len(self.retry_buffer):
+            try:
+                self._send(*item)
+                return
+            except connection_failures as e:
+                self._lost(e)
+        self.retry_buffer.append(item)
+        self.retry()
+
+    def retry(self):
+        # Sends the buffered messages, oldest first; False while the broker is unreachable
+        while len(self.retry_buffer):
+            if self.channel is None and not self._reconnect():
+                return False
+            try:
+                self._send(*self.retry_buffer.peek())
+            except connection_failures as e:
+                self._lost(e)
+                return False
+            self.retry_buffer.pop()
+        return True
+
+    def _reconnect(self):
+        # True once the connecting thread has finished; starts it when the backoff allows
+        if self.channel is not None:
+            return True
+        if not self.connecting and time.monotonic() >= self.retry_at and not self.closing.is_set():
+            self._start_connecting()
+        if self.connecting:
+            self.retry_at = time.monotonic() + connect_poll_interval # When to look again (Async_publisher)
+        return False
+
+    def _lost(self, e):
+        print("Publisher lost its connection to RabbitMQ: " + str(e) + ". Buffering until it is back")
+        self.error = e
+        self._close_connection()
+        self.retry_at = time.monotonic() + self.backoff.next()
+
+    def _close_connection(self):
+        for closeable in (self.tx_channel, self.channel, self.conn):
+            try:
+                if closeable and closeable.is_open:
+                    closeable.close()
+            except connection_failures:
+                pass
+        self.conn = self.channel = self.tx_channel = None
+
+    def _send(self, queue, bodies, properties=None, transactional=False, exchange=''):
+        # queue is the routing key: a queue name on the default exchange
+        if not transactional:
+            for body in bodies:
+                self.channel.basic_publish(exchange=exchange, routing_key=queue, body=body, properties=properties)
+            self.sent += len(bodies)
+            return
+
+        # Publishing inside a transaction gets the whole flush confirmed by the broker with a single
+        # round trip (tx_commit) instead of one confirm per message.
+        if self.tx_channel is None:
+            self.tx_channel = self.conn.channel()
+            self.tx_channel.tx_select()
+        for body in bodies:
+            self.tx_channel.basic_publish(exchange=exchange, routing_key=queue, body=body, properties=properties)
+        self.tx_channel.tx_commit()
+        self.sent += len(bodies)
+
+    def idle(self):
+        if self.channel is None or self.connecting:
+            self.retry()
+            return
+        try:
+            self.conn.process_data_events(0)
+        except connection_failures as e:
+            self._lost(e)
+
+    def close(self):
+        # A last attempt; with a retry file what is still buffered is kept for the next start
+        self.closing.set()
+        self.retry()
+        self.retry_buffer.close()
+        self._close_connection()
+
+class PublishOverflow(Exception):
+    pass
+
+class Async_publisher:
+    # Publishes from its own I/O thread, fed by a bounded queue, so callers never wait on the broker.
+    # When the queue is full the overflow policy decides: "block" (the default; up to block_timeout
+    # seconds, then drop), "drop_newest", "drop_oldest" or "raise" (PublishOverflow). Dropped events
+    # are counted in metrics() and reported, at most every drop_report_interval seconds.
+    overflow_policies = ("block", "drop_newest", "drop_oldest", "raise")
+    drop_report_interval = 10.0 # Seconds
+
+    def __init__(self, maxsize=10000, overflow="block", block_timeout=None, connect=connection_factory, retry_buffer=None):
+        if overflow not in self.overflow_policies:
+            raise ValueError("Unknown overflow policy " + repr(overflow))
+        self.queue = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.connect = connect
+        self.retry_buffer = retry_buffer if retry_buffer is not None else Retry_buffer()
+        self.publisher = None # Blocking_publisher, owned by the I/O thread
+
+        self.lock = Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.blocked_seconds = 0.0
+        self.reported_drops = 0
+        self.reported_at = None
+
+        self.thread = Thread(target=self._run, name="cep-publisher", daemon=True)
+        self.thread.start()
+
+    def publish(self, queue_name, bodies, properties=None, transactional=False, exchange=''):
+        item = (queue_name, bodies, properties, transactional, exchange)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if not self._overflow(item):
+                return False
+        with self.lock:
+            self.enqueued += len(bodies)
+            self.high_water = max(self.high_water, self.queue.qsize())
+        return True
+
+    def _overflow(self, item):
+        if self.overflow == "raise":
+            raise PublishOverflow("Publish queue is full (" + str(self.queue.maxsize) + " items)")
+        if self.overflow == "block":
+            start = time.perf_counter()
+            try:
+                self.queue.put(item, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                pass
+            finally:
+                with self.lock:
+                    self.blocked_seconds += time.perf_counter() - start
+        elif self.overflow == "drop_oldest":
+            while True:
+                try:
+                    self._dropped(len(self.queue.get_nowait()[1]))
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(item)
+                    return True
+                except queue.Full:
+                    continue
+        self._dropped(len(item[1]))
+        return False
+
+    def _dropped(self, count):
+        now = time.monotonic()
+        with self.lock:
+            self.dropped += count
+            if self.reported_at is not None and now - self.reported_at < self.drop_report_interval:
+                return
+            new = self.dropped - self.reported_drops
+            self.reported_drops = self.dropped
+            self.reported_at = now
+        print("Publish queue full (" + self.overflow + "): dropped " + str(new) + " events, " + str(self.dropped) + " in total")
+
+    def metrics(self):
+        publisher = self.publisher
+        with self.lock:
+            return {
+                "depth": self.queue.qsize(),
+                "capacity": self.queue.maxsize,
+                "high_water": self.high_water,
+                "enqueued": self.enqueued,
+                "published": publisher.sent if publisher else 0,
+                "dropped": self.dropped + self.retry_buffer.dropped,
+                "blocked_seconds": self.blocked_seconds,
+                "retry_depth": len(self.retry_buffer),
+                "reconnects": publisher.reconnects if publisher else 0,
+                "error": str(publisher.error) if publisher and publisher.error else None,
+            }
+
+    def _run(self):
+        # The pika connection belongs to this thread; it is never touched from the caller's thread.
+        # While the broker is away the queue keeps draining into the retry buffer.
+        publisher = self.publisher = Blocking_publisher(self.connect, self.retry_buffer, required=False)
+        while True:
+            waiting = len(self.retry_buffer) > 0
+            try:
+                item = self.queue.get(timeout=max(0.01, publisher.retry_at - time.monotonic()) if waiting else 30)
+            except queue.Empty:
+                if waiting:
+                    publisher.retry()
+                else:
+                    publisher.idle() # Keep heartbeats going while there is nothing to publish
+                continue
+            if item is None:
+                break
+            publisher.publish(*item)
+        publisher.close()
+
+    def close(self, timeout=5):
+        # A stuck I/O thread must not hang the caller: past timeout what is still queued is dropped
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            while True:
+                try:
+                    self._dropped(len(self.queue.get_nowait()[1]))
+                except queue.Empty:
+                    break
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+        self.thread.join(timeout=timeout)
+
+max_batch_delay = 0.05 # Seconds
+
 class Cep_manager:
-    def __init__(self):
+    def __init__(self, local=False, batch_size=None, batch_interval=None, envelope=False, async_publish=False, publish_queue_size=10000, overflow="block", connect=connection_factory, recorder=None, metrics=None, sample_every=1, routing=None, binary=False, retry_buffer_size=10000, retry_path=None, prefetch=None, ack_batch=100, background_connect=False):
         self.pattern_cb = None
-        self.connection = None
-        self.channel = None
-
-        self.conn, self.channel = connection_factory()
+        self.publisher = None
         self.consumer = None
+        self.engine = None
+        self.connect = connect # connection_factory, or e.g. Fake_broker().connection_factory
+        self.recorder = recorder # cep_recorder.Recorder capturing the traffic
+        self.metrics = metrics # metrics.Metrics; enables correlation ids and latency tracking
+        self.latency = Latency_tracker(metrics, sample_every) if metrics else None
+        self.routing = routing # stations.Station_routing when several stations share the CEP engine
+        self.wire = wire_format.shared() if binary else None # Binary event bodies instead of JSON
+        self.events = cep_events.shared() # Event classes of the schemas
+        self.prefetch = prefetch # Matches in flight, acked in batches of ack_batch once handled (see PikaSubscriber)
+        self.ack_batch = ack_batch
+
+        # Batching: events are held back and sent in one flush when batch_size events are pending,
+        # batch_interval seconds have passed since the first one, or the outermost batch() block ends.
+        # With envelope, a flush is a single AMQP message holding a JSON array of events. A batch_size
+        # alone gets max_batch_delay as its interval, or a partial batch would wait for more events.
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval if batch_interval or not batch_size else max_batch_delay
+        self.envelope = envelope
+        self.batch_depth = 0
+        self.pending = []
+        self.pending_since = None
+
+        if local:
+            # Run the patterns in-process instead of going through RabbitMQ and a remote engine.
+            self.engine = Cep_engine()
+        else:
+            # Messages published while the broker is unreachable wait here (and in retry_path past
+            # retry_buffer_size), see broker_pool.py
+            retry_buffer = Retry_buffer(retry_buffer_size, retry_path)
+            # With background_connect nothing here waits for the broker: the publisher's first connection
+            # is opened from another thread (the async publisher and the subscriber always do that)
+            publisher_connect = self._connect_publisher if routing else connect
+            if async_publish:
+                self.publisher = Async_publisher(maxsize=publish_queue_size, overflow=overflow, connect=publisher_connect, retry_buffer=retry_buffer)
+            else:
+                self.publisher = Blocking_publisher(publisher_connect, retry_buffer, background=background_connect)
+
+        if metrics:
+            metrics.gauge("cep_pending_events", lambda: len(self.pending))
+            if isinstance(self.publisher, Async_publisher):
+                for key in ("depth", "high_water", "dropped"):
+                    metrics.gauge("cep_publish_queue_" + key, lambda key=key: self.publisher.metrics()[key])
+            if self.publisher:
+                metrics.gauge("cep_retry_buffer_depth", lambda: len(retry_buffer))
+                metrics.gauge("cep_retry_buffer_dropped", lambda: retry_buffer.dropped)
+                metrics.gauge("cep_broker_reconnects", self.reconnects)
+                for key in ("backlog", "dispatch_delay", "queue_depth"):
+                    metrics.gauge("cep_consumer_" + key, lambda key=key: self.consumer.lag()[key] if self.consumer else 0)
+
+    def _connect_publisher(self):
+        # Every publisher connection declares the station exchanges, it may be the first client of a broker
+        conn, channel = self.connect()
+        try:
+            stations.declare_exchanges(channel)
+        except connection_failures as e:
+            raise ConnectionError("Could not declare the station exchanges: " + str(e)) from e
+        return conn, channel
+
+    def broker_status(self):
+        # None with the local engine, else (connected, last connection error or None)
+        if not self.publisher:
+            return None
+        publisher = self.publisher.publisher if isinstance(self.publisher, Async_publisher) else self.publisher
+        if publisher is None:
+            return (False, None)
+        return (publisher.channel is not None, publisher.error)
 
     def start_consuming(self, pattern_cb):
         self.pattern_cb = pattern_cb
 
+        if self.engine:
+            self.engine.set_output(self._on_local_pattern)
+            return
+
         # Lauch thread for subscriber
-        subscriber = Thread(target=self._subscribe, args=(pattern_cb,))
+        self.consumer = PikaSubscriber(self.connect, self.recorder, self.routing, self.prefetch, self.ack_batch)
+        subscriber = Thread(target=self.consumer.consume, args=(self._on_pattern,))
         subscriber.start()
 
-    def _subscribe(self, callback):
-        self.consumer = PikaSubscriber()
-        self.consumer.consume(callback)
+    def _on_local_pattern(self, pattern):
+        if self.recorder:
+            self.recorder.record_in('MuleOut', mule_format.encode({"stmt0_out0": pattern}))
+        self._on_pattern(pattern)
+
+    def _on_pattern(self, pattern):
+        if self.latency:
+            self.latency.received(pattern)
+        self.pattern_cb(pattern)
+
+    def patterns_displayed(self, patient_ids):
+        # Called by the UI once the matches for these patients are on screen
+        if self.latency:
+            self.latency.displayed(patient_ids)
+
+    def patient_removed(self, patient_id):
+        if self.latency:
+            self.latency.forget(patient_id)
 
     def publish_patient(self, patient):
-        body = json.dumps({
-            "eventTypeName": "Patient",
-            "patient": patient.id,
-            "ssn": patient.ssn if patient.ssn != "" else None,
-            "age": int(patient.age)*12 if patient.age != "" else None, # Months
-            "is_male": patient.is_male,
-            "latitude": patient.latitude if patient.latitude != "" else None,
-            "longitude": patient.longitude if patient.longitude != "" else None,
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.Patient(
+            patient=patient.id,
+            ssn=patient.ssn if patient.ssn != "" else None,
+            age=int(patient.age)*12 if patient.age != "" else None, # Months
+            is_male=patient.is_male,
+            latitude=float(patient.latitude) if patient.latitude != "" else None,
+            longitude=float(patient.longitude) if patient.longitude != "" else None,
+        ))
 
     def publish_life_threat(self, id, life_threat_id):
-        body = json.dumps({
-            "eventTypeName": "LifeThreat",
-            "patient": id,
-            "type": life_threat_id
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.LifeThreat(patient=id, type=life_threat_id))
 
     def publish_consciousness(self, id, consciousness_id):
-        body = json.dumps({
-            "eventTypeName": "ConsciousnessLevel",
-            "patient": id,
-            "type": consciousness_id
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.ConsciousLevel(patient=id, type=consciousness_id))
 
     def publish_haemorrhage(self, id, haemorrhage_id):
-        body = json.dumps({
-            "eventTypeName": "Haemorrhage",
-            "patient": id,
-            "type": haemorrhage_id
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.Haemorrhage(patient=id, type=haemorrhage_id))
 
     def publish_temperature(self, id, temperature_float):
-        body = json.dumps({
-            "eventTypeName": "Temperature",
-            "patient": id,
-            "value": temperature_float
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.Temperature(patient=id, value=temperature_float))
 
     def publish_pain_level(self, id, pain_level_id):
-        body = json.dumps({
-            "eventTypeName": "Pain",
-            "patient": id,
-            "type": pain_level_id
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.Pain(patient=id, type=pain_level_id))
 
     def publish_specific_symptom(self, id, symptom_name):
-        body = json.dumps({
-            "eventTypeName": "Symptom",
-            "patient": id,
-            "name": symptom_name
-        })
-        self._publish_to_queue('Messages', body)
+        self._publish_event(self.events.Symptom(patient=id, name=symptom_name))
 
-    def _publish_to_queue(self, queue, body):
-        print("Publishing to queue " + queue + ": " + body)
-        self.channel.basic_publish(exchange='', routing_key=queue, body=body)
+    def publish_retraction(self, id, source):
+        # Withdraws the evidence of a cleared general symptom (its event type) or specific symptom (its name)
+        self._publish_event(self.events.Retraction(patient=id, source=source))
+
+    @contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0 and not self.batch_size and not self.batch_interval:
+                self.flush()
+            else:
+                self.flush_due()
+
+    def reconnects(self):
+        publisher = self.publisher.publisher if isinstance(self.publisher, Async_publisher) else self.publisher
+        return (publisher.reconnects if publisher else 0) + (self.consumer.reconnects if self.consumer else 0)
+
+    def flush_due(self):
+        # Also where a blocking publisher retries after an outage, this is called on a timer
+        if isinstance(self.publisher, Blocking_publisher) and len(self.publisher.retry_buffer):
+            self.publisher.retry()
+        if not self.pending:
+            return
+        if self.batch_size and len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.batch_interval and time.monotonic() - self.pending_since >= self.batch_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        events, self.pending = self.pending, []
+        self.pending_since = None
+
+        # With stations, every partition gets its own messages (and envelopes)
+        groups = dict() # routing key: events
+        for event in events:
+            groups.setdefault(self._routing_key(event), []).append(event)
+        exchange = stations.events_exchange if self.routing else ''
+
+        for key, events in groups.items():
+            if self.envelope:
+                bodies = [self.wire.encode_events([event.as_dict() for event in events]) if self.wire else b"[" + b", ".join(event.to_bytes() for event in events) + b"]"]
+                properties = pika.BasicProperties(content_type=self._content_type(), headers={'envelope': len(events)})
+            elif self.wire:
+                bodies = [self.wire.encode_events([event.as_dict()]) for event in events]
+                properties = pika.BasicProperties(content_type=self._content_type())
+            else:
+                bodies = [event.to_bytes() for event in events]
+                properties = None
+
+            if self.recorder:
+                for body in bodies:
+                    self.recorder.record_out(key, body)
+            self.publisher.publish(key, bodies, properties, transactional=True, exchange=exchange)
+
+    def _content_type(self):
+        return 'application/x-triage-events' if self.wire else 'application/json'
+
+    def _encode(self, event):
+        return self.wire.encode_events([event.as_dict()]) if self.wire else event.to_bytes()
+
+    def _routing_key(self, event):
+        return self.routing.event_key(event.patient) if self.routing else 'Messages'
+
+    def _publish_event(self, event):
+        if self.latency:
+            self.latency.sent(event)
+        if self.engine:
+            if self.recorder:
+                self.recorder.record_out('Messages', self._encode(event))
+            self.engine.send(event.as_dict())
+        elif self.batch_depth or self.batch_size or self.batch_interval:
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append(event)
+            self.flush_due()
+        else:
+            self._publish_to_queue(self._routing_key(event), self._encode(event), stations.events_exchange if self.routing else '')
+
+    def _publish_to_queue(self, queue, body, exchange=''):
+        properties = pika.BasicProperties(content_type=self._content_type()) if self.wire else None
+        if self.recorder:
+            self.recorder.record_out(queue, body)
+        self.publisher.publish(queue, [body], properties, exchange=exchange)
+
+    def publisher_metrics(self):
+        if isinstance(self.publisher, Async_publisher):
+            return self.publisher.metrics()
+        return None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.channel.close()
-        self.conn.close()
+        if self.publisher:
+            self.flush()
+            self.publisher.close()
 
         if self.consumer:
             self.consumer.close()
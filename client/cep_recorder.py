@@ -0,0 +1,324 @@
+import argparse
+import gzip
+import json
+import struct
+import time
+import zlib
+from collections import Counter, defaultdict
+from threading import Lock, Thread
+
+import stations
+from cep_engine import Cep_engine
+from fake_broker import Fake_broker
+from wire_format import events_of, patterns_of
+
+# Records CEP traffic and plays it back.
+# Cep_manager(recorder=Recorder(path)) appends every body published to 'Messages' and every MuleOut
+# message consumed, with the time since the recording started, to a gzip file:
+#   magic, start wall time (d), then per message: time (d), direction (B), queue name length (B),
+#   body length (I), queue name, body.
+# Replayer plays the published bodies back with their original spacing (or N times faster, or as fast as
+# possible) into the in-process engine, the fake broker or a real RabbitMQ, measures the latency from each
+# event to the matches it triggers per event type, and compares the matches with the recorded ones.
+#
+#   python cep_recorder.py traffic.rec --speed 10 --target fake --compare
+
+magic = b"CEPREC1\n"
+file_header = struct.Struct("<d")
+record_header = struct.Struct("<dBBI")
+
+OUT, IN = 0, 1
+
+class RecordingError(Exception):
+    pass
+
+class Record:
+    __slots__ = ("time", "direction", "queue", "body")
+
+    def __init__(self, time, direction, queue, body):
+        self.time = time
+        self.direction = direction
+        self.queue = queue
+        self.body = body
+
+flush_interval = 1.0 # Seconds; a recording whose process dies loses at most this much
+
+class Recorder:
+    # Called from the Tk thread (publishing) and the subscriber thread (consuming), hence the lock.
+    # The gzip stream is sync-flushed every flush_interval, so a recording that is never closed can
+    # still be read up to the last flush.
+    def __init__(self, path):
+        self.file = gzip.open(path, "wb", compresslevel=6)
+        self.start = time.perf_counter()
+        self.flushed_at = self.start
+        self.lock = Lock()
+        self.count = 0
+        self.file.write(magic + file_header.pack(time.time()))
+
+    def record(self, direction, queue, body):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        name = queue.encode("utf-8")
+        with self.lock:
+            if self.file is None:
+                return
+            now = time.perf_counter()
+            self.file.write(record_header.pack(now - self.start, direction, len(name), len(body)) + name + body)
+            self.count += 1
+            if now - self.flushed_at >= flush_interval:
+                self.file.flush()
+                self.flushed_at = now
+
+    def record_out(self, queue, body):
+        self.record(OUT, queue, body)
+
+    def record_in(self, queue, body):
+        self.record(IN, queue, body)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+def read_data(path):
+    # Decompressed incrementally rather than with gzip.open, which rejects a file without its end of
+    # stream: a recording whose process died keeps everything up to the last flush
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    with open(path, "rb") as f:
+        while not decompressor.eof:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            try:
+                chunks.append(decompressor.decompress(chunk))
+            except zlib.error:
+                break # Corrupt from here on
+    return b"".join(chunks)
+
+def read_records(path):
+    data = read_data(path)
+    if not data.startswith(magic):
+        raise RecordingError(path + " is not a CEP recording")
+    (started,) = file_header.unpack_from(data, len(magic))
+    offset = len(magic) + file_header.size
+    records = []
+    while offset + record_header.size <= len(data):
+        t, direction, name_length, body_length = record_header.unpack_from(data, offset)
+        offset += record_header.size
+        if offset + name_length + body_length > len(data):
+            break # Torn tail, the recording process died mid-write
+        queue = data[offset:offset + name_length].decode("utf-8")
+        offset += name_length
+        records.append(Record(t, direction, queue, data[offset:offset + body_length]))
+        offset += body_length
+    return started, records
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def match_key(pattern):
+    return tuple(sorted((key, str(value)) for key, value in pattern.items()))
+
+class Engine_target:
+    # Sends straight into a Cep_engine. The engine is synchronous, so the matches emitted during send()
+    # belong to the event being sent. Events keep their recorded timestamps, so time windows behave as
+    # they did when recording regardless of the playback speed.
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else Cep_engine()
+        self.engine.set_output(self._on_match)
+        self.matches = []
+        self.latencies = defaultdict(list)
+        self.event_counts = Counter()
+        self.current = None
+
+    def _on_match(self, pattern):
+        self.matches.append(pattern)
+        event_type, sent = self.current
+        self.latencies[event_type].append(time.perf_counter() - sent)
+
+    def send(self, queue, body, timestamp):
+        for event in events_of(body):
+            self.event_counts[event["eventTypeName"]] += 1
+            self.current = (event["eventTypeName"], time.perf_counter())
+            self.engine.send(event, timestamp=timestamp)
+
+    def finish(self, timeout):
+        pass
+
+class Broker_target:
+    # Publishes through a broker connection and consumes the matches on a second one. A match is attributed
+    # to the last event sent for its patient. With stations the matches come from a private exclusive queue
+    # bound to the stations' keys on the matches exchange, next to (not instead of) their own queues; without
+    # them they are taken off MuleOut, so no client should be consuming it during the replay.
+    def __init__(self, connect, station_ids=()):
+        self.conn, self.channel = connect()
+        self.consumer_conn, self.consumer_channel = connect()
+        if station_ids:
+            stations.declare_exchanges(self.consumer_channel)
+            self.matches_queue = self.consumer_channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+            for station in station_ids:
+                self.consumer_channel.queue_bind(queue=self.matches_queue, exchange=stations.matches_exchange, routing_key="matches." + str(station) + ".#")
+        else:
+            self.matches_queue = 'MuleOut'
+        self.matches = []
+        self.latencies = defaultdict(list)
+        self.event_counts = Counter()
+        self.last_sent = dict() # patient: (event type, time)
+        self.lock = Lock()
+        self.received_at = time.perf_counter()
+        self.thread = Thread(target=self._consume, name="replay-consumer", daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        for method_frame, properties, body in self.consumer_channel.consume(self.matches_queue, inactivity_timeout=0.1):
+            if body is None:
+                continue
+            self.consumer_channel.basic_ack(method_frame.delivery_tag)
+            now = time.perf_counter()
+            with self.lock:
+                for pattern in patterns_of(body):
+                    self.matches.append(pattern)
+                    sent = self.last_sent.get(str(pattern.get("patient")))
+                    if sent:
+                        self.latencies[sent[0]].append(now - sent[1])
+                self.received_at = now
+
+    def send(self, queue, body, timestamp):
+        events = events_of(body)
+        now = time.perf_counter()
+        with self.lock:
+            for event in events:
+                self.event_counts[event["eventTypeName"]] += 1
+                self.last_sent[str(event.get("patient"))] = (event["eventTypeName"], now)
+        # Recorded on a station: the routing key of the events exchange (see stations.py)
+        exchange = stations.events_exchange if queue.startswith("events.") else ''
+        self.channel.basic_publish(exchange=exchange, routing_key=queue, body=body)
+
+    def finish(self, timeout):
+        # Wait until no match has arrived for `timeout` seconds
+        while True:
+            with self.lock:
+                quiet = time.perf_counter() - self.received_at
+            if quiet >= timeout:
+                break
+            time.sleep(timeout - quiet)
+        self.consumer_conn.add_callback_threadsafe(self.consumer_channel.stop_consuming)
+        self.thread.join(timeout=5)
+        self.channel.close()
+        self.conn.close()
+        self.consumer_conn.close()
+
+class Replayer:
+    def __init__(self, path):
+        self.started, self.records = read_records(path)
+
+    def published(self):
+        return [record for record in self.records if record.direction == OUT]
+
+    def station_ids(self):
+        # Stations the recording published for, from the events.<partition>.<station> routing keys
+        return sorted({int(record.queue.split(".")[2]) for record in self.published() if record.queue.startswith("events.")})
+
+    def recorded_matches(self):
+        return [pattern for record in self.records if record.direction == IN for pattern in patterns_of(record.body)]
+
+    def replay(self, target, speed=1.0, settle=0.5):
+        # speed: 1.0 is real time, 10.0 ten times faster, None as fast as possible.
+        # Returns the wall time spent sending.
+        published = self.published()
+        if not published:
+            return 0.0
+        first = published[0].time
+        start = time.perf_counter()
+        for record in published:
+            if speed:
+                delay = (record.time - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            target.send(record.queue, record.body, record.time)
+        elapsed = time.perf_counter() - start
+        target.finish(settle)
+        return elapsed
+
+    def compare(self, matches):
+        # Matches the recording has and the replay did not produce, and the other way around
+        expected = Counter(match_key(pattern) for pattern in self.recorded_matches())
+        got = Counter(match_key(pattern) for pattern in matches)
+        return expected - got, got - expected
+
+def report(replayer, target, elapsed, speed):
+    published = replayer.published()
+    span = published[-1].time - published[0].time if published else 0.0
+    events = sum(target.event_counts.values())
+    result = {
+        "messages": len(published),
+        "events": events,
+        "matches": len(target.matches),
+        "recorded_span_s": span,
+        "replay_s": elapsed,
+        "speed": speed,
+        "achieved_speed": span / elapsed if elapsed else None,
+        "events_per_s": events / elapsed if elapsed else None,
+        "latency_ms": dict(),
+    }
+    for event_type in sorted(target.event_counts):
+        values = target.latencies.get(event_type, [])
+        result["latency_ms"][event_type] = {
+            "events": target.event_counts[event_type],
+            "matches": len(values),
+            "p50": percentile(values, 0.5) * 1000 if values else None,
+            "p99": percentile(values, 0.99) * 1000 if values else None,
+            "max": max(values) * 1000 if values else None,
+        }
+    return result
+
+def print_report(result):
+    print(str(result["messages"]) + " messages, " + str(result["events"]) + " events, " + str(result["matches"]) + " matches")
+    print("Recorded over " + str(round(result["recorded_span_s"], 3)) + " s, replayed in " + str(round(result["replay_s"], 3)) + " s")
+    print("event type".ljust(20) + "events".rjust(8) + "matches".rjust(9) + "p50 ms".rjust(10) + "p99 ms".rjust(10) + "max ms".rjust(10))
+    for event_type, stats in result["latency_ms"].items():
+        cells = [("-" if stats[key] is None else str(round(stats[key], 3))).rjust(10) for key in ("p50", "p99", "max")]
+        print(event_type.ljust(20) + str(stats["events"]).rjust(8) + str(stats["matches"]).rjust(9) + "".join(cells))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded CEP traffic")
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed, 1 is real time")
+    parser.add_argument("--max", action="store_true", help="Replay as fast as possible")
+    parser.add_argument("--target", choices=("engine", "fake", "rabbitmq"), default="engine", help="In-process engine, fake broker with an in-process engine, or the RabbitMQ server")
+    parser.add_argument("--compare", action="store_true", help="Check the matches against the recorded ones")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    replayer = Replayer(args.recording)
+    if args.target == "engine":
+        target = Engine_target()
+    elif args.target == "fake":
+        target = Broker_target(Fake_broker(Cep_engine()).connection_factory, replayer.station_ids())
+    else:
+        from cep_manager import connection_factory
+        target = Broker_target(connection_factory, replayer.station_ids())
+
+    speed = None if args.max else args.speed
+    elapsed = replayer.replay(target, speed)
+    result = report(replayer, target, elapsed, speed)
+
+    if args.compare:
+        missing, extra = replayer.compare(target.matches)
+        result["missing"] = sum(missing.values())
+        result["extra"] = sum(extra.values())
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+        if args.compare:
+            print(str(result["missing"]) + " recorded matches missing, " + str(result["extra"]) + " unexpected matches")
+
+    if args.compare and (result["missing"] or result["extra"]):
+        raise SystemExit(1)
@@ -0,0 +1,77 @@
+import argparse
+
+import mule_format
+import stations
+import wire_format
+from cep_engine import Cep_engine
+from cep_manager import connection_factory, ConnectionError
+from broker_pool import Connection_pool, parse_endpoints
+
+# Runs the in-process engine as the remote CEP side, one process per partition: it consumes
+# Messages.<partition> (or plain 'Messages' without --partitions), and publishes each match to
+# triage.matches keyed to the station owning the patient (or to 'MuleOut'). It takes JSON and binary
+# events alike (see wire_format.py); --binary also publishes the matches in the binary format.
+#
+#   python cep_worker.py --partition 0 --partitions 4
+
+class Cep_worker:
+    def __init__(self, partition=None, partitions=None, connect=connection_factory, binary=False):
+        self.partitions = partitions
+        self.binary = binary
+        self.conn, self.channel = connect()
+        if partitions:
+            self.queue = stations.declare_partition_queue(self.channel, partition)
+        else:
+            self.queue = 'Messages'
+        self.engine = Cep_engine()
+        self.engine.set_output(self._publish_match)
+
+    def _publish_match(self, pattern):
+        if self.binary:
+            body = wire_format.shared().encode_matches([pattern])
+        else:
+            body = mule_format.encode({"stmt0_out0": pattern})
+        if self.partitions:
+            self.channel.basic_publish(exchange=stations.matches_exchange, routing_key=stations.match_key(pattern["patient"], self.partitions), body=body)
+        else:
+            self.channel.basic_publish(exchange='', routing_key='MuleOut', body=body)
+
+    def run(self):
+        for method_frame, properties, body in self.channel.consume(self.queue):
+            try:
+                events = wire_format.events_of(body)
+            except (ValueError, wire_format.WireError) as e:
+                print("Dropping message: " + str(e))
+                events = []
+            for event in events:
+                try:
+                    self.engine.send(event)
+                except Exception as e:
+                    print("Dropping event " + repr(event) + ": " + str(e))
+            # Acked once its matches are out, a crash redelivers the message
+            self.channel.basic_ack(method_frame.delivery_tag)
+
+    def close(self):
+        self.channel.close()
+        self.conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-process CEP engine as a RabbitMQ worker")
+    parser.add_argument("--partition", type=int, default=0)
+    parser.add_argument("--partitions", type=int, default=None, help="Number of partitions the stations publish to")
+    parser.add_argument("--binary", action="store_true", help="Publish the matches in the binary wire format")
+    parser.add_argument("--brokers", default=None, help="RabbitMQ endpoints to try in turn, host[:port],...")
+    args = parser.parse_args()
+
+    connect = Connection_pool(parse_endpoints(args.brokers)).connect if args.brokers else connection_factory
+    try:
+        worker = Cep_worker(args.partition, args.partitions, connect, binary=args.binary)
+    except ConnectionError:
+        print("Could not connect to RabbitMQ. Please start the server and try again.")
+        exit()
+    print("CEP worker consuming " + worker.queue)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    worker.close()
@@ -0,0 +1,316 @@
+import time
+from collections import deque, defaultdict
+from threading import Condition, Lock
+
+import pika
+
+import mule_format
+import wire_format
+from broker_pool import ConnectionError
+
+# In-process stand-in for the RabbitMQ server and the remote CEP engine. It implements the part of the
+# pika BlockingConnection/channel API that Cep_manager uses, so Cep_manager(connect=broker.connection_factory)
+# runs unchanged without a broker. With an engine, every body published to 'Messages' (single events or
+# envelopes) is fed to it and its matches are delivered on 'MuleOut' in the engine's map format.
+# add_engine() attaches more engines to other queues, e.g. one per partition (see stations.py), and
+# topic exchanges route with the usual '*' and '#' wildcards. Binary bodies (see wire_format.py) are
+# decoded like the JSON ones; with binary=True the matches go out in the binary format too.
+#
+# Failures are injected with disconnect(): the open connections (of one endpoint, or all) are dropped and
+# their next call raises what pika raises on a lost socket; with outage=True new connections are refused
+# until restore(). Connection_pool(endpoints, open_connection=broker.open_connection) connects through it.
+#
+# Deliveries stay unacked on their channel until basic_ack (multiple=True acks every tag up to the given
+# one); basic_qos(prefetch_count) holds back deliveries while that many are unacked, and the unacked ones
+# go back to the head of their queue, flagged redelivered, when the channel or its connection goes away.
+
+def topic_matches(pattern, key):
+    if not pattern:
+        return not key
+    if pattern[0] == "#":
+        return any(topic_matches(pattern[1:], key[i:]) for i in range(len(key) + 1))
+    if not key:
+        return False
+    return (pattern[0] == "*" or pattern[0] == key[0]) and topic_matches(pattern[1:], key[1:])
+
+class Method_frame:
+    def __init__(self, delivery_tag, redelivered=False):
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+
+class Declare_ok:
+    # What queue_declare returns: frame.method.queue and frame.method.message_count
+    def __init__(self, queue, message_count):
+        self.method = self
+        self.queue = queue
+        self.message_count = message_count
+
+class Fake_broker:
+    def __init__(self, engine=None, in_queue='Messages', out_queue='MuleOut', binary=False, ack_delay=0.0):
+        self.binary = binary
+        self.ack_delay = ack_delay # Seconds an ack blocks, standing in for the round trip to a real broker
+        self.queues = defaultdict(deque) # queue: deque of (body, redelivered)
+        self.condition = Condition()
+        self.engines = dict() # queue: engine
+        self.engine_lock = Lock()
+        self.bindings = defaultdict(list) # exchange: [(pattern words, queue)]
+        self.published = 0
+        self.acked = 0
+        self.generated = 0 # Server-named queues
+        self.connections = [] # Open Fake_connections
+        self.down = False
+        self.down_endpoints = set()
+        if engine:
+            self.add_engine(engine, in_queue, lambda pattern: ('', out_queue))
+
+    def add_engine(self, engine, queue, output):
+        # output(pattern) -> (exchange, routing key) for the engine's matches
+        def forward(pattern):
+            exchange, routing_key = output(pattern)
+            if self.binary:
+                body = wire_format.shared().encode_matches([pattern])
+            else:
+                body = mule_format.encode({"stmt0_out0": pattern})
+            self.publish(routing_key, body, exchange)
+        engine.set_output(forward)
+        self.engines[queue] = engine
+
+    def bind(self, queue, exchange, routing_key):
+        with self.condition:
+            self.bindings[exchange].append((routing_key.split("."), queue))
+
+    def open_connection(self, host=None, port=None):
+        with self.condition:
+            if self.down or (host, port) in self.down_endpoints:
+                raise pika.exceptions.AMQPConnectionError("Fake broker " + str(host) + ":" + str(port) + " is down")
+            connection = Fake_connection(self, (host, port))
+            self.connections.append(connection)
+        return connection
+
+    def connection_factory(self):
+        try:
+            connection = self.open_connection()
+        except pika.exceptions.AMQPConnectionError as e:
+            raise ConnectionError(str(e)) from e
+        return connection, connection.channel()
+
+    def disconnect(self, endpoint=None, outage=False):
+        with self.condition:
+            if outage:
+                if endpoint is None:
+                    self.down = True
+                else:
+                    self.down_endpoints.add(endpoint)
+            dropped = [c for c in self.connections if endpoint is None or c.endpoint == endpoint]
+            for connection in dropped:
+                connection.is_open = False
+                self.connections.remove(connection)
+            self.condition.notify_all()
+        for connection in dropped:
+            connection.requeue_unacked()
+
+    def restore(self, endpoint=None):
+        with self.condition:
+            if endpoint is None:
+                self.down = False
+                self.down_endpoints.clear()
+            else:
+                self.down_endpoints.discard(endpoint)
+
+    def requeue(self, queue, body, redelivered=False):
+        # A message taken off a queue by a connection that dropped before delivering it (or before its ack)
+        with self.condition:
+            self.queues[queue].appendleft((body, redelivered))
+            self.condition.notify_all()
+
+    def publish(self, routing_key, body, exchange=''):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if exchange:
+            with self.condition:
+                words = routing_key.split(".")
+                queues = list(dict.fromkeys(queue for pattern, queue in self.bindings[exchange] if topic_matches(pattern, words)))
+        else:
+            queues = [routing_key]
+        with self.condition:
+            self.published += 1
+        for queue in queues:
+            self._deliver(queue, body)
+
+    def _deliver(self, queue, body):
+        engine = self.engines.get(queue)
+        if engine:
+            events = wire_format.events_of(body)
+            with self.engine_lock:
+                for event in events:
+                    engine.send(event)
+            return
+        with self.condition:
+            self.queues[queue].append((body, False))
+            self.condition.notify_all()
+
+    def get(self, queue, timeout=None, stopped=lambda: False, blocked=lambda: False):
+        # Returns (body, redelivered), or None on timeout or stop
+        with self.condition:
+            self.condition.wait_for(lambda: (self.queues[queue] and not blocked()) or stopped(), timeout)
+            if self.queues[queue] and not blocked():
+                return self.queues[queue].popleft()
+            return None
+
+    def depth(self, queue):
+        with self.condition:
+            return len(self.queues[queue])
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+class Fake_connection:
+    def __init__(self, broker, endpoint=(None, None)):
+        self.broker = broker
+        self.endpoint = endpoint
+        self.is_open = True
+        self.channels = []
+
+    def check(self):
+        if not self.is_open:
+            raise pika.exceptions.StreamLostError("Fake connection to " + str(self.endpoint[0]) + " lost")
+
+    def channel(self):
+        self.check()
+        channel = Fake_channel(self.broker, self)
+        self.channels.append(channel)
+        return channel
+
+    def requeue_unacked(self):
+        for channel in self.channels:
+            channel.requeue_unacked()
+
+    def process_data_events(self, time_limit=0):
+        self.check()
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("Connection is closed")
+        callback()
+
+    def close(self):
+        self.is_open = False
+        with self.broker.condition:
+            if self in self.broker.connections:
+                self.broker.connections.remove(self)
+        self.requeue_unacked()
+
+class Fake_channel:
+    def __init__(self, broker, connection):
+        self.broker = broker
+        self.connection = connection
+        self.is_open = True
+        self.consuming = False
+        self.delivery_tag = 0
+        self.prefetch = 0
+        self.unacked = dict() # delivery tag: (queue, body), in delivery order
+        self.transaction = None # [(routing key, body, exchange)] after tx_select, published on tx_commit
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.connection.check()
+        if self.transaction is not None:
+            self.transaction.append((routing_key, body, exchange))
+        else:
+            self.broker.publish(routing_key, body, exchange)
+
+    def exchange_declare(self, exchange, exchange_type="direct", durable=False):
+        self.connection.check()
+
+    def queue_declare(self, queue='', durable=False, passive=False, exclusive=False, auto_delete=False):
+        # An empty name gets a generated one, as the server does; exclusive and auto_delete are not enforced
+        self.connection.check()
+        if not queue:
+            with self.broker.condition:
+                self.broker.generated += 1
+                queue = "amq.gen-" + str(self.broker.generated)
+        return Declare_ok(queue, self.broker.depth(queue))
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        self.connection.check()
+        self.broker.bind(queue, exchange, routing_key or queue)
+
+    def basic_qos(self, prefetch_count=0):
+        self.connection.check()
+        self.prefetch = prefetch_count
+
+    def _settle(self, delivery_tag, multiple):
+        # Takes the acked (or rejected) deliveries off the unacked ones
+        with self.broker.condition:
+            if multiple:
+                tags = [tag for tag in self.unacked if tag <= delivery_tag]
+            else:
+                tags = [delivery_tag] if delivery_tag in self.unacked else []
+            settled = [self.unacked.pop(tag) for tag in tags]
+            self.broker.condition.notify_all()
+        return settled
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.connection.check()
+        if self.broker.ack_delay:
+            time.sleep(self.broker.ack_delay)
+        settled = self._settle(delivery_tag, multiple)
+        with self.broker.condition:
+            self.broker.acked += len(settled)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.connection.check()
+        for queue, body in reversed(self._settle(delivery_tag, multiple)):
+            if requeue:
+                self.broker.requeue(queue, body, True)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.basic_nack(delivery_tag, False, requeue)
+
+    def requeue_unacked(self):
+        with self.broker.condition:
+            settled = list(self.unacked.values())
+            self.unacked.clear()
+        for queue, body in reversed(settled):
+            self.broker.requeue(queue, body, True)
+
+    def tx_select(self):
+        self.connection.check()
+        self.transaction = []
+
+    def tx_commit(self):
+        self.connection.check()
+        pending, self.transaction = self.transaction, []
+        for routing_key, body, exchange in pending:
+            self.broker.publish(routing_key, body, exchange)
+
+    def consume(self, queue, inactivity_timeout=None):
+        self.consuming = True
+        while self.consuming:
+            self.connection.check()
+            item = self.broker.get(queue, inactivity_timeout, lambda: not self.consuming or not self.connection.is_open,
+                                   lambda: self.prefetch and len(self.unacked) >= self.prefetch)
+            if item is not None and not self.connection.is_open:
+                self.broker.requeue(queue, *item)
+                item = None
+            if item is None:
+                if not self.consuming:
+                    break
+                self.connection.check()
+                yield None, None, None
+                continue
+            body, redelivered = item
+            with self.broker.condition:
+                self.delivery_tag += 1
+                self.unacked[self.delivery_tag] = (queue, body)
+            yield Method_frame(self.delivery_tag, redelivered), None, body
+
+    def stop_consuming(self):
+        self.consuming = False
+        self.broker.wake()
+
+    def close(self):
+        self.consuming = False
+        self.is_open = False
+        self.requeue_unacked()
+        self.broker.wake()
@@ -0,0 +1,43 @@
+class Fenwick:
+    # Binary indexed tree over positions 1..capacity holding counts: point update, prefix sum and
+    # k-th occupied position in O(log capacity).
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+        self.total = 0
+
+    def update(self, i, delta):
+        self.total += delta
+        tree = self.tree
+        capacity = self.capacity
+        while i <= capacity:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        total = 0
+        tree = self.tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k):
+        # Smallest position whose prefix sum reaches k (1-based k)
+        pos = 0
+        mask = 1 << self.capacity.bit_length()
+        tree = self.tree
+        capacity = self.capacity
+        while mask:
+            nxt = pos + mask
+            if nxt <= capacity and tree[nxt] < k:
+                pos = nxt
+                k -= tree[nxt]
+            mask >>= 1
+        return pos + 1
+
+def capacity_for(n):
+    capacity = 1
+    while capacity < n + 1:
+        capacity *= 2
+    return capacity
@@ -0,0 +1,277 @@
+import json
+import math
+import os
+import time
+from itertools import count
+from threading import Lock, Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Counters, gauges and latency histograms for the CEP pipeline, exported as Prometheus text (served by
+# Prometheus_exporter) or JSON (written periodically by Json_dumper). Metric names follow the Prometheus
+# conventions; labels are a tuple of (name, value) pairs.
+
+class Histogram:
+    # Log-scale buckets, 8 per power of two from 1 us up (about 9% wide): recording is a log and an
+    # increment, quantiles are read from the bucket counts.
+    per_octave = 8
+    smallest = 1e-6
+
+    def __init__(self):
+        self.buckets = dict() # bucket index: count
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = int(math.log2(seconds / self.smallest) * self.per_octave) if seconds > self.smallest else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def upper_bound(self, index):
+        return self.smallest * 2 ** ((index + 1) / self.per_octave)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+class Metrics:
+    quantiles = (0.5, 0.99, 0.999)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = dict() # (name, labels): value
+        self.gauges = dict() # (name, labels): function returning the current value
+        self.histograms = dict() # (name, labels): Histogram
+        self.help = dict()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, function, labels=()):
+        self.gauges[(name, labels)] = function
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(seconds)
+
+    def gauge_values(self):
+        values = dict()
+        for key, function in list(self.gauges.items()):
+            try:
+                values[key] = function()
+            except Exception:
+                values[key] = None
+        return values
+
+    def snapshot(self):
+        # Plain dict of everything, for the JSON dump
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.count, h.sum, h.max, [h.quantile(q) for q in self.quantiles]) for key, h in self.histograms.items()}
+        result = {"time": time.time(), "counters": [], "gauges": [], "histograms": []}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), value in sorted(self.gauge_values().items(), key=lambda item: item[0]):
+            result["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), (n, total, largest, quantiles) in sorted(histograms.items()):
+            entry = {"name": name, "labels": dict(labels), "count": n, "sum": total, "max": largest}
+            for q, value in zip(self.quantiles, quantiles):
+                entry["p" + str(q)[2:].ljust(2, "0")] = value
+            result["histograms"].append(entry)
+        return result
+
+    def prometheus_text(self):
+        # Histograms are exported as summaries with quantile labels
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append("# HELP " + name + " " + self.help[name])
+                lines.append("# TYPE " + name + " " + kind)
+
+        for entry in snapshot["counters"]:
+            header(entry["name"], "counter")
+            lines.append(entry["name"] + label_text(entry["labels"]) + " " + number_text(entry["value"]))
+        for entry in snapshot["gauges"]:
+            header(entry["name"], "gauge")
+            lines.append(entry["name"] + label_text(entry["labels"]) + " " + number_text(entry["value"]))
+        for entry in snapshot["histograms"]:
+            name = entry["name"]
+            header(name, "summary")
+            for q in self.quantiles:
+                value = entry["p" + str(q)[2:].ljust(2, "0")]
+                lines.append(name + label_text(dict(entry["labels"], quantile=str(q))) + " " + number_text(value))
+            lines.append(name + "_sum" + label_text(entry["labels"]) + " " + number_text(entry["sum"]))
+            lines.append(name + "_count" + label_text(entry["labels"]) + " " + number_text(entry["count"]))
+        return "\n".join(lines) + "\n"
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in labels.items()) + "}"
+
+def number_text(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Prometheus_exporter:
+    # Serves GET /metrics from a daemon thread
+    def __init__(self, metrics, port=9108, host="127.0.0.1"):
+        exporter_metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter_metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = Thread(target=self.server.serve_forever, name="metrics-exporter", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Json_dumper:
+    # Rewrites path every interval seconds with a snapshot plus the per-second rate of every counter
+    # since the previous dump
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.previous = None
+        self.running = True
+        self.thread = Thread(target=self._run, name="metrics-dumper", daemon=True)
+        self.thread.start()
+
+    def dump(self):
+        snapshot = self.metrics.snapshot()
+        if self.previous:
+            elapsed = snapshot["time"] - self.previous["time"]
+            before = {(c["name"], tuple(sorted(c["labels"].items()))): c["value"] for c in self.previous["counters"]}
+            for counter in snapshot["counters"]:
+                key = (counter["name"], tuple(sorted(counter["labels"].items())))
+                counter["per_second"] = (counter["value"] - before.get(key, 0)) / elapsed if elapsed > 0 else None
+        self.previous = snapshot
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            if self.running:
+                self.dump()
+
+    def close(self):
+        self.running = False
+        self.dump()
+
+def source_of(event):
+    # The source column of the EmergencyLevel and SymptomClassification rows an event leads to (see patterns/)
+    if event.event_type == "Symptom":
+        return event.name
+    if event.event_type == "Retraction":
+        return event.source
+    return event.event_type
+
+class Latency_tracker:
+    # End-to-end latency of the CEP round trip. Published events get a correlation id ("cid" in the JSON
+    # body) and, when sampled, are remembered with their send time under their patient and source. The CEP
+    # outputs are aggregates and cannot echo the id, but they carry the source of the row that changed them
+    # (the event type, or the symptom name), so a match is paired with the pending event of its patient and
+    # source: "cep_match_latency_seconds" is measured when the first match for it arrives, and
+    # "cep_display_latency_seconds" when the UI has applied it. Patient events never produce a match and
+    # are not timed. With sample_every=n only every n-th patient is timed, which keeps the bookkeeping off
+    # the hot path under load.
+    def __init__(self, metrics, sample_every=1):
+        self.metrics = metrics
+        self.sample_every = max(1, int(sample_every))
+        self.ids = count(1)
+        self.lock = Lock()
+        self.in_flight = dict() # patient: {source: (event type, send time)}
+        self.pending = 0 # Entries in in_flight
+        self.matched = dict() # patient: (event type, send time), waiting to be displayed
+        metrics.describe("cep_events_published_total", "Events published to the CEP engine")
+        metrics.describe("cep_matches_received_total", "Pattern matches received from the CEP engine")
+        metrics.describe("cep_match_latency_seconds", "Time from publishing an event to receiving the match it triggered")
+        metrics.describe("cep_display_latency_seconds", "Time from publishing an event to the UI showing the match it triggered")
+        metrics.gauge("cep_events_in_flight", lambda: self.pending)
+
+    def sent(self, event):
+        # event: a cep_events class
+        cid = next(self.ids)
+        event.cid = cid
+        event_type = event.event_type
+        self.metrics.inc("cep_events_published_total", (("type", event_type),))
+        if event_type != "Patient" and event.patient % self.sample_every == 0:
+            with self.lock:
+                sources = self.in_flight.setdefault(event.patient, dict())
+                self.pending += source_of(event) not in sources
+                sources[source_of(event)] = (event_type, time.perf_counter())
+        return cid
+
+    def received(self, pattern):
+        now = time.perf_counter()
+        self.metrics.inc("cep_matches_received_total", (("stream", str(pattern.get("stream"))),))
+        patient = int(pattern["patient"])
+        if patient % self.sample_every:
+            return
+        with self.lock:
+            sources = self.in_flight.get(patient)
+            sent = sources and sources.pop(pattern.get("source"), None)
+            if not sent:
+                return
+            self.pending -= 1
+            if not sources:
+                del self.in_flight[patient]
+            event_type, start = sent
+            self.matched[patient] = (event_type, start)
+        self.metrics.observe("cep_match_latency_seconds", now - start, (("type", event_type),))
+
+    def displayed(self, patients):
+        now = time.perf_counter()
+        with self.lock:
+            shown = [self.matched.pop(patient) for patient in patients if patient in self.matched]
+        for event_type, start in shown:
+            self.metrics.observe("cep_display_latency_seconds", now - start, (("type", event_type),))
+
+    def forget(self, patient):
+        with self.lock:
+            self.pending -= len(self.in_flight.pop(patient, ()))
+            self.matched.pop(patient, None)
@@ -0,0 +1,92 @@
+import re
+
+# Decoder for the map format the CEP engine writes to MuleOut, e.g.
+#   {stmt0_out0={stream=Level, patient=3, level=4}}
+# Keys and values are unquoted, so values run until the next ',' or '}' and keep their inner spaces
+# ("very hot", "self-harm high risk"). Numbers, booleans and null come back typed.
+# The whole message is scanned once by a single compiled tokenizer.
+
+token_re = re.compile(r"([{}=,])|([^{}=,]+)")
+
+literals = {"true": True, "false": False, "null": None}
+
+class DecodeError(Exception):
+    pass
+
+def scalar(text):
+    text = text.strip()
+    if not text:
+        return None
+    if text[0] in "-0123456789":
+        try:
+            return int(text)
+        except ValueError:
+            try:
+                return float(text)
+            except ValueError:
+                return text
+    return literals.get(text, text)
+
+def decode(text):
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode("utf-8")
+
+    root = None
+    current = None
+    stack = []
+    key = None
+    expecting_value = False
+
+    for punct, atom in token_re.findall(text):
+        if atom:
+            if expecting_value:
+                current[key] = scalar(atom)
+                expecting_value = False
+                key = None
+            elif not atom.isspace():
+                if current is None or key is not None:
+                    raise DecodeError("Unexpected " + repr(atom.strip()) + " in " + repr(text))
+                key = atom.strip()
+        elif punct == "=":
+            if key is None or expecting_value:
+                raise DecodeError("Unexpected '=' in " + repr(text))
+            expecting_value = True
+        elif punct == "{":
+            new = dict()
+            if current is None:
+                if root is not None:
+                    raise DecodeError("Trailing data in " + repr(text))
+                root = new
+            elif expecting_value:
+                current[key] = new
+                expecting_value = False
+                key = None
+            else:
+                raise DecodeError("Unexpected '{' in " + repr(text))
+            stack.append(current)
+            current = new
+        elif current is None:
+            raise DecodeError("Unexpected " + repr(punct) + " in " + repr(text))
+        else:
+            if expecting_value:
+                current[key] = None
+                expecting_value = False
+                key = None
+            elif key is not None:
+                raise DecodeError("Missing '=' after " + repr(key) + " in " + repr(text))
+            if punct == "}":
+                current = stack.pop()
+
+    if root is None or current is not None:
+        raise DecodeError("Incomplete message " + repr(text))
+    return root
+
+def encode(value):
+    # Inverse of decode, for the local engine, recordings and the fake broker
+    if isinstance(value, dict):
+        return "{" + ", ".join(str(key) + "=" + encode(item) for key, item in value.items()) + "}"
+    if value is None:
+        return "null"
+    if value is True or value is False:
+        return "true" if value else "false"
+    return str(value)
@@ -0,0 +1,447 @@
+import math
+from enum import Enum
+
+import numpy as np
+
+import symptom_registry
+
+# The patient table as columns instead of an object per patient: typed numpy arrays indexed by row for
+# the numbers (id, age, sex, coordinates, level, classification) and for both symptom sets (what the
+# edit panel holds and what was last published), the specific symptoms as a bitmap matrix over
+# symptom_registry.shared() ids, SSNs as a fixed width UTF-8 column. Only the class counts of patients
+# the engine classified are Python objects. A patient costs around a hundred bytes instead of the
+# better part of a KB of dataclasses, strings, lists and dicts, and questions over the whole table
+# ("all level 5", "who has chest pain") are array operations.
+#
+# The store is also the id: Patient_unit mapping Triage_core.patients used to be, iterated in id order.
+# Ids are allocated in sequence (from the station's range, see stations.py), so the row of an id comes
+# from an int32 table over the window of live ids rather than a dict; the table drops the expired ids
+# below the window when it grows, and the odd id far outside it goes to a dict. Patient_unit, Patient
+# and Symptoms_view are __slots__ views of one row for the code that wants objects; they are created on
+# access and are only valid while their patient stays in the store, as rows are reused.
+#
+# Missing values follow batch_triage.py: -1 for ages and option ids, NaN for the temperature and the
+# coordinates, so triage_columns() goes straight into Batch_triage.triage(). The text fields of the old
+# Patient (age, latitude, longitude as typed) read back as the numbers they parse to, "" when missing;
+# specific symptoms read back in registry order.
+
+class EmergencyType(Enum):
+    Generic = 0
+    Mental = 1
+    Palpitations = 2
+    Asthma = 3
+    Allergy = 4
+    DiarrVom = 5
+
+SYMPTOMS, PUBLISHED = 0, 1 # Sides of the symptom columns
+
+symptom_fields = ("life_threat", "consciousness", "haemorrhage", "pain_level")
+default_temperature = 36.1
+
+class Symptoms:
+    # Detached symptoms, not backed by a store
+    __slots__ = ("life_threat", "consciousness", "haemorrhage", "temperature", "pain_level", "specific")
+
+    def __init__(self, life_threat=None, consciousness=None, haemorrhage=None, temperature=default_temperature, pain_level=None, specific=None):
+        self.life_threat = life_threat
+        self.consciousness = consciousness
+        self.haemorrhage = haemorrhage
+        self.temperature = temperature
+        self.pain_level = pain_level
+        self.specific = list(specific) if specific is not None else []
+
+def parse_number(text, kind=float):
+    try:
+        return kind(text)
+    except (TypeError, ValueError):
+        return None
+
+def number_text(value):
+    return "" if math.isnan(value) else repr(float(value))
+
+class Patient_store:
+    def __init__(self, capacity=64):
+        self.registry = symptom_registry.shared()
+        self.count = 0
+        self.base = 0 # Id of row_of[0]
+        self.row_of = np.full(0, -1, dtype=np.int32) # id - base: row, -1 when absent
+        self.far = dict() # id: row, for ids too far from the others for row_of
+        self.free = [] # Rows of removed patients
+        self.high = 0 # Rows ever used
+        self.categories = [EmergencyType.Generic] # Category index: EmergencyType or class name
+        self.category_index = {EmergencyType.Generic: 0}
+        self.class_factors = dict() # row: {class: factors}, for the patients the engine classified
+        self.words = 1
+        self.capacity = 0
+        self.id = np.full(0, -1, dtype=np.int64) # -1 on free rows
+        self.ssn = np.zeros(0, dtype="S1") # UTF-8, widened for longer ones
+        self.age = np.full(0, -1, dtype=np.int16)
+        self.male = np.zeros(0, dtype=np.bool_)
+        self.latitude = np.full(0, np.nan)
+        self.longitude = np.full(0, np.nan)
+        self.level = np.zeros(0, dtype=np.int8)
+        self.factors = np.zeros(0, dtype=np.int16)
+        self.category = np.zeros(0, dtype=np.int16)
+        self.symptoms = {field: np.full((2, 0), -1, dtype=np.int8) for field in symptom_fields}
+        self.temperature = np.full((2, 0), np.nan)
+        self.specific = np.zeros((2, 0, 1), dtype=np.uint64)
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        def extend(array, fill, axis=0):
+            shape = list(array.shape)
+            shape[axis] = capacity - self.capacity
+            return np.concatenate((array, np.full(shape, fill, dtype=array.dtype)), axis=axis)
+        self.id = extend(self.id, -1)
+        self.ssn = extend(self.ssn, b"")
+        self.age = extend(self.age, -1)
+        self.male = extend(self.male, False)
+        self.latitude = extend(self.latitude, np.nan)
+        self.longitude = extend(self.longitude, np.nan)
+        self.level = extend(self.level, 0)
+        self.factors = extend(self.factors, 0)
+        self.category = extend(self.category, 0)
+        self.symptoms = {field: extend(column, -1, axis=1) for field, column in self.symptoms.items()}
+        self.temperature = extend(self.temperature, np.nan, axis=1)
+        self.specific = extend(self.specific, 0, axis=1)
+        self.capacity = capacity
+
+    def grow_words(self, words):
+        self.specific = np.concatenate((self.specific, np.zeros((2, self.capacity, words - self.words), dtype=np.uint64)), axis=2)
+        self.words = words
+
+    # Mapping of id: Patient_unit
+
+    def row(self, id):
+        # Row of the patient, -1 when not in the store
+        try:
+            i = id - self.base
+        except TypeError:
+            return -1
+        if 0 <= i < len(self.row_of):
+            return int(self.row_of[i])
+        return self.far.get(id, -1)
+
+    def place(self, id, row):
+        i = id - self.base
+        if not 0 <= i < len(self.row_of):
+            live = np.flatnonzero(self.row_of >= 0)
+            low = min(id, self.base + int(live[0])) if len(live) else id
+            high = max(id, self.base + int(live[-1])) + 1 if len(live) else id + 1
+            if high - low > 4 * (self.count + 1024):
+                self.far[id] = row
+                return
+            table = np.full(max(64, 2 * (high - low)), -1, dtype=np.int32)
+            table[live + (self.base - low)] = self.row_of[live]
+            self.row_of = table
+            self.base = low
+            i = id - low
+        self.row_of[i] = row
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        return self.row(id) >= 0
+
+    def ids(self):
+        # Ids in the store, in id order
+        ids = (np.flatnonzero(self.row_of >= 0) + self.base).tolist()
+        if self.far:
+            ids = sorted(ids + list(self.far))
+        return ids
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def keys(self):
+        return self.ids()
+
+    def __getitem__(self, id):
+        row = self.row(id)
+        if row < 0:
+            raise KeyError(id)
+        return Patient_unit(self, row)
+
+    def get(self, id, default=None):
+        row = self.row(id)
+        return Patient_unit(self, row) if row >= 0 else default
+
+    def values(self):
+        return (Patient_unit(self, self.row(id)) for id in self.ids())
+
+    def items(self):
+        return ((id, Patient_unit(self, self.row(id))) for id in self.ids())
+
+    def add(self, id, ssn, age, is_male, longitude=None, latitude=None):
+        # Returns the Patient_unit of the new patient, with default symptoms and nothing published
+        self.remove(id)
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.high == self.capacity:
+                self.grow(2 * self.capacity)
+            row = self.high
+            self.high += 1
+        self.place(id, row)
+        self.count += 1
+        self.id[row] = id
+        self.set_ssn(row, ssn)
+        age = parse_number(age, int)
+        self.age[row] = age if age is not None and 0 <= age < 32768 else -1
+        self.male[row] = bool(is_male)
+        latitude, longitude = parse_number(latitude), parse_number(longitude)
+        self.latitude[row] = latitude if latitude is not None else np.nan
+        self.longitude[row] = longitude if longitude is not None else np.nan
+        self.level[row] = 0
+        self.factors[row] = 0
+        self.category[row] = 0
+        for column in self.symptoms.values():
+            column[:, row] = -1
+        self.temperature[:, row] = default_temperature
+        self.specific[:, row] = 0
+        return Patient_unit(self, row)
+
+    def remove(self, id):
+        row = self.row(id)
+        if row < 0:
+            return False
+        if id in self.far:
+            del self.far[id]
+        else:
+            self.row_of[id - self.base] = -1
+        self.count -= 1
+        self.id[row] = -1
+        self.ssn[row] = b""
+        self.class_factors.pop(row, None)
+        self.free.append(row)
+        return True
+
+    def set_ssn(self, row, ssn):
+        data = ("" if ssn is None else str(ssn)).encode("utf-8")
+        if len(data) > self.ssn.dtype.itemsize:
+            self.ssn = self.ssn.astype("S" + str(len(data)))
+        self.ssn[row] = data
+
+    def category_of(self, value):
+        index = self.category_index.get(value)
+        if index is None:
+            index = self.category_index[value] = len(self.categories)
+            self.categories.append(value)
+        return index
+
+    def mask(self, side, row):
+        words = self.specific[side, row]
+        if self.words == 1:
+            return int(words[0])
+        mask = 0
+        for i, word in enumerate(words):
+            mask |= int(word) << (64 * i)
+        return mask
+
+    def set_mask(self, side, row, mask):
+        words = -(-mask.bit_length() // 64)
+        if words > self.words:
+            self.grow_words(words)
+        for i in range(self.words):
+            self.specific[side, row, i] = (mask >> (64 * i)) & 0xFFFFFFFFFFFFFFFF
+
+    # Whole table scans
+
+    def live(self):
+        # Boolean column of the rows in use
+        return self.id[:self.high] >= 0
+
+    def select(self, level=None, min_level=None, symptom=None, side=PUBLISHED):
+        # Ids of the patients at `level`, at `min_level` or above and/or with `symptom`, in id order
+        keep = self.live()
+        if level is not None:
+            keep &= self.level[:self.high] == level
+        if min_level is not None:
+            keep &= self.level[:self.high] >= min_level
+        if symptom is not None:
+            if symptom not in self.registry:
+                return np.zeros(0, dtype=np.int64)
+            i = self.registry.get(symptom).id
+            if i // 64 >= self.words:
+                return np.zeros(0, dtype=np.int64)
+            keep &= (self.specific[side, :self.high, i // 64] & np.uint64(1 << (i % 64))) != 0
+        return np.sort(self.id[:self.high][keep])
+
+    def level_counts(self):
+        # Number of patients at each level 0-5
+        return np.bincount(self.level[:self.high][self.live()], minlength=6)
+
+    def triage_columns(self, side=SYMPTOMS):
+        # Keyword arguments of Batch_triage.triage() for every patient, the specific bitsets over the
+        # registry ids (the default Batch_triage vocabulary)
+        keep = self.live()
+        age = self.age[:self.high][keep].astype(np.int64)
+        columns = {field: column[side, :self.high][keep] for field, column in self.symptoms.items()}
+        columns.update({
+            "patient": self.id[:self.high][keep],
+            "temperature": self.temperature[side, :self.high][keep],
+            "specific": self.specific[side, :self.high][keep],
+            "age_months": np.where(age < 0, -1, age * 12),
+        })
+        return columns
+
+class Patient:
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def id(self):
+        return int(self.store.id[self.row])
+
+    @property
+    def ssn(self):
+        return self.store.ssn[self.row].decode("utf-8")
+
+    @property
+    def age(self):
+        age = self.store.age[self.row]
+        return str(age) if age >= 0 else ""
+
+    @property
+    def is_male(self):
+        return bool(self.store.male[self.row])
+
+    @property
+    def latitude(self):
+        return number_text(self.store.latitude[self.row])
+
+    @property
+    def longitude(self):
+        return number_text(self.store.longitude[self.row])
+
+    @property
+    def emergency_level(self):
+        return int(self.store.level[self.row])
+
+    @emergency_level.setter
+    def emergency_level(self, level):
+        self.store.level[self.row] = level
+
+    @property
+    def category_factors(self):
+        return int(self.store.factors[self.row])
+
+    @category_factors.setter
+    def category_factors(self, factors):
+        self.store.factors[self.row] = factors
+
+    @property
+    def emergency_category(self):
+        return self.store.categories[self.store.category[self.row]]
+
+    @emergency_category.setter
+    def emergency_category(self, category):
+        self.store.category[self.row] = self.store.category_of(category)
+
+    def get_sex(self):
+        return "Male" if self.is_male else "Female"
+
+class Symptoms_view:
+    __slots__ = ("store", "row", "side")
+
+    def __init__(self, store, row, side):
+        self.store = store
+        self.row = row
+        self.side = side
+
+    def _get(self, field):
+        value = self.store.symptoms[field][self.side, self.row]
+        return int(value) if value >= 0 else None
+
+    def _set(self, field, value):
+        self.store.symptoms[field][self.side, self.row] = -1 if value is None else value
+
+    life_threat = property(lambda self: self._get("life_threat"), lambda self, value: self._set("life_threat", value))
+    consciousness = property(lambda self: self._get("consciousness"), lambda self, value: self._set("consciousness", value))
+    haemorrhage = property(lambda self: self._get("haemorrhage"), lambda self, value: self._set("haemorrhage", value))
+    pain_level = property(lambda self: self._get("pain_level"), lambda self, value: self._set("pain_level", value))
+
+    @property
+    def temperature(self):
+        value = self.store.temperature[self.side, self.row]
+        return None if math.isnan(value) else float(value)
+
+    @temperature.setter
+    def temperature(self, value):
+        self.store.temperature[self.side, self.row] = np.nan if value is None else value
+
+    @property
+    def mask(self):
+        return self.store.mask(self.side, self.row)
+
+    @mask.setter
+    def mask(self, mask):
+        self.store.set_mask(self.side, self.row, mask)
+
+    @property
+    def specific(self):
+        return self.store.registry.names_of(self.mask)
+
+    @specific.setter
+    def specific(self, names):
+        self.mask = self.store.registry.mask(names)
+
+    def assign(self, symptoms):
+        # Copies any object with the Symptoms fields in
+        for field in symptom_fields:
+            self._set(field, getattr(symptoms, field))
+        self.temperature = symptoms.temperature
+        self.specific = symptoms.specific
+
+class Patient_unit:
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def patient(self):
+        return Patient(self.store, self.row)
+
+    @property
+    def symptoms(self):
+        return Symptoms_view(self.store, self.row, SYMPTOMS)
+
+    @symptoms.setter
+    def symptoms(self, symptoms):
+        self.symptoms.assign(symptoms)
+
+    @property
+    def published(self):
+        return Symptoms_view(self.store, self.row, PUBLISHED)
+
+    @published.setter
+    def published(self, symptoms):
+        self.published.assign(symptoms)
+
+    @property
+    def published_mask(self):
+        # published.specific over symptom_registry.shared()
+        return self.store.mask(PUBLISHED, self.row)
+
+    @published_mask.setter
+    def published_mask(self, mask):
+        self.store.set_mask(PUBLISHED, self.row, mask)
+
+    @property
+    def class_factors(self):
+        # class: factors, as last reported by the engine. A patient without any gets a new empty dict that is
+        # not stored, reading does not allocate an entry per patient: assign it back to keep changes
+        return self.store.class_factors.get(self.row) or dict()
+
+    @class_factors.setter
+    def class_factors(self, factors):
+        if factors:
+            self.store.class_factors[self.row] = factors
+        else:
+            self.store.class_factors.pop(self.row, None)
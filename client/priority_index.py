@@ -0,0 +1,103 @@
+from fenwick import Fenwick, capacity_for
+
+# Patients ordered by urgency: emergency level descending, then arrival order.
+# Every patient keeps a fixed arrival slot and each level owns a Fenwick tree marking the slots of its
+# patients. There are only a handful of levels, so raising a level, finding a patient's rank, the k-th
+# most urgent patient and popping the next one are all O(log n).
+
+class Priority_index:
+    def __init__(self):
+        self.level_of = dict() # id: level
+        self.rebuild([])
+
+    def rebuild(self, ids):
+        self.ids = list(ids) # arrival slot: id, None once removed
+        self.slot_of = {id: slot for slot, id in enumerate(self.ids)}
+        self.capacity = capacity_for(len(self.ids))
+        self.trees = dict() # level: Fenwick
+        for slot, id in enumerate(self.ids):
+            self.tree(self.level_of[id]).update(slot + 1, 1)
+        self.levels = sorted(self.trees, reverse=True)
+
+    def tree(self, level):
+        tree = self.trees.get(level)
+        if tree is None:
+            tree = self.trees[level] = Fenwick(self.capacity)
+            self.levels = sorted(self.trees, reverse=True)
+        return tree
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, id):
+        return id in self.slot_of
+
+    def __iter__(self):
+        for level in self.levels:
+            tree = self.trees[level]
+            for k in range(tree.total):
+                yield self.ids[tree.find(k + 1) - 1]
+
+    def level(self, id):
+        return self.level_of[id]
+
+    def add(self, id, level=0):
+        if id in self.slot_of:
+            self.update(id, level)
+            return
+        self.level_of[id] = level
+        if len(self.ids) >= self.capacity:
+            self.rebuild([i for i in self.ids if i is not None] + [id])
+            return
+        self.slot_of[id] = len(self.ids)
+        self.ids.append(id)
+        self.tree(level).update(len(self.ids), 1)
+
+    def update(self, id, level):
+        old = self.level_of[id]
+        if old == level:
+            return
+        slot = self.slot_of[id] + 1
+        self.trees[old].update(slot, -1)
+        self.tree(level).update(slot, 1)
+        self.level_of[id] = level
+
+    def remove(self, id):
+        slot = self.slot_of.pop(id, None)
+        if slot is None:
+            return
+        self.trees[self.level_of.pop(id)].update(slot + 1, -1)
+        self.ids[slot] = None
+        if len(self.ids) > 64 and len(self.slot_of) < len(self.ids) // 4:
+            self.rebuild([i for i in self.ids if i is not None])
+
+    def index(self, id):
+        level = self.level_of[id]
+        rank = 0
+        for l in self.levels:
+            if l == level:
+                break
+            rank += self.trees[l].total
+        return rank + self.trees[level].prefix(self.slot_of[id] + 1) - 1
+
+    def at(self, k):
+        # Id of the k-th most urgent patient (0-based)
+        if not 0 <= k < len(self.slot_of):
+            raise IndexError(k)
+        for level in self.levels:
+            tree = self.trees[level]
+            if k < tree.total:
+                return self.ids[tree.find(k + 1) - 1]
+            k -= tree.total
+
+    def peek(self):
+        return self.at(0) if self.slot_of else None
+
+    def pop(self):
+        id = self.peek()
+        if id is not None:
+            self.remove(id)
+        return id
+
+    def top(self, k):
+        return [self.at(i) for i in range(min(k, len(self.slot_of)))]
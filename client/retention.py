@@ -0,0 +1,181 @@
+import heapq
+import os
+import struct
+import time
+
+from triage_log import frame, records, encode_patient, decode_patient, encode_symptoms, decode_symptoms, encode_state, decode_state, file_header, PATIENT, SYMPTOMS, STATE, LogError
+
+# Keeps a long running station's patient table bounded. Every patient has an expiry deadline: its last
+# activity (creation, symptom submit) plus the idle window, which defaults to the 8 hours the CEP windows
+# remember a patient for, or, once discharged, the discharge time plus a grace period. The deadlines sit
+# in a heap with lazy deletion (a newer deadline just shadows the old entry, the heap is rebuilt when
+# stale entries outnumber live ones), so expired() only looks at what is due instead of scanning every
+# patient. Over max_patients, the earliest deadlines go first: discharged patients, then the least
+# recently active.
+#
+# Expired patients are appended to an archive file as the triage log records of a snapshot (patient,
+# symptoms, final state) behind an EXPIRED record with the time and reason, about a hundred bytes per
+# patient. read_archive() reads them back.
+
+IDLE, DISCHARGED, OVERFLOW = 1, 2, 3
+reasons = {IDLE: "idle", DISCHARGED: "discharged", OVERFLOW: "overflow"}
+
+EXPIRED = 16
+archive_magic = b"TRARC1\0\0"
+expired_struct = struct.Struct("<qdB") # id, time, reason
+
+# Idle window without idle_seconds: the deadline never comes, but unlike infinity it still orders the
+# patients by their last activity for the max_patients overflow
+forever = 1e12
+
+class Retention_policy:
+    def __init__(self, idle_seconds=8 * 3600, max_patients=None, discharge_grace=0.0):
+        self.idle_seconds = idle_seconds # None: never expire for inactivity
+        self.max_patients = max_patients # None: no limit
+        self.discharge_grace = discharge_grace
+
+class Retention:
+    def __init__(self, policy=None, clock=time.time):
+        self.policy = policy or Retention_policy()
+        self.clock = clock
+        self.heap = [] # (deadline, id, reason), including shadowed entries
+        self.deadlines = dict() # id: (deadline, reason) of the live entry
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, id):
+        return id in self.deadlines
+
+    def _push(self, id, deadline, reason):
+        self.deadlines[id] = (deadline, reason)
+        heapq.heappush(self.heap, (deadline, id, reason))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, id, reason) for id, (deadline, reason) in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def touch(self, id, now=None):
+        # Activity: pushes the idle deadline back, unless the patient is already discharged
+        current = self.deadlines.get(id)
+        if current is not None and current[1] == DISCHARGED:
+            return
+        now = self.clock() if now is None else now
+        idle = self.policy.idle_seconds
+        self._push(id, now + (idle if idle is not None else forever), IDLE)
+
+    def discharge(self, id, now=None):
+        # Returns the expiry deadline, which the triage log keeps so a restart does not reactivate the patient
+        now = self.clock() if now is None else now
+        deadline = now + self.policy.discharge_grace
+        self._push(id, deadline, DISCHARGED)
+        return deadline
+
+    def restore_discharge(self, id, deadline):
+        self._push(id, deadline, DISCHARGED)
+
+    def discharged(self):
+        # [(id, deadline)] of the discharged patients not expired yet
+        return [(id, deadline) for id, (deadline, reason) in self.deadlines.items() if reason == DISCHARGED]
+
+    def forget(self, id):
+        self.deadlines.pop(id, None)
+
+    def _pop(self):
+        # The live entry with the earliest deadline, removed; None when empty
+        while self.heap:
+            deadline, id, reason = heapq.heappop(self.heap)
+            if self.deadlines.get(id) == (deadline, reason):
+                del self.deadlines[id]
+                return deadline, id, reason
+        return None
+
+    def next_deadline(self):
+        while self.heap:
+            deadline, id, reason = self.heap[0]
+            if self.deadlines.get(id) == (deadline, reason):
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def expired(self, now=None):
+        # [(id, reason)] of the patients due now, and of the earliest ones past max_patients
+        now = self.clock() if now is None else now
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                break
+            _, id, reason = self._pop()
+            due.append((id, reason))
+        limit = self.policy.max_patients
+        while limit is not None and len(self.deadlines) > limit:
+            entry = self._pop()
+            if entry is None:
+                break
+            _, id, reason = entry
+            due.append((id, reason if reason == DISCHARGED else OVERFLOW))
+        return due
+
+class Patient_archive:
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.archived = 0
+        new = not os.path.exists(path) or os.path.getsize(path) < file_header.size
+        if not new:
+            with open(path, "r+b") as f:
+                buffer = f.read()
+                if file_header.unpack_from(buffer, 0)[0] != archive_magic:
+                    raise LogError(path + " is not a patient archive")
+                # A torn last entry is cut off, or everything appended after it would be unreadable
+                end = file_header.size
+                for _, _, end in records(buffer, file_header.size):
+                    pass
+                if end < len(buffer):
+                    f.truncate(end)
+        self.file = open(path, "wb" if new else "ab")
+        if new:
+            self.file.write(file_header.pack(archive_magic, 0))
+
+    def archive(self, unit, reason, now):
+        # unit: a Patient_unit
+        self.file.write(frame(EXPIRED, expired_struct.pack(unit.patient.id, now, reason)) +
+                        frame(PATIENT, encode_patient(unit.patient)) +
+                        frame(SYMPTOMS, encode_symptoms(unit.patient.id, unit.symptoms, unit.published)) +
+                        frame(STATE, encode_state(unit.patient)))
+        self.archived += 1
+
+    def flush(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+def read_archive(path):
+    # Yields a dict per archived patient, oldest first
+    with open(path, "rb") as f:
+        buffer = f.read()
+    if len(buffer) < file_header.size or file_header.unpack_from(buffer, 0)[0] != archive_magic:
+        raise LogError(path + " is not a patient archive")
+    entry = None
+    for kind, start, end in records(buffer, file_header.size):
+        if kind == EXPIRED:
+            if entry:
+                yield entry
+            id, when, reason = expired_struct.unpack_from(buffer, start)
+            entry = {"id": id, "time": when, "reason": reasons.get(reason, reason)}
+        elif entry is None:
+            continue
+        elif kind == PATIENT:
+            entry["patient"] = decode_patient(buffer, start)
+        elif kind == SYMPTOMS:
+            _, entry["symptoms"], entry["published"] = decode_symptoms(buffer, start)
+        elif kind == STATE:
+            _, entry["level"], entry["factors"], entry["category"] = decode_state(buffer, start)
+    if entry:
+        yield entry
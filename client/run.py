@@ -1,11 +1,25 @@
+import time
+started = time.time() # Before the imports, see Startup_report
+
+import argparse
+import json
+import os
 import tkinter as tk
 import tkinter.ttk as ttk
 import customtkinter as ctk
-from enum import Enum
-from dataclasses import dataclass, field
 
 from tk_scrolled_listbox import ScrolledListbox
-from cep_manager import Cep_manager, ConnectionError
+from virtual_list import Virtual_list
+from triage_core import Triage_core
+from triage_log import Triage_log
+import triage_options
+import symptom_registry
+from cep_recorder import Recorder
+from metrics import Metrics, Prometheus_exporter, Json_dumper
+from cep_manager import Cep_manager, connection_factory
+from broker_pool import Connection_pool, parse_endpoints
+from stations import Station_routing
+from retention import Retention, Retention_policy, Patient_archive
 
 ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue")
@@ -24,150 +38,69 @@ container_background_color = "#f0f0f0"
 button_color = "#3b8ed0"
 button_highlight_color = "#225177"
 
-class EmergencyType(Enum):
-    Generic = 0
-    Mental = 1
-    Palpitations = 2
-    Asthma = 3
-    Allergy = 4
-    DiarrVom = 5
-
-@dataclass
-class Patient:
-    id: int
-    ssn: str
-    age: int
-    is_male: bool
-    longitude: float = None
-    latitude: float = None
-    emergency_level: int = 0
-    emergency_category: EmergencyType = EmergencyType.Generic
-
-    emergency_category_var: tk.StringVar = None
-    emergency_level_var: tk.StringVar = None
-
-    category_factors: int = 0
-
-    def get_sex(self):
-        return "Male" if self.is_male else "Female"
-
-@dataclass
-class Symptoms:
-    life_threat: int = None
-    consciousness: int = None
-    haemorrhage: int = None
-    temperature: float = 36.1
-    pain_level: int = None
-    specific: list = field(default_factory=list)
-
-@dataclass
-class Patient_unit:
-    patient: Patient
-    symptoms: Symptoms
-    published: Symptoms
-    row: list
+class Startup_report:
+    # Seconds from the start of the process to each startup stage; with a path they are written as JSON
+    # once the window is painted and the broker connected, for bench_startup.py
+    def __init__(self, path=None, started=started):
+        self.path = path
+        self.started = started
+        self.stages = dict()
+
+    def mark(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = time.time() - self.started
+
+    def complete(self):
+        return "first_paint" in self.stages and "connected" in self.stages
+
+    def write(self):
+        with open(self.path, "w") as f:
+            json.dump({"started": self.started, "stages": self.stages}, f, indent=2)
 
 class Triage(ctk.CTk):
-    def __init__(self, cep_manager):
-
-        self.cep_manager = cep_manager
-        self.cep_manager.start_consuming(self.cep_pattern_cb)
-
-        # These symptoms are only for mental, palpitations, asthma, allergy and diarrhea and vomit emergencies. The complete list of symptoms is in the Manchester Triage handbook.
-        self.specific_symptoms = {
-            "High risk of self-harm": "self-harm high risk",
-            "High risk of harming others": "other-harm high risk",
-            "Violence": "violence",
-            "Moderate risk of self-harm": "self-harm moderate risk",
-            "Moderate risk of harming others": "other-harm moderate risk",
-            "Significant distress": "significant distress",
-            "Significant psychiatric history": "significant psychiatric history",
-            "Agressive demeanor": "agressive demeanor",
-            "Crying easily": "crying easily",
-            "Recent risk of self-harm": "recent self-harm risk",
-            "Recent risk of harming others": "recent other-harm risk",
-            "Moderate distress": "moderate distress",
-            "Disruptive demeanor": "disruptive demeanor",
-            "Crying": "crying",
-            "Abnormal pulse": "abnormal pulse",
-            "Intoxication history": "intoxication history",
-            "Chest pain": "chest pain",
-            "Palpitations": "palpitations",
-            "Significant cardiac history": "significant cardiac history",
-            "Relative cardiac history": "relative cardiac history",
-            "Difficulty speaking": "difficulty speaking",
-            "Abnormal pulse": "abnormal pulse",
-            "Significant respiratory history": "significant respiratory history",
-            "Chest pain": "chest pain",
-            "Sunken ribs": "sunken ribs",
-            "Ineffective medication": "ineffective medication",
-            "Nostril flare": "nostril flare",
-            "Dry cough": "dry cough",
-            "Wet cough": "wet cough",
-            "Difficulty speaking": "difficulty speaking",
-            "Swollen face": "swollen face",
-            "Abnormal pulse": "abnormal pulse",
-            "Skin rash": "skin rash",
-            "Swollen hands": "swollen hands",
-            "Localized swelling": "localized swelling",
-            "Recent swelling": "recent swelling",
-            "Severe thirst": "severe thirst",
-            "Slenderness": "slenderness",
-            "Blood vomit": "blood vomit",
-            "Rectal bleeding leakage": "rectal bleeding leakage",
-            "Blood vomit history": "blood vomit history",
-            "Red or black deposition": "red or black deposition",
-            "Dehydration signs": "dehydration signs",
-            "Frequent deposition": "frequent deposition",
-            "Vomiting": "vomiting",
-            "Anorexia": "anorexia",
-            "Nausea": "nausea",
-            "Thrist": "thrist",
-            "Abdominal pain": "abdominal pain"
-        }
-        self.inverse_specific_symptoms_options = {v: k for k, v in self.specific_symptoms.items()}
-
-        self.life_threat_options = {
-            "-": None,
-            "Shock": 2,
-            "Compromised": 0,
-            "Inadequate": 1,
-            "Difficult": 3
-        }
-        self.inverse_life_threat_options = {v: k for k, v in self.life_threat_options.items()}
+    refresh_ms = 16 # Matches are applied to the widgets at most once per frame
+    status_ms = 500
+    expire_ms = 1000
+    startup_timeout_ms = 60000
 
-        self.consciousness_options = {
-            "-": None,
-            "Fitting": 0,
-            "Unresponsive": 1,
-            "Alt. Responsive": 2,
-            "History": 3
-        }
-        self.inverse_consciousness_options = {v: k for k, v in self.consciousness_options.items()}
+    # Startup is staged so the window shows at once: the broker connects in the background (the status bar
+    # tells how it goes, events wait in the retry buffer meanwhile) and the edit panel is built when a
+    # patient is first selected.
+    def __init__(self, core, startup=None):
 
-        self.haemorrhage_options = {
-            "-": None,
-            "Extreme": 0,
-            "Major": 1,
-            "Minor": 2
-        }
-        self.inverse_haemorrhage_options = {v: k for k, v in self.haemorrhage_options.items()}
+        self.core = core
+        self.cep_manager = core.cep_manager
 
-        self.pain_level_options = {
-            "-": None,
-            "Severe": 0,
-            "Moderate": 1,
-            "Mild Pain": 2,
-            "Mild Itch": 3
-        }
+        self.symptom_registry = symptom_registry.shared() # Specific symptoms: names, labels, levels and classes
+        self.life_threat_options = triage_options.life_threat_options
+        self.inverse_life_threat_options = {v: k for k, v in self.life_threat_options.items()}
+        self.consciousness_options = triage_options.consciousness_options
+        self.inverse_consciousness_options = {v: k for k, v in self.consciousness_options.items()}
+        self.haemorrhage_options = triage_options.haemorrhage_options
+        self.inverse_haemorrhage_options = {v: k for k, v in self.haemorrhage_options.items()}
+        self.pain_level_options = triage_options.pain_level_options
         self.inverse_pain_level_options = {v: k for k, v in self.pain_level_options.items()}
 
-        self.patients = dict() # patient_id: Patient_unit
-        self.next_patient_id = 0
+        # Owned by the core, shared here for the list and the edit panel
+        self.patients = core.patients # patient_id: Patient_unit
+        self.id_order = core.id_order
+        self.priority = core.priority # Most urgent first
         self.selected_patient_id = None
+        self.edit_panel_built = False
+        self.startup = startup or Startup_report()
 
         self.create_tk()
-        self.clear_edit()
+        self.startup.mark("window")
+        self.bind("<Map>", self.on_first_map, add="+")
+
+        if self.cep_manager.batch_interval:
+            self.flush_cep_batches()
+        self.drain_pattern_queue()
+        self.poll_broker()
+        if self.core.retention is not None:
+            self.expire_patients()
+        if self.startup.path:
+            self.after(self.startup_timeout_ms, self.finish_startup_report)
 
     def create_tk(self):
         super().__init__()
@@ -183,6 +116,7 @@ class Triage(ctk.CTk):
         self.grid_rowconfigure(0, weight=0) # Add Patient Frame
         self.grid_rowconfigure(1, weight=1) # Patients Frame
         self.grid_rowconfigure(2, weight=0) # Edit Patient Frame
+        self.grid_rowconfigure(3, weight=0) # Status bar
 
         # Add Patient Frame
         self.tk_add_patient_frame = ctk.CTkFrame(self, corner_radius=0, fg_color=vvlight_widget_color)
@@ -222,6 +156,11 @@ class Triage(ctk.CTk):
         self.tk_edit_patient_frame.grid_rowconfigure(5, weight=0)
         self.tk_edit_patient_frame.grid_rowconfigure(6, weight=1)
 
+        # Status bar
+        self.tk_status_var = tk.StringVar(value="")
+        self.tk_status_label = ctk.CTkLabel(self, textvariable=self.tk_status_var, height=18, anchor="w", fg_color=vlight_widget_color, text_color=subheader_font_color)
+        self.tk_status_label.grid(row=3, column=0, sticky="nsew")
+
     def create_widgets(self):
         # Add Patient Frame
         self.tk_add_patient_label = ctk.CTkLabel(self.tk_add_patient_frame, text="Add Patient", bg_color=header_label_color, text_color=header_font_color)
@@ -259,48 +198,34 @@ class Triage(ctk.CTk):
         # Patients Frame
 
         self.tk_patients_label = ctk.CTkLabel(self.tk_patients_frame, text="Patients", bg_color=header_label_color, text_color=header_font_color)
-        self.tk_patients_label.grid(row=0, column=0, sticky="nsew", columnspan=2)
-
-        self.tk_patients_canvas = tk.Canvas(self.tk_patients_frame, bg=vvlight_widget_color)
-        self.tk_patients_canvas.grid(row=1, column=0, sticky="nsew")
-
-        self.tk_patients_scrollbar = ctk.CTkScrollbar(self.tk_patients_frame, orientation="vertical", command=self.tk_patients_canvas.yview)
-        self.tk_patients_scrollbar.grid(row=1, column=1, sticky="ns")
-        self.tk_patients_canvas.configure(yscrollcommand=self.tk_patients_scrollbar.set)
-
-        self.tk_patients_list_frame = ctk.CTkFrame(self.tk_patients_canvas, fg_color=light_widget_color)
-        self.tk_patients_list_frame.grid(row=0, column=0, sticky="nsew")
-        self.tk_patients_list_frame.grid_columnconfigure(0, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(1, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(2, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(3, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(4, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(5, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(6, weight=1)
-        self.tk_patients_list_frame.grid_columnconfigure(7, weight=1)
-        self.tk_patients_list_frame.grid_rowconfigure(0, weight=0)
-
-        self.tk_patients_id_label = ctk.CTkLabel(self.tk_patients_list_frame, text="ID", bg_color=vdark_widget_color, text_color=header_font_color)
-        self.tk_patients_ssn_label = ctk.CTkLabel(self.tk_patients_list_frame, text="SSN", bg_color=dark_widget_color, text_color=header_font_color)
-        self.tk_patients_age_label = ctk.CTkLabel(self.tk_patients_list_frame, text="Age", bg_color=vdark_widget_color, text_color=header_font_color)
-        self.tk_patients_sex_label = ctk.CTkLabel(self.tk_patients_list_frame, text="Sex", bg_color=dark_widget_color, text_color=header_font_color)
-        self.tk_patients_longitude_label = ctk.CTkLabel(self.tk_patients_list_frame, text="Longitude", bg_color=vdark_widget_color, text_color=header_font_color)
-        self.tk_patients_latitude_label = ctk.CTkLabel(self.tk_patients_list_frame, text="Latitude", bg_color=dark_widget_color, text_color=header_font_color)
-        self.tk_patients_emergency_class_label = ctk.CTkLabel(self.tk_patients_list_frame, text="Classification", bg_color=vdark_widget_color, text_color=header_font_color)
-        self.tk_patients_emergency_level_label = ctk.CTkLabel(self.tk_patients_list_frame, text="Emergency Lvl.", bg_color=dark_widget_color, text_color=header_font_color)
-        self.set_patients_header_grid()
-
-        self.tk_patients_canvas_frame =  self.tk_patients_canvas.create_window((0,0), window=self.tk_patients_list_frame, anchor="nw")
-        self.tk_patients_list_frame.bind("<Configure>", self.on_patients_list_frame_configure)
-        self.tk_patients_canvas.bind("<Configure>", self.on_patients_canvas_configure)
+        self.tk_patients_label.grid(row=0, column=0, sticky="nsew")
+
+        self.tk_patients_controls_frame = ctk.CTkFrame(self.tk_patients_frame, corner_radius=0, fg_color=header_label_color)
+        self.tk_patients_controls_frame.grid(row=0, column=1, sticky="nsew")
+        self.tk_patients_order_var = tk.StringVar(value="ID")
+        self.tk_patients_order_selector = ctk.CTkSegmentedButton(self.tk_patients_controls_frame, values=["ID", "Urgency"], variable=self.tk_patients_order_var, command=self.on_patients_order_changed, height=20)
+        self.tk_patients_order_selector.grid(row=0, column=0, sticky="nsew", padx=1)
+        self.tk_patients_next_button = ctk.CTkButton(self.tk_patients_controls_frame, text="Next", command=self.select_next_patient, width=10, height=20, fg_color=button_color)
+        self.tk_patients_next_button.grid(row=0, column=1, sticky="nsew", padx=1)
+
+        self.tk_patients_list = Virtual_list(self.tk_patients_frame, self.make_patients_header, self.make_patient_row, self.fill_patient_row, order=self.id_order, fg_color=light_widget_color, corner_radius=0)
+        self.tk_patients_list.grid(row=1, column=0, sticky="nsew", columnspan=2)
 
         self.tk_patients_separator = ttk.Separator(self.tk_patients_frame, orient=tk.HORIZONTAL)
         self.tk_patients_separator.grid(row=2, column=0, sticky="nsew", columnspan=2, padx=5, pady=5)
 
-        # Edit Patient Frame
+        # Edit Patient Frame, the rest of it is built by build_edit_panel()
 
         self.tk_edit_patient_label = ctk.CTkLabel(self.tk_edit_patient_frame, text="Edit Patient", bg_color=header_label_color, text_color=header_font_color)
         self.tk_edit_patient_label.grid(row=0, column=0, sticky="nsew", columnspan=3)
+        self.tk_edit_placeholder = ctk.CTkLabel(self.tk_edit_patient_frame, text="Select a patient to edit", text_color=subheader_font_color)
+        self.tk_edit_placeholder.grid(row=1, column=0, sticky="nsew", columnspan=3, pady=10)
+
+    def build_edit_panel(self):
+        if self.edit_panel_built:
+            return
+        self.edit_panel_built = True
+        self.tk_edit_placeholder.destroy()
 
         self.tk_life_threat_label = ctk.CTkLabel(self.tk_edit_patient_frame, text="Life Threat", bg_color=vdark_widget_color, text_color=header_font_color)
         self.tk_life_threat_label.grid(row=1, column=0, sticky="nsew")
@@ -340,7 +265,7 @@ class Triage(ctk.CTk):
         self.tk_pain_level_selector = ctk.CTkSegmentedButton(self.tk_edit_patient_frame, fg_color=light_widget_color, text_color=subheader_font_color, values=list(self.pain_level_options.keys()), variable=self.tk_pain_level_var)
         self.tk_pain_level_selector.grid(row=5, column=1, sticky="nsew", padx=1, pady=1)
         self.tk_specific_var = tk.StringVar(value="-")
-        self.tk_specific_selector = ScrolledListbox(self.tk_edit_patient_frame, listvariable=sorted(self.specific_symptoms.keys()), selectmode=tk.MULTIPLE)
+        self.tk_specific_selector = ScrolledListbox(self.tk_edit_patient_frame, listvariable=sorted(self.symptom_registry.label_names), selectmode=tk.MULTIPLE, search=True)
         self.tk_specific_selector.grid(row=6, column=1, sticky="nsew", padx=1, pady=1)
 
         self.tk_delete_button = ctk.CTkButton(self.tk_edit_patient_frame, text="Delete\nPatient", fg_color=dark_widget_color, command=lambda: self.remove_patient_row(self.selected_patient_id), width=10, border_width=2, border_color=dark_widget_color)
@@ -348,6 +273,51 @@ class Triage(ctk.CTk):
         self.tk_submit_button = ctk.CTkButton(self.tk_edit_patient_frame, text="Submit\nChanges", fg_color=button_color, command=self.submit_patient_changes, width=10, border_width=2, border_color=dark_widget_color)
         self.tk_submit_button.grid(row=3, column=2, sticky="nsew", rowspan=5, padx=5, pady=3)
 
+    def on_first_map(self, event):
+        # Drawn by the idle handlers that follow the map
+        if event.widget is self and "first_paint" not in self.startup.stages:
+            self.after_idle(self.on_first_paint)
+
+    def on_first_paint(self):
+        self.startup.mark("first_paint")
+        self.check_startup()
+
+    def poll_broker(self):
+        status = self.cep_manager.broker_status()
+        if status is None:
+            text = "Local CEP engine"
+            self.startup.mark("connected")
+        else:
+            connected, error = status
+            if connected:
+                text = "Connected to RabbitMQ"
+                self.startup.mark("connected")
+            elif error is None:
+                text = "Connecting to RabbitMQ..."
+            else:
+                text = "RabbitMQ unreachable, changes are kept until it is back (" + str(error) + ")"
+            if not self.cep_manager.batch_interval:
+                self.cep_manager.flush_due() # Sends what was buffered while connecting
+        if self.tk_status_var.get() != text:
+            self.tk_status_var.set(text)
+        self.check_startup()
+        self.after(self.status_ms, self.poll_broker)
+
+    def check_startup(self):
+        if self.startup.path and self.startup.complete():
+            self.finish_startup_report()
+
+    def finish_startup_report(self):
+        # With --startup-report the client only starts up, writes the report and quits
+        if self.startup.path and "written" not in self.startup.stages:
+            self.startup.mark("written")
+            self.startup.write()
+            self.after_idle(self.destroy)
+
+    def flush_cep_batches(self):
+        self.cep_manager.flush_due()
+        self.after(max(1, int(self.cep_manager.batch_interval * 1000 / 2)), self.flush_cep_batches)
+
     def on_temperature_slider_changed(self, value):
         self.tk_temperature_var.set(str(round(value,1))+u"ºC")
 
@@ -358,75 +328,97 @@ class Triage(ctk.CTk):
         longitude = self.tk_add_patient_longitude_entry.get()
         latitude = self.tk_add_patient_latitude_entry.get()
 
-        patient = Patient(id=self.next_patient_id, ssn=ssn, age=age, is_male=True if sex == "Male" else False, longitude=longitude, latitude=latitude)
-
-        row = len(self.patients)+1
-
-        ssn = str(patient.ssn) if patient.ssn else "-"
-        age = str(patient.age) if patient.age else "-"
-        longitude = str(patient.longitude) if patient.longitude else "-"
-        latitude = str(patient.latitude) if patient.latitude else "-"
-        emergency_level = str(patient.emergency_level) if patient.emergency_level else "-"
-        classification = patient.classification.name if patient.emergency_level > 0 else "-"
-
-        patient.emergency_category_var = tk.StringVar(value=classification)
-        patient.emergency_level_var = tk.StringVar(value=emergency_level)
-
-        patient_row = [None, None, None, None, None, None, None, None]
-        patient_row[0] = ctk.CTkButton(self.tk_patients_list_frame, text=str(patient.id), command=lambda: self.patient_selected(patient.id), width=5, border_width=2, border_color=dark_widget_color, fg_color=button_color)
-        patient_row[0].grid(row=row, column=0, sticky="nsew", padx=1, pady=1)
-        patient_row[1] = ctk.CTkLabel(self.tk_patients_list_frame, text=ssn, bg_color=vlight_widget_color, text_color=subheader_font_color)
-        patient_row[1].grid(row=row, column=1, sticky="nsew")
-        patient_row[2] = ctk.CTkLabel(self.tk_patients_list_frame, text=age, bg_color=light_widget_color, text_color=subheader_font_color)
-        patient_row[2].grid(row=row, column=2, sticky="nsew")
-        patient_row[3] = ctk.CTkLabel(self.tk_patients_list_frame, text=patient.get_sex(), bg_color=vlight_widget_color, text_color=subheader_font_color)
-        patient_row[3].grid(row=row, column=3, sticky="nsew")
-        patient_row[4] = ctk.CTkLabel(self.tk_patients_list_frame, text=longitude, bg_color=light_widget_color, text_color=subheader_font_color)
-        patient_row[4].grid(row=row, column=4, sticky="nsew")
-        patient_row[5] = ctk.CTkLabel(self.tk_patients_list_frame, text=latitude, bg_color=vlight_widget_color, text_color=subheader_font_color)
-        patient_row[5].grid(row=row, column=5, sticky="nsew")
-        patient_row[6] = ctk.CTkLabel(self.tk_patients_list_frame, textvariable=patient.emergency_category_var, bg_color=light_widget_color, text_color=subheader_font_color)
-        patient_row[6].grid(row=row, column=6, sticky="nsew")
-        patient_row[7] = ctk.CTkLabel(self.tk_patients_list_frame, textvariable=patient.emergency_level_var, bg_color=vlight_widget_color, text_color=subheader_font_color)
-        patient_row[7].grid(row=row, column=7, sticky="nsew")
-
-        patient_unit = Patient_unit(patient=patient, symptoms=Symptoms(), published=Symptoms(), row=patient_row)
-        self.patients[patient.id] = patient_unit
-
-        self.cep_manager.publish_patient(patient_unit.patient)
-
-        self.next_patient_id += 1
+        self.core.add_patient(ssn=ssn, age=age, is_male=True if sex == "Male" else False, longitude=longitude, latitude=latitude)
+        self.core.commit()
+        self.tk_patients_list.redraw()
+
+    def make_patients_header(self, parent):
+        return [
+            ctk.CTkLabel(parent, text="ID", bg_color=vdark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="SSN", bg_color=dark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="Age", bg_color=vdark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="Sex", bg_color=dark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="Longitude", bg_color=vdark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="Latitude", bg_color=dark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="Classification", bg_color=vdark_widget_color, text_color=header_font_color),
+            ctk.CTkLabel(parent, text="Emergency Lvl.", bg_color=dark_widget_color, text_color=header_font_color),
+        ]
+
+    def make_patient_row(self, parent):
+        # Rows are recycled by the virtual list: the button reads the id it currently shows when clicked.
+        row = [
+            ctk.CTkButton(parent, text="", width=5, border_width=2, border_color=dark_widget_color, fg_color=button_color),
+            ctk.CTkLabel(parent, text="", bg_color=vlight_widget_color, text_color=subheader_font_color),
+            ctk.CTkLabel(parent, text="", bg_color=light_widget_color, text_color=subheader_font_color),
+            ctk.CTkLabel(parent, text="", bg_color=vlight_widget_color, text_color=subheader_font_color),
+            ctk.CTkLabel(parent, text="", bg_color=light_widget_color, text_color=subheader_font_color),
+            ctk.CTkLabel(parent, text="", bg_color=vlight_widget_color, text_color=subheader_font_color),
+            ctk.CTkLabel(parent, text="", bg_color=light_widget_color, text_color=subheader_font_color),
+            ctk.CTkLabel(parent, text="", bg_color=vlight_widget_color, text_color=subheader_font_color),
+        ]
+        pooled = self.tk_patients_list.rows
+        slot = len(pooled)
+        row[0].configure(command=lambda: self.patient_selected(pooled[slot].id))
+        return row
+
+    def fill_patient_row(self, row, id):
+        patient = self.patients[id].patient
+
+        row.set_text(0, str(patient.id))
+        row.set_option(0, "fg_color", button_highlight_color if id == self.selected_patient_id else button_color)
+        row.set_text(1, str(patient.ssn) if patient.ssn else "-")
+        row.set_text(2, str(patient.age) if patient.age else "-")
+        row.set_text(3, patient.get_sex())
+        row.set_text(4, str(patient.longitude) if patient.longitude else "-")
+        row.set_text(5, str(patient.latitude) if patient.latitude else "-")
+        row.set_text(6, str(patient.emergency_category).capitalize() if patient.category_factors else "-")
+        row.set_text(7, str(patient.emergency_level) if patient.emergency_level else "-")
+
+    def on_patients_order_changed(self, value):
+        self.tk_patients_list.set_order(self.priority if value == "Urgency" else self.id_order)
+
+    def select_next_patient(self):
+        id = self.priority.peek()
+        if id is None:
+            return
+        self.patient_selected(id)
+        self.tk_patients_list.see(id)
 
     def patient_selected(self, id):
+        previous = self.selected_patient_id
         self.selected_patient_id = id
 
-        # Reset all button colors
-        for patient in self.patients.values():
-            patient.row[0].configure(fg_color=button_color)
-
-        # Highlight selected button
-        self.patients[self.selected_patient_id].row[0].configure(fg_color=button_highlight_color)
+        # Move the highlight
+        if previous is not None:
+            self.tk_patients_list.refresh(previous)
+        self.tk_patients_list.refresh(id)
 
+        self.build_edit_panel()
         self.clear_edit()
         self.activate_edit(self.patients[self.selected_patient_id])
 
     def remove_patient_row(self, id):
-        self.patients.pop(id)
-        for widget in self.tk_patients_list_frame.children.values():
-            widget.grid_forget()
+        # A discharge: with a retention policy the patient is archived, now or after the grace period
+        self.core.discharge(id)
+        self.core.commit()
+        self.core.expire()
+        self.patients_removed()
 
-        self.set_patients_header_grid()
-        for row, key in enumerate(sorted(self.patients)):
-            for column, i in enumerate(self.patients[key].row):
-                i.grid(row=row+1, column=column, sticky="nsew")
+    def expire_patients(self):
+        if self.core.expire():
+            self.patients_removed()
+        self.after(self.expire_ms, self.expire_patients)
 
-        self.tk_patients_list_frame.update_idletasks()
+    def patients_removed(self):
+        self.tk_patients_list.redraw()
 
-        if self.selected_patient_id == id:
+        if self.selected_patient_id is not None and self.selected_patient_id not in self.patients:
             self.selected_patient_id = None
             self.clear_edit()
 
     def clear_edit(self):
+        if not self.edit_panel_built:
+            return
         self.tk_life_threat_var.set("-")
         self.tk_consciousness_var.set("-")
         self.tk_haemorrhage_var.set("-")
@@ -462,7 +454,7 @@ class Triage(ctk.CTk):
         if patient.symptoms.pain_level:
             self.tk_pain_level_var.set(self.inverse_pain_level_options[patient.symptoms.pain_level])
         if patient.symptoms.specific:
-            self.tk_specific_selector.set_selected([self.inverse_specific_symptoms_options[i] for i in patient.symptoms.specific])
+            self.tk_specific_selector.set_selected([self.symptom_registry.label_of(name) for name in patient.symptoms.specific])
 
     def submit_patient_changes(self):
         life_threat = self.tk_life_threat_var.get()
@@ -482,82 +474,78 @@ class Triage(ctk.CTk):
         symptoms_container.haemorrhage = self.haemorrhage_options.get(haemorrhage)
         symptoms_container.temperature = temperature
         symptoms_container.pain_level = self.pain_level_options.get(pain_level)
-        symptoms_container.specific = list(map(self.specific_symptoms.get, self.tk_specific_selector.get_selected()))
-
-        self.publish_to_cep(self.patients[self.selected_patient_id])
-
-    def publish_to_cep(self, patient_unit):
-        patient = patient_unit.patient
-        symptoms = patient_unit.symptoms
-        published = patient_unit.published
-
-        if symptoms.life_threat is not None and symptoms.life_threat != published.life_threat:
-            self.cep_manager.publish_life_threat(patient.id, symptoms.life_threat)
-            published.life_threat = symptoms.life_threat
-        if symptoms.consciousness is not None and symptoms.consciousness != published.consciousness:
-            self.cep_manager.publish_consciousness(patient.id, symptoms.consciousness)
-            published.consciousness = symptoms.consciousness
-        if symptoms.haemorrhage is not None and symptoms.haemorrhage != published.haemorrhage:
-            self.cep_manager.publish_haemorrhage(patient.id, symptoms.haemorrhage)
-            published.haemorrhage = symptoms.haemorrhage
-        if symptoms.temperature is not None and symptoms.temperature != published.temperature:
-            self.cep_manager.publish_temperature(patient.id, symptoms.temperature)
-            published.temperature = symptoms.temperature
-        if symptoms.pain_level is not None and symptoms.pain_level != published.pain_level:
-            self.cep_manager.publish_pain_level(patient.id, symptoms.pain_level)
-            published.pain_level = symptoms.pain_level
-        if symptoms.specific:
-            for symptom in symptoms.specific:
-                if symptom not in published.specific:
-                    self.cep_manager.publish_specific_symptom(patient.id, symptom)
-            published.specific = symptoms.specific
-
-    def cep_pattern_cb(self, pattern):
-        patient_id = int(pattern["patient"])
-        patient = self.patients.get(patient_id)
-
-        if patient is None:
-            print("Patient " + str(patient_id) + " not found. Ignoring pattern.")
-            return
-        patient = patient.patient
-
-        print("Pattern for patient " + str(patient_id) + ": " + str(pattern))
-
-        if pattern["stream"] == "Classification":
-            factors = int(pattern["factors"])
-            if not patient.category_factors or factors > patient.category_factors:
-                patient.category_factors = factors
-                patient.emergency_category = pattern["class"]
-                patient.emergency_category_var.set(pattern["class"].capitalize())
-        elif pattern["stream"] == "Level":
-            # Ignore patterns with lower level than the current one (May be due to unordered arrival of patterns).
-            if not patient.emergency_level or int(pattern["level"]) > patient.emergency_level:
-                patient.emergency_level = int(pattern["level"])
-                patient.emergency_level_var.set(str(pattern["level"]))
-
-        self.tk_patients_list_frame.update_idletasks()
-
-    def set_patients_header_grid(self):
-        self.tk_patients_id_label.grid(row=0, column=0, sticky="nsew")
-        self.tk_patients_ssn_label.grid(row=0, column=1, sticky="nsew")
-        self.tk_patients_age_label.grid(row=0, column=2, sticky="nsew")
-        self.tk_patients_sex_label.grid(row=0, column=3, sticky="nsew")
-        self.tk_patients_longitude_label.grid(row=0, column=4, sticky="nsew")
-        self.tk_patients_latitude_label.grid(row=0, column=5, sticky="nsew")
-        self.tk_patients_emergency_class_label.grid(row=0, column=6, sticky="nsew")
-        self.tk_patients_emergency_level_label.grid(row=0, column=7, sticky="nsew")
-
-    def on_patients_list_frame_configure(self, event):
-        self.tk_patients_canvas.configure(scrollregion=self.tk_patients_canvas.bbox("all"))
-
-    def on_patients_canvas_configure(self, event):
-        self.tk_patients_canvas.itemconfigure(self.tk_patients_canvas_frame, width=event.width)
+        symptoms_container.specific = list(map(self.symptom_registry.name_of, self.tk_specific_selector.get_selected()))
+
+        self.core.submit_symptoms(self.selected_patient_id)
+        self.core.commit()
+
+    def drain_pattern_queue(self):
+        patterns = self.core.drain()
+        if patterns:
+            self.tk_patients_list.redraw() # Levels may have moved rows when ordering by urgency
+            self.cep_manager.patterns_displayed([int(pattern["patient"]) for pattern in patterns])
+        self.after(self.refresh_ms, self.drain_pattern_queue)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emergency Triage client")
+    parser.add_argument("--local", action="store_true", help="Match the patterns with the in-process CEP engine instead of RabbitMQ")
+    parser.add_argument("--batch-size", type=int, default=None, help="Publish events in batches of this many events")
+    parser.add_argument("--batch-interval", type=float, default=None, help="Publish pending events at least every this many seconds (0.05 with only --batch-size)")
+    parser.add_argument("--envelope", action="store_true", help="Pack each batch of events into a single AMQP message")
+    parser.add_argument("--async-publish", action="store_true", help="Publish from a background I/O thread so the window never waits on RabbitMQ")
+    parser.add_argument("--publish-queue-size", type=int, default=10000, help="Capacity of the background publish queue")
+    parser.add_argument("--overflow", choices=["block", "drop_newest", "drop_oldest", "raise"], default="block", help="What to do when the background publish queue is full (drops are counted and reported)")
+    parser.add_argument("--state-dir", default=None, help="Keep a write-ahead log and snapshots of the triage state in this directory and restore it on start")
+    parser.add_argument("--record", default=None, help="Record the CEP traffic to this file for cep_recorder.py to replay")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics (CEP latency, queue depths, message rates) on this port")
+    parser.add_argument("--metrics-json", default=None, help="Periodically write the metrics as JSON to this file")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Seconds between JSON metric dumps")
+    parser.add_argument("--sample-every", type=int, default=1, help="Time the CEP round trip of every n-th patient only")
+    parser.add_argument("--station", type=int, default=None, help="Station number when several stations share the CEP engine")
+    parser.add_argument("--partitions", type=int, default=1, help="Number of CEP partitions (with --station)")
+    parser.add_argument("--binary", action="store_true", help="Publish the events in the compact binary wire format instead of JSON")
+    parser.add_argument("--brokers", default=None, help="RabbitMQ endpoints to fail over between, host[:port],... (the default server otherwise)")
+    parser.add_argument("--retry-buffer-size", type=int, default=10000, help="Messages kept in memory while RabbitMQ is unreachable")
+    parser.add_argument("--retry-file", default=None, help="Spill the messages that do not fit the retry buffer to this file, and keep them across restarts")
+    parser.add_argument("--prefetch", type=int, default=None, help="Matches in flight from RabbitMQ, acked in batches once handled (default: ack each on arrival)")
+    parser.add_argument("--ack-batch", type=int, default=100, help="Matches per ack with --prefetch")
+    parser.add_argument("--retention-hours", type=float, default=None, help="Archive and remove patients idle for this many hours (8 matches the CEP windows)")
+    parser.add_argument("--max-patients", type=int, default=None, help="Archive and remove the least recently active patients past this many")
+    parser.add_argument("--discharge-grace", type=float, default=0.0, help="Seconds a deleted patient stays listed before it is archived (with a retention policy)")
+    parser.add_argument("--archive", default=None, help="Append the expired patients to this file (default: patients.archive in --state-dir)")
+    parser.add_argument("--startup-report", default=None, help="Write the startup times to this JSON file once the window is painted and the broker connected, then quit (see bench_startup.py)")
+    args = parser.parse_args()
+
+    startup = Startup_report(args.startup_report)
+    startup.mark("imports")
+
+    triage_log = Triage_log(args.state_dir) if args.state_dir else None
+    recorder = Recorder(args.record) if args.record else None
+    metrics = Metrics() if args.metrics_port or args.metrics_json else None
+    exporter = Prometheus_exporter(metrics, args.metrics_port) if args.metrics_port else None
+    dumper = Json_dumper(metrics, args.metrics_json, args.metrics_interval) if args.metrics_json else None
+    routing = Station_routing(args.station, args.partitions) if args.station is not None else None
+    connect = Connection_pool(parse_endpoints(args.brokers)).connect if args.brokers else connection_factory
+    retention, archive = None, None
+    if args.retention_hours is not None or args.max_patients is not None:
+        retention = Retention(Retention_policy(args.retention_hours * 3600 if args.retention_hours is not None else None, args.max_patients, args.discharge_grace))
+        archive_path = args.archive or (os.path.join(args.state_dir, "patients.archive") if args.state_dir else None)
+        archive = Patient_archive(archive_path) if archive_path else None
+
     try:
-        with Cep_manager() as cep_manager:
-            app = Triage(cep_manager=cep_manager)
+        with Cep_manager(local=args.local, batch_size=args.batch_size, batch_interval=args.batch_interval, envelope=args.envelope,
+                         async_publish=args.async_publish, publish_queue_size=args.publish_queue_size, overflow=args.overflow, recorder=recorder,
+                         metrics=metrics, sample_every=args.sample_every, routing=routing, binary=args.binary, connect=connect, retry_buffer_size=args.retry_buffer_size, retry_path=args.retry_file, prefetch=args.prefetch, ack_batch=args.ack_batch,
+                         background_connect=True) as cep_manager:
+            startup.mark("cep_manager")
+            core = Triage_core(cep_manager, triage_log, retention, archive)
+            app = Triage(core, startup)
             app.mainloop()
-    except ConnectionError as e:
-            print("Could not connect to RabbitMQ. Please start the server and try again.")
-            exit()
+            core.close()
+    finally:
+        if recorder:
+            recorder.close()
+        if exporter:
+            exporter.close()
+        if dumper:
+            dumper.close()
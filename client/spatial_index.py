@@ -0,0 +1,137 @@
+import math
+
+# Patients by location, for "every patient of level 4 or more within 5 km" and "the patients nearest to
+# this unit". The globe is cut into a grid of cells about cell_km on a side (longitude cells are sized
+# for the given latitude, they only need to be roughly square) and every cell keeps its patients by
+# emergency level, so a query only looks at the cells overlapping its bounding box and skips the levels
+# it does not want. Distances are great-circle distances, compared as haversines.
+#
+# A radius query costs the cells of its box plus the patients in them; nearest() runs radius queries
+# from one cell out, doubling the radius until k patients are in range, so it is exact without a
+# separate search order.
+
+earth_radius_km = 6371.0088
+km_per_degree = math.pi * earth_radius_km / 180
+
+def coordinates(patient):
+    # (latitude, longitude) in degrees, None unless both are set and valid (they are entered as text)
+    try:
+        latitude, longitude = float(patient.latitude), float(patient.longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return latitude, longitude
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius_km * math.asin(min(1.0, math.sqrt(a)))
+
+class Spatial_index:
+    def __init__(self, cell_km=1.0, latitude=0.0):
+        self.cell_km = cell_km
+        self.cell_lat = cell_km / km_per_degree # Degrees
+        # Columns split the 360 degrees evenly, so column indices wrap around the antimeridian
+        self.columns = max(1, int(360 / (self.cell_lat / max(math.cos(math.radians(latitude)), 0.01))))
+        self.cell_lon = 360 / self.columns
+        self.cells = dict() # (row, column): {level: {id: (latitude, longitude, cos latitude) in radians}}
+        self.where = dict() # id: (cell, level)
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, id):
+        return id in self.where
+
+    def cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_lat), math.floor((longitude + 180) / self.cell_lon) % self.columns
+
+    def add(self, id, latitude, longitude, level=0):
+        if id in self.where:
+            self.remove(id)
+        cell = self.cell(latitude, longitude)
+        latitude, longitude = math.radians(latitude), math.radians(longitude)
+        self.cells.setdefault(cell, dict()).setdefault(level, dict())[id] = (latitude, longitude, math.cos(latitude))
+        self.where[id] = (cell, level)
+
+    def update(self, id, level):
+        entry = self.where.get(id)
+        if entry is None or entry[1] == level:
+            return
+        cell, old = entry
+        levels = self.cells[cell]
+        point = levels[old].pop(id)
+        if not levels[old]:
+            del levels[old]
+        levels.setdefault(level, dict())[id] = point
+        self.where[id] = (cell, level)
+
+    def remove(self, id):
+        entry = self.where.pop(id, None)
+        if entry is None:
+            return
+        cell, level = entry
+        levels = self.cells[cell]
+        del levels[level][id]
+        if not levels[level]:
+            del levels[level]
+            if not levels:
+                del self.cells[cell]
+
+    def level(self, id):
+        return self.where[id][1]
+
+    def covering(self, latitude, longitude, radius_km):
+        # Cells that may hold points within radius_km
+        angle = radius_km / earth_radius_km
+        lat_min, lat_max = latitude - math.degrees(angle), latitude + math.degrees(angle)
+        if lat_min <= -90 or lat_max >= 90 or angle >= math.pi / 2:
+            columns = range(self.columns) # A pole is in range
+        else:
+            # Widest longitude span of the circle, from its tangent meridians
+            span = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(latitude)))))
+            first = math.floor((longitude - span + 180) / self.cell_lon)
+            last = math.floor((longitude + span + 180) / self.cell_lon)
+            if last - first + 1 >= self.columns:
+                columns = range(self.columns)
+            else:
+                columns = [column % self.columns for column in range(first, last + 1)]
+        row_min = math.floor(max(lat_min, -90) / self.cell_lat)
+        row_max = math.floor(min(lat_max, 90) / self.cell_lat)
+        cells = self.cells
+        if (row_max - row_min + 1) * len(columns) > len(cells):
+            # Fewer occupied cells than cells in the box
+            columns = set(columns)
+            return [cell for cell in cells if row_min <= cell[0] <= row_max and cell[1] in columns]
+        return [(row, column) for row in range(row_min, row_max + 1) for column in columns if (row, column) in cells]
+
+    def within(self, latitude, longitude, radius_km, min_level=None):
+        # [(distance_km, id)] of the patients within radius_km, nearest first
+        found = []
+        lat0, lon0 = math.radians(latitude), math.radians(longitude)
+        cos0 = math.cos(lat0)
+        limit = math.sin(min(radius_km / earth_radius_km, math.pi) / 2) ** 2
+        sin, asin, sqrt = math.sin, math.asin, math.sqrt
+        for cell in self.covering(latitude, longitude, radius_km):
+            for level, points in self.cells[cell].items():
+                if min_level is not None and level < min_level:
+                    continue
+                for id, (lat, lon, cos) in points.items():
+                    a = sin((lat - lat0) / 2) ** 2 + cos0 * cos * sin((lon - lon0) / 2) ** 2
+                    if a <= limit:
+                        found.append((2 * earth_radius_km * asin(min(1.0, sqrt(a))), id))
+        found.sort()
+        return found
+
+    def nearest(self, latitude, longitude, k=1, min_level=None, max_km=None):
+        # [(distance_km, id)] of the k nearest patients, nearest first
+        if k <= 0 or not self.where:
+            return []
+        limit = max_km if max_km is not None else math.pi * earth_radius_km
+        radius = min(self.cell_km, limit)
+        while True:
+            found = self.within(latitude, longitude, radius, min_level)
+            if len(found) >= k or radius >= limit:
+                return found[:k]
+            radius = min(radius * 2, limit)
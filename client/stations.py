@@ -0,0 +1,84 @@
+import zlib
+
+# Several triage stations sharing one CEP deployment.
+#
+# Patient ids are station-scoped: the schemas declare the patient as an Integer, so the top bits of the
+# 31 usable ones hold the station and the rest a per-station sequence. Anyone holding an id can tell
+# which station owns it without a lookup.
+#
+# Events go to the topic exchange "triage.events" with the routing key events.<partition>.<station>,
+# where the partition is a hash of the patient id: every event of a patient reaches the same CEP
+# partition, which binds its queue Messages.<partition> to events.<partition>.*. Each partition publishes
+# its matches to "triage.matches" keyed matches.<station>.<partition>, and each station only binds
+# matches.<station>.#, so it never sees the other stations' patients.
+
+station_bits = 10
+sequence_bits = 31 - station_bits
+max_station = (1 << station_bits) - 1
+sequence_mask = (1 << sequence_bits) - 1
+
+events_exchange = "triage.events"
+matches_exchange = "triage.matches"
+
+class StationError(Exception):
+    pass
+
+def station_of(patient_id):
+    return int(patient_id) >> sequence_bits
+
+def partition_of(patient_id, partitions):
+    # crc32 rather than modulo so consecutive ids of one station spread over the partitions evenly
+    return zlib.crc32(int(patient_id).to_bytes(4, "little")) % partitions
+
+def event_key(patient_id, partitions):
+    return "events." + str(partition_of(patient_id, partitions)) + "." + str(station_of(patient_id))
+
+def match_key(patient_id, partitions):
+    return "matches." + str(station_of(patient_id)) + "." + str(partition_of(patient_id, partitions))
+
+def partition_queue(partition):
+    return "Messages." + str(partition)
+
+def station_queue(station):
+    return "MuleOut." + str(station)
+
+def declare_exchanges(channel):
+    channel.exchange_declare(exchange=events_exchange, exchange_type="topic", durable=True)
+    channel.exchange_declare(exchange=matches_exchange, exchange_type="topic", durable=True)
+
+class Station_routing:
+    def __init__(self, station, partitions=1):
+        if not 0 <= station <= max_station:
+            raise StationError("Station must be between 0 and " + str(max_station))
+        if partitions < 1:
+            raise StationError("There must be at least one partition")
+        self.station = station
+        self.partitions = partitions
+
+    def first_id(self):
+        return self.station << sequence_bits
+
+    def owns(self, patient_id):
+        return station_of(patient_id) == self.station
+
+    def check_id(self, patient_id):
+        if not self.owns(patient_id):
+            raise StationError("Station " + str(self.station) + " has run out of patient ids")
+
+    def event_key(self, patient_id):
+        return event_key(patient_id, self.partitions)
+
+    def declare_station_queue(self, channel):
+        # The station's own match queue, bound to every partition's matches for it
+        queue = station_queue(self.station)
+        declare_exchanges(channel)
+        channel.queue_declare(queue=queue, durable=True)
+        channel.queue_bind(queue=queue, exchange=matches_exchange, routing_key="matches." + str(self.station) + ".#")
+        return queue
+
+def declare_partition_queue(channel, partition):
+    queue = partition_queue(partition)
+    declare_exchanges(channel)
+    channel.queue_declare(queue=queue, durable=True)
+    channel.queue_bind(queue=queue, exchange=events_exchange, routing_key="events." + str(partition) + ".*")
+    return queue
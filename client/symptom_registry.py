@@ -0,0 +1,149 @@
+from dataclasses import dataclass
+
+import triage_options
+from cep_engine import Cep_engine, default_patterns_dir
+
+# One table of the specific symptoms for the UI, the publisher and local scoring, read from the
+# 'on Symptom' statements of the patterns: the level a symptom alone gives (the first insert into
+# EmergencyLevel whose where clause names it, as those statements output first) and the classes it counts
+# for (every insert into SymptomClassification naming it). Display labels come from
+# triage_options.specific_symptoms.
+#
+# A symptom's id is its bit in the masks (see symptom_state.py): the symptoms of the edit panel in its
+# order, then any the patterns mention that the panel does not offer, then any register() adds. Lookups
+# by id, name and label are list indexing and dict hits; bit() and mask() raise KeyError for a name that
+# is not registered rather than adding it. Parsing the patterns takes a few milliseconds,
+# shared() does it once per process.
+
+@dataclass(frozen=True)
+class Symptom:
+    id: int
+    name: str # Published to the CEP engine
+    label: str # Shown in the edit panel
+    level: int # 0 when no pattern gives it one
+    classes: tuple
+
+class Symptom_vocabulary:
+    def __init__(self, names):
+        self.names = []
+        self.bits = dict() # name: bit
+        for name in names:
+            self.register(name)
+
+    def register(self, name):
+        # A new name gets the next free bit, masks are unbounded ints
+        bit = self.bits.get(name)
+        if bit is None:
+            bit = self.bits[name] = 1 << len(self.names)
+            self.names.append(name)
+        return bit
+
+    def bit(self, name):
+        return self.bits[name]
+
+    def mask(self, names):
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+    def names_of(self, mask):
+        names = []
+        while mask:
+            low = mask & -mask
+            names.append(self.names[low.bit_length() - 1])
+            mask ^= low
+        return names
+
+def named_symptoms(node, found):
+    # Symptom names a where clause tests for: name = "x" and name in ("x", ...)
+    if isinstance(node, tuple):
+        if node[0] == "in" and node[1] == ("ident", "name") and not node[3]:
+            found.extend(value[1] for value in node[2] if value[0] == "const" and isinstance(value[1], str))
+        elif node[0] == "cmp" and node[1] == "=" and node[2] == ("ident", "name") and node[3][0] == "const":
+            found.append(node[3][1])
+        for child in node[1:]:
+            for c in (child if isinstance(child, list) else [child]):
+                named_symptoms(c, found)
+    return found
+
+def selected_constant(select, column):
+    for name, expression in select:
+        if name == column and expression[0] == "const":
+            return expression[1]
+    return None
+
+class Symptom_registry(Symptom_vocabulary):
+    def __init__(self, patterns_dir=default_patterns_dir, labels=triage_options.specific_symptoms):
+        levels = dict() # name: level
+        classes = dict() # name: [class]
+        order = []
+        for statement in Cep_engine.load_dir(patterns_dir):
+            if statement[0] != "on" or statement[1] != "Symptom":
+                continue
+            _, _, _, clauses, output = statement
+            for target, select, where in clauses:
+                names = named_symptoms(where, [])
+                order.extend(names)
+                if target == "EmergencyLevel":
+                    level = selected_constant(select, "level")
+                    for name in names:
+                        if output == "first":
+                            levels.setdefault(name, level)
+                        else:
+                            levels[name] = max(level, levels.get(name, 0))
+                elif target == "SymptomClassification":
+                    symptom_class = selected_constant(select, "class")
+                    for name in names:
+                        if symptom_class not in classes.setdefault(name, []):
+                            classes[name].append(symptom_class)
+
+        self.label_names = dict(labels) # label: name
+        self.labels = {name: label for label, name in self.label_names.items()} # name: label
+        self.symptoms = []
+        self.levels = [] # By id
+        self.class_masks = dict() # class: mask of the symptoms counting for it
+        self.level_of = levels
+        self.classes_of = classes
+        super().__init__(list(self.label_names.values()) + order)
+
+    def register(self, name):
+        bit = self.bits.get(name)
+        if bit is None:
+            bit = super().register(name)
+            symptom = Symptom(len(self.symptoms), name, self.labels.get(name, name.capitalize()),
+                              self.level_of.get(name, 0), tuple(self.classes_of.get(name, ())))
+            self.symptoms.append(symptom)
+            self.levels.append(symptom.level)
+            for symptom_class in symptom.classes:
+                self.class_masks[symptom_class] = self.class_masks.get(symptom_class, 0) | bit
+        return bit
+
+    def __len__(self):
+        return len(self.symptoms)
+
+    def __contains__(self, name):
+        return name in self.bits
+
+    def get(self, name):
+        bit = self.bits.get(name)
+        return self.symptoms[bit.bit_length() - 1] if bit else None
+
+    def label_of(self, name):
+        symptom = self.get(name)
+        return symptom.label if symptom else name
+
+    def name_of(self, label):
+        return self.label_names.get(label)
+
+    def class_counts(self, mask):
+        # class: number of the symptoms in the mask that count for it
+        return {symptom_class: bin(mask & class_mask).count("1") for symptom_class, class_mask in self.class_masks.items() if mask & class_mask}
+
+shared_registry = None
+
+def shared():
+    global shared_registry
+    if shared_registry is None:
+        shared_registry = Symptom_registry()
+    return shared_registry
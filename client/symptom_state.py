@@ -0,0 +1,41 @@
+import symptom_registry
+
+# Specific symptoms as bits of an int, bit i for the symptom with id i in symptom_registry.py. What a submit added and removed
+# is two mask operations instead of a list scan per symptom, and a removed symptom becomes a Retraction
+# event (see patterns/PatternRetraction.epl) rather than being forgotten on the client only.
+#
+# General symptoms are one value each: a change retracts the old value before publishing the new one,
+# clearing back to "-" only retracts. Retraction sources are the event types the patterns tag their
+# EmergencyLevel rows with, and the symptom name for specific symptoms.
+
+# Symptoms field: (retraction source, Cep_manager publisher name)
+general_fields = (
+    ("life_threat", "LifeThreat", "publish_life_threat"),
+    ("consciousness", "ConsciousLevel", "publish_consciousness"),
+    ("haemorrhage", "Haemorrhage", "publish_haemorrhage"),
+    ("temperature", "Temperature", "publish_temperature"),
+    ("pain_level", "Pain", "publish_pain_level"),
+)
+
+def publish_changes(cep_manager, id, symptoms, published, published_mask):
+    # Publishes the difference between the symptoms and what was last published, updates `published`
+    # and returns the new mask of published specific symptoms
+    for field, source, publisher in general_fields:
+        value = getattr(symptoms, field)
+        old = getattr(published, field)
+        if value == old:
+            continue
+        if old is not None:
+            cep_manager.publish_retraction(id, source)
+        if value is not None:
+            getattr(cep_manager, publisher)(id, value)
+        setattr(published, field, value)
+
+    vocabulary = symptom_registry.shared()
+    mask = vocabulary.mask(symptoms.specific)
+    for name in vocabulary.names_of(published_mask & ~mask):
+        cep_manager.publish_retraction(id, name)
+    for name in vocabulary.names_of(mask & ~published_mask):
+        cep_manager.publish_specific_symptom(id, name)
+    published.specific = list(symptoms.specific)
+    return mask
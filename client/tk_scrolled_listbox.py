@@ -4,35 +4,58 @@ import tkinter as tk
 import customtkinter as ctk
 
 class ScrolledListbox(ctk.CTkFrame):
-    def __init__(self, parent, *args, **kwargs):
+    # The entries live in self.items, with a label -> index map kept in sync on insert and delete, and the
+    # selection in self.selected, so it survives filtering. The listbox only shows self.visible: its contents
+    # are replaced through a listvariable and its selection redrawn with one Tcl script, a single round trip
+    # each however many entries there are. With search=True a box above the list filters the entries as you
+    # type (case-insensitive substring), narrowing the current matches while the query grows.
+    def __init__(self, parent, *args, search=False, **kwargs):
         ctk.CTkFrame.__init__(self, parent)
-        self.listbox = tk.Listbox(self, *args, **kwargs)
+        item_list = kwargs.pop('listvariable', None)
+        kwargs.setdefault('exportselection', 0) # Selecting text elsewhere must not clear the selection
+        self.items = []
+        self.index = dict() # item: position in self.items
+        self.folded = dict() # item: lowercase text for the filter
+        self.selected = set()
+        self.visible = []
+        self.rows = dict() # item: row in the listbox
+        self.query = ""
+        self.list_var = tk.Variable(self, value=())
+
+        self.search = None
+        if search:
+            self.search = ctk.CTkEntry(self, placeholder_text="Filter")
+            self.search.pack(side="top", fill="x")
+            self.search.bind('<KeyRelease>', self.on_search)
+            self.search.bind('<Escape>', self.clear_search)
+        self.listbox = tk.Listbox(self, *args, listvariable=self.list_var, **kwargs)
         self.listbox_scrollbar = ctk.CTkScrollbar(self, orientation="vertical", command=self.listbox.yview)
         self.listbox.configure(yscrollcommand=self.listbox_scrollbar.set)
         self.listbox_scrollbar.pack(side="right", fill="y")
         self.listbox.pack(side="left", fill="both", expand=True)
         self.listbox.bind('<Enter>', self.enter)
         self.listbox.bind('<Leave>', self.leave)
-        self.listvariable(kwargs.get('listvariable',None))
+        self.listbox.bind('<<ListboxSelect>>', self.on_select)
+        self.listvariable(item_list)
 
 
     def configure(self, **kwargs):
-        self.listvariable(kwargs.get('listvariable',None))
+        self.listvariable(kwargs.pop('listvariable',None))
         self.setbackground(kwargs.get('bg',None))
         self.setforeground(kwargs.get('fg',None))
         self.sethighlight(kwargs.get('highlightcolor',None))
         self.setselectbackground(kwargs.get('selectbackground',None))
-        self.setexportselection(kwargs.get('exportselection',1))
+        self.setexportselection(kwargs.get('exportselection',None))
         self.listbox.configure(**kwargs)
 
 
     def listvariable(self, item_list):
         if item_list != None:
-            for item in item_list:
-                self.listbox.insert(tk.END, item)
+            self.insert(tk.END, *item_list)
 
     def setexportselection(self, exportselection):
-        self.listbox.configure(exportselection = exportselection)
+        if exportselection != None:
+            self.listbox.configure(exportselection = exportselection)
 
     def setbackground(self, bg):
         if bg != None:
@@ -56,59 +79,110 @@ class ScrolledListbox(ctk.CTkFrame):
     def leave(self, event):
         self.listbox.config(cursor="")
 
-    def insert(self, location, item):
-        self.listbox.insert(location, item)
+    def _position(self, location):
+        return len(self.items) if location == tk.END else int(location)
+
+    def _reindex(self, start=0):
+        for i in range(start, len(self.items)):
+            self.index[self.items[i]] = i
+
+    def insert(self, location, *items):
+        position = self._position(location)
+        self.items[position:position] = items
+        for item in items:
+            self.folded[item] = str(item).lower()
+        self._reindex(position)
+        self.filter(self.query)
+
+    def _remove(self, keep):
+        # Keeps the items keep(item) is true for, then shows the result with one update
+        removed = [item for item in self.items if not keep(item)]
+        self.items = [item for item in self.items if keep(item)]
+        for item in removed:
+            self.index.pop(item, None)
+            self.folded.pop(item, None)
+            self.selected.discard(item)
+        self._reindex()
+        self.filter(self.query)
 
     def curselection(self):
-        return self.listbox.curselection()
+        # Positions in the whole list, as if nothing were filtered out
+        return tuple(sorted(self.index[item] for item in self.selected))
 
     def delete(self, first, last=None):
-        self.listbox.delete(first, last)
+        first = self._position(first)
+        last = first if last is None else min(self._position(last), len(self.items) - 1)
+        doomed = set(self.items[first:last + 1])
+        self._remove(lambda item: item not in doomed)
 
     def delete_selected(self):
-        selected_item = self.listbox.curselection()
-        idx_count = 0
-        for item in selected_item:
-            self.listbox.delete(item - idx_count)
-            idx_count += 1
+        self._remove(lambda item: item not in self.selected)
 
     def delete_unselected(self):
-        selected_item = self.listbox.curselection()
-        idx_count = 0
-        for i, listbox_entry in enumerate(self.listbox.get(0, tk.END)):
-            if not listbox_entry in selected_item:
-                self.listbox.delete(i - idx_count)
-                idx_count += 1
+        self._remove(lambda item: item in self.selected)
 
     def clear_selected(self):
-        selected_item = self.listbox.curselection()
-        for index in selected_item:
-            self.listbox.selection_clear(index)
+        self.selected.clear()
+        self.listbox.selection_clear(0, tk.END)
 
     def disable_list(self):
         self.listbox.configure(state=tk.DISABLED)
+        if self.search:
+            self.search.configure(state="disabled")
 
     def activate_list(self):
         self.listbox.configure(state=tk.NORMAL)
+        if self.search:
+            self.search.configure(state="normal")
 
     def set_selected(self, names):
         if names == None:
             return
 
-        self.listbox.selection_clear(0, tk.END)
-        for name in names:
-            index = self.listbox.get(0, tk.END).index(name)
-            self.listbox.selection_set(index)
+        self.selected = {name for name in names if name in self.index}
+        self._show_selection()
 
     def get_selected(self):
-        return [self.listbox.get(item) for item in self.listbox.curselection()]
+        return sorted(self.selected, key=self.index.__getitem__)
+
+    def filter(self, query, narrow=False):
+        query = query.strip().lower()
+        if narrow and query == self.query:
+            return
+        # While typing, a longer query only matches entries the shorter one matched
+        candidates = self.visible if narrow and query.startswith(self.query) else self.items
+        self.visible = [item for item in candidates if query in self.folded[item]] if query else list(self.items)
+        self.query = query
+        self.rows = {item: row for row, item in enumerate(self.visible)}
+        self.list_var.set(tuple(self.visible))
+        self._show_selection()
+
+    def on_search(self, event=None):
+        self.filter(self.search.get(), narrow=True)
+
+    def clear_search(self, event=None):
+        self.search.delete(0, tk.END)
+        self.filter("")
+
+    def on_select(self, event=None):
+        # The user (de)selected rows: only the shown entries can have changed
+        shown = set(self.listbox.curselection())
+        for row, item in enumerate(self.visible):
+            if row in shown:
+                self.selected.add(item)
+            else:
+                self.selected.discard(item)
+
+    def _show_selection(self):
+        rows = " ".join(str(self.rows[item]) for item in self.selected if item in self.rows)
+        widget = str(self.listbox)
+        self.listbox.tk.eval(widget + " selection clear 0 end; foreach row {" + rows + "} {" + widget + " selection set $row}")
 
 if __name__ == '__main__':
 
     gui = tk.Tk()
-    list_values = ['Test1','Test2','Test3','Test4','Test5','Test6','Test7',
-                   'Test8','Test9','Test10','Test11','Test12','Test13','Test14']
-    scrolled_listbox = ScrolledListbox(gui, selectmode=tk.MULTIPLE)
+    list_values = ['Test' + str(i) for i in range(1, 1001)]
+    scrolled_listbox = ScrolledListbox(gui, selectmode=tk.MULTIPLE, search=True)
     scrolled_listbox.configure(listvariable=list_values)
     scrolled_listbox.configure(bg='yellow')
     scrolled_listbox.configure(selectbackground='red')
@@ -0,0 +1,233 @@
+import time
+
+from ui_queue import Coalescing_queue
+from virtual_list import Id_order
+from priority_index import Priority_index
+from spatial_index import Spatial_index, coordinates
+import symptom_state
+from patient_store import Patient_store, Symptoms, EmergencyType
+
+# Patient and symptom bookkeeping shared by the Tk client (run.py) and the HTTP service
+# (triage_service.py): creating and removing patients, publishing only what changed to the CEP engine,
+# merging the matches that come back and keeping the triage log. Nothing here touches a UI; the owner
+# calls drain() periodically on its own thread and shows the patterns it returns, and expire() to let
+# the retention policy (see retention.py) archive and remove patients.
+
+class Triage_core:
+    def __init__(self, cep_manager, triage_log=None, retention=None, archive=None):
+        self.log = triage_log
+        self.retention = retention # retention.Retention, None keeps every patient until removed
+        self.archive = archive # retention.Patient_archive for the expired patients
+        self.pattern_queue = Coalescing_queue()
+        self.cep_manager = cep_manager
+        if cep_manager.metrics:
+            cep_manager.metrics.gauge("ui_pattern_queue_depth", lambda: len(self.pattern_queue))
+            cep_manager.metrics.gauge("ui_patients", lambda: len(self.patients))
+            if retention is not None:
+                cep_manager.metrics.gauge("retention_heap_entries", lambda: len(self.retention.heap))
+            if archive:
+                cep_manager.metrics.gauge("retention_archived", lambda: self.archive.archived)
+        self.cep_manager.start_consuming(self.cep_pattern_cb)
+
+        self.patients = Patient_store() # patient_id: Patient_unit
+        self.id_order = Id_order()
+        self.priority = Priority_index() # Most urgent first
+        self.spatial = Spatial_index() # Patients with coordinates, discharged ones left out
+        # With stations, ids are allocated from the station's own range (see stations.py)
+        self.routing = cep_manager.routing
+        self.next_patient_id = self.routing.first_id() if self.routing else 0
+
+        if self.log:
+            self.next_patient_id = max(self.next_patient_id, self.log.recover(self.restore_patient, self.restore_symptoms, self.merge_pattern, self.forget_patient, self.restore_state, self.restore_discharge))
+
+    def add_patient(self, ssn, age, is_male, longitude, latitude):
+        if self.routing:
+            self.routing.check_id(self.next_patient_id)
+        patient_unit = self.patients.add(self.next_patient_id, ssn, age, is_male, longitude, latitude)
+        patient = patient_unit.patient
+        self.id_order.add(patient.id)
+        self.priority.add(patient.id, patient.emergency_level)
+        self.locate(patient)
+        if self.retention is not None:
+            self.retention.touch(patient.id)
+
+        self.cep_manager.publish_patient(patient_unit.patient)
+        if self.log:
+            self.log.log_patient(patient)
+
+        self.next_patient_id += 1
+        self.snapshot_if_due()
+        return patient
+
+    def submit_symptoms(self, id):
+        # Publishes whatever changed in patients[id].symptoms since the last submit
+        patient_unit = self.patients[id]
+        if self.retention is not None:
+            self.retention.touch(id)
+        with self.cep_manager.batch():
+            self.publish_to_cep(patient_unit)
+        if self.log:
+            self.log.log_symptoms(patient_unit.patient.id, patient_unit.symptoms, patient_unit.published)
+            self.snapshot_if_due()
+
+    def remove_patient(self, id):
+        self.forget_patient(id)
+        self.cep_manager.patient_removed(id)
+        if self.log:
+            self.log.log_remove(id)
+            self.snapshot_if_due()
+
+    def discharge(self, id):
+        # Removed by the retention policy after its discharge grace period, or at once without one
+        if self.retention is not None:
+            deadline = self.retention.discharge(id)
+            self.spatial.remove(id)
+            if self.log:
+                self.log.log_discharge(id, deadline)
+                self.snapshot_if_due()
+        else:
+            self.remove_patient(id)
+
+    def expire(self, now=None):
+        # Archives and removes the patients the retention policy lets go; returns [(id, reason)]
+        if self.retention is None:
+            return []
+        now = time.time() if now is None else now
+        expired = self.retention.expired(now)
+        if not expired:
+            return expired
+        for id, reason in expired:
+            if self.archive:
+                self.archive.archive(self.patients[id], reason, now)
+        if self.archive:
+            self.archive.flush() # Archived before the removals are committed to the log
+        for id, reason in expired:
+            self.remove_patient(id)
+        self.commit()
+        return expired
+
+    def locate(self, patient):
+        position = coordinates(patient)
+        if position:
+            self.spatial.add(patient.id, position[0], position[1], patient.emergency_level)
+
+    def commit(self):
+        if self.log:
+            self.log.commit()
+
+    def snapshot_if_due(self):
+        # Checked after every logged change, so the log stays bounded without any matches coming back
+        if self.log and self.log.snapshot_due():
+            self.log.snapshot(self.patients.values(), self.next_patient_id, self.discharges())
+
+    def discharges(self):
+        return self.retention.discharged() if self.retention is not None else ()
+
+    def publish_to_cep(self, patient_unit):
+        # Additions and retractions, see symptom_state.py
+        patient_unit.published_mask = symptom_state.publish_changes(self.cep_manager, patient_unit.patient.id, patient_unit.symptoms, patient_unit.published, patient_unit.published_mask)
+
+    def cep_pattern_cb(self, pattern):
+        # Called from the subscriber thread: only queue the pattern, drain() applies it.
+        self.pattern_queue.put(pattern)
+
+    def drain(self):
+        # Applies the queued matches; returns the ones for known patients
+        applied = [pattern for pattern in self.pattern_queue.drain() if self.apply_pattern(pattern)]
+        if self.log and applied:
+            self.log.commit()
+            self.snapshot_if_due()
+        return applied
+
+    def apply_pattern(self, pattern):
+        patient_id = int(pattern["patient"])
+        patient = self.patients.get(patient_id)
+
+        if patient is None:
+            return False # Removed since the events were sent
+
+        self.merge_pattern(pattern)
+        if self.log:
+            self.log.log_match(pattern)
+        return True
+
+    def merge_pattern(self, pattern):
+        patient_id = int(pattern["patient"])
+        if patient_id not in self.patients:
+            return
+        unit = self.patients[patient_id]
+        patient = unit.patient
+
+        # The engine reports the current count or maximum, which also goes down when symptoms are retracted
+        # (a patient's events all go through one engine, in order)
+        if pattern["stream"] == "Classification":
+            factors = int(pattern["factors"] or 0)
+            class_factors = unit.class_factors
+            if factors:
+                class_factors[pattern["class"]] = factors
+            else:
+                class_factors.pop(pattern["class"], None)
+            unit.class_factors = class_factors
+            # The current class keeps ties, so the first class to reach a count wins as before
+            current = class_factors.get(patient.emergency_category, 0)
+            best = max(class_factors, key=class_factors.get, default=None)
+            if best is None:
+                patient.category_factors = 0
+                patient.emergency_category = EmergencyType.Generic
+            elif class_factors[best] > current:
+                patient.category_factors = class_factors[best]
+                patient.emergency_category = best
+            else:
+                patient.category_factors = current
+        elif pattern["stream"] == "Level":
+            level = int(pattern["level"] or 0)
+            if level != patient.emergency_level:
+                patient.emergency_level = level
+                self.priority.update(patient_id, level)
+                self.spatial.update(patient_id, level)
+
+    def close(self):
+        if self.log:
+            self.log.snapshot(self.patients.values(), self.next_patient_id, self.discharges())
+            self.log.close()
+        if self.archive:
+            self.archive.close()
+
+    # Replay of the triage log (no publishing)
+
+    def restore_patient(self, fields):
+        patient = self.patients.add(**fields).patient
+        self.id_order.add(patient.id)
+        self.priority.add(patient.id, patient.emergency_level)
+        self.locate(patient)
+        if self.retention is not None:
+            self.retention.touch(patient.id) # Activity times are not logged: a restored patient starts a new window
+
+    def restore_symptoms(self, id, symptoms, published):
+        if id in self.patients:
+            self.patients[id].symptoms = Symptoms(**symptoms)
+            self.patients[id].published = Symptoms(**published)
+
+    def restore_state(self, id, level, factors, category):
+        if id in self.patients:
+            patient = self.patients[id].patient
+            patient.emergency_level = level
+            patient.category_factors = factors
+            patient.emergency_category = category if category is not None else EmergencyType.Generic
+            # Snapshots keep the winning class only
+            self.patients[id].class_factors = {category: factors} if category is not None and factors else dict()
+            self.priority.update(id, level)
+            self.spatial.update(id, level)
+
+    def restore_discharge(self, id, deadline):
+        if id in self.patients and self.retention is not None:
+            self.retention.restore_discharge(id, deadline)
+            self.spatial.remove(id)
+
+    def forget_patient(self, id):
+        self.patients.remove(id)
+        self.id_order.remove(id)
+        self.priority.remove(id)
+        self.spatial.remove(id)
+        if self.retention is not None:
+            self.retention.forget(id)
@@ -0,0 +1,273 @@
+import os
+import mmap
+import math
+import struct
+import zlib
+
+# Write-ahead log of the triage state: patient creations, symptom submissions, received matches,
+# discharges (with their expiry deadline, see retention.py) and removals are appended to triage.wal as
+# small binary records. Every so often the whole state is written to triage.snapshot and the log starts
+# over. On startup the snapshot is mmapped and only the log tail written after it is replayed.
+#
+# Record: type (B), payload length (I), crc32 of the payload (I), payload. A torn or corrupt record ends
+# the replay and is cut off the log. Both files start with a magic and a generation number; a snapshot
+# of generation g covers everything in logs of generation < g.
+
+wal_magic = b"TRWAL1\0\0"
+snapshot_magic = b"TRSNP1\0\0"
+file_header = struct.Struct("<8sQ") # magic, generation
+snapshot_header = struct.Struct("<qI") # next patient id, record count
+record_header = struct.Struct("<BII")
+
+PATIENT, SYMPTOMS, MATCH, REMOVE, STATE, DISCHARGE = 1, 2, 3, 4, 5, 6
+
+patient_struct = struct.Struct("<qB")
+symptoms_struct = struct.Struct("<bbbbdH")
+match_struct = struct.Struct("<qBi")
+id_struct = struct.Struct("<q")
+state_struct = struct.Struct("<qiI")
+discharge_struct = struct.Struct("<qd") # id, expiry deadline
+str_struct = struct.Struct("<H")
+
+LEVEL, CLASSIFICATION = 0, 1
+no_string = 0xFFFF
+
+class LogError(Exception):
+    pass
+
+def pack_str(value):
+    if value is None:
+        return str_struct.pack(no_string)
+    data = str(value).encode("utf-8")
+    return str_struct.pack(len(data)) + data
+
+def unpack_str(buffer, offset):
+    (length,) = str_struct.unpack_from(buffer, offset)
+    offset += str_struct.size
+    if length == no_string:
+        return None, offset
+    return bytes(buffer[offset:offset + length]).decode("utf-8"), offset + length
+
+def pack_small(value):
+    return -1 if value is None else value
+
+def unpack_small(value):
+    return None if value < 0 else value
+
+def pack_symptoms(symptoms):
+    temperature = math.nan if symptoms.temperature is None else symptoms.temperature
+    head = symptoms_struct.pack(pack_small(symptoms.life_threat), pack_small(symptoms.consciousness), pack_small(symptoms.haemorrhage), pack_small(symptoms.pain_level), temperature, len(symptoms.specific))
+    return head + b"".join(pack_str(name) for name in symptoms.specific)
+
+def unpack_symptoms(buffer, offset):
+    life_threat, consciousness, haemorrhage, pain_level, temperature, count = symptoms_struct.unpack_from(buffer, offset)
+    offset += symptoms_struct.size
+    specific = []
+    for _ in range(count):
+        name, offset = unpack_str(buffer, offset)
+        specific.append(name)
+    values = {
+        "life_threat": unpack_small(life_threat),
+        "consciousness": unpack_small(consciousness),
+        "haemorrhage": unpack_small(haemorrhage),
+        "pain_level": unpack_small(pain_level),
+        "temperature": None if math.isnan(temperature) else temperature,
+        "specific": specific,
+    }
+    return values, offset
+
+def encode_patient(patient):
+    return patient_struct.pack(patient.id, patient.is_male) + pack_str(patient.ssn) + pack_str(patient.age) + pack_str(patient.longitude) + pack_str(patient.latitude)
+
+def decode_patient(buffer, offset):
+    id, is_male = patient_struct.unpack_from(buffer, offset)
+    offset += patient_struct.size
+    fields = {"id": id, "is_male": bool(is_male)}
+    for name in ("ssn", "age", "longitude", "latitude"):
+        fields[name], offset = unpack_str(buffer, offset)
+    return fields
+
+def encode_symptoms(id, symptoms, published):
+    return id_struct.pack(id) + pack_symptoms(symptoms) + pack_symptoms(published)
+
+def decode_symptoms(buffer, offset):
+    (id,) = id_struct.unpack_from(buffer, offset)
+    symptoms, offset = unpack_symptoms(buffer, offset + id_struct.size)
+    published, offset = unpack_symptoms(buffer, offset)
+    return id, symptoms, published
+
+def encode_match(pattern):
+    # A level or class whose evidence was all retracted comes as null, logged as 0
+    if pattern["stream"] == "Level":
+        return match_struct.pack(int(pattern["patient"]), LEVEL, int(pattern["level"] or 0)) + pack_str(None)
+    return match_struct.pack(int(pattern["patient"]), CLASSIFICATION, int(pattern["factors"] or 0)) + pack_str(pattern["class"])
+
+def decode_match(buffer, offset):
+    id, stream, value = match_struct.unpack_from(buffer, offset)
+    name, _ = unpack_str(buffer, offset + match_struct.size)
+    if stream == LEVEL:
+        return {"stream": "Level", "patient": id, "level": value}
+    return {"stream": "Classification", "patient": id, "class": name, "factors": value}
+
+def encode_state(patient):
+    category = patient.emergency_category if patient.category_factors else None
+    return state_struct.pack(patient.id, patient.emergency_level, patient.category_factors) + pack_str(category)
+
+def decode_state(buffer, offset):
+    id, level, factors = state_struct.unpack_from(buffer, offset)
+    category, _ = unpack_str(buffer, offset + state_struct.size)
+    return id, level, factors, category
+
+def frame(kind, payload):
+    return record_header.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+def records(buffer, offset):
+    # Yields (type, payload offset, end offset) until the end of the buffer or the first bad record
+    end = len(buffer)
+    while offset + record_header.size <= end:
+        kind, length, crc = record_header.unpack_from(buffer, offset)
+        start = offset + record_header.size
+        if start + length > end or zlib.crc32(buffer[start:start + length]) != crc:
+            return
+        yield kind, start, start + length
+        offset = start + length
+
+class Triage_log:
+    def __init__(self, directory, snapshot_every=10000, fsync=True):
+        self.directory = directory
+        self.wal_path = os.path.join(directory, "triage.wal")
+        self.snapshot_path = os.path.join(directory, "triage.snapshot")
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.generation = 0
+        self.records_since_snapshot = 0
+        self.wal = None
+        os.makedirs(directory, exist_ok=True)
+
+    def recover(self, on_patient, on_symptoms, on_match, on_remove, on_state, on_discharge=None):
+        # Replays the snapshot and the log tail through the callbacks; returns the next free patient id.
+        next_patient_id = 0
+        snapshot_generation = 0
+
+        if os.path.exists(self.snapshot_path) and os.path.getsize(self.snapshot_path) >= file_header.size + snapshot_header.size:
+            with open(self.snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                magic, snapshot_generation = file_header.unpack_from(buffer, 0)
+                if magic != snapshot_magic:
+                    raise LogError(self.snapshot_path + " is not a triage snapshot")
+                next_patient_id, count = snapshot_header.unpack_from(buffer, file_header.size)
+                seen = 0
+                for kind, start, _ in records(buffer, file_header.size + snapshot_header.size):
+                    next_patient_id = max(next_patient_id, self._dispatch(buffer, kind, start, on_patient, on_symptoms, on_match, on_remove, on_state, on_discharge))
+                    seen += 1
+                if seen != count:
+                    raise LogError(self.snapshot_path + " is truncated")
+
+        self.generation = snapshot_generation
+        end = None
+        if os.path.exists(self.wal_path) and os.path.getsize(self.wal_path) >= file_header.size:
+            with open(self.wal_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                magic, generation = file_header.unpack_from(buffer, 0)
+                if magic != wal_magic:
+                    raise LogError(self.wal_path + " is not a triage log")
+                # An older log is already covered by the snapshot (crash right after writing it)
+                if generation == snapshot_generation:
+                    end = file_header.size
+                    for kind, start, record_end in records(buffer, file_header.size):
+                        next_patient_id = max(next_patient_id, self._dispatch(buffer, kind, start, on_patient, on_symptoms, on_match, on_remove, on_state, on_discharge))
+                        self.records_since_snapshot += 1
+                        end = record_end
+
+        if end is None:
+            self._start_wal()
+        else:
+            self.wal = open(self.wal_path, "r+b")
+            self.wal.truncate(end) # Drop a torn tail
+            self.wal.seek(end)
+        return next_patient_id
+
+    @staticmethod
+    def _dispatch(buffer, kind, start, on_patient, on_symptoms, on_match, on_remove, on_state, on_discharge):
+        if kind == PATIENT:
+            fields = decode_patient(buffer, start)
+            on_patient(fields)
+            return fields["id"] + 1
+        if kind == SYMPTOMS:
+            on_symptoms(*decode_symptoms(buffer, start))
+        elif kind == MATCH:
+            on_match(decode_match(buffer, start))
+        elif kind == REMOVE:
+            on_remove(id_struct.unpack_from(buffer, start)[0])
+        elif kind == STATE:
+            on_state(*decode_state(buffer, start))
+        elif kind == DISCHARGE and on_discharge:
+            on_discharge(*discharge_struct.unpack_from(buffer, start))
+        return 0
+
+    def _start_wal(self):
+        if self.wal:
+            self.wal.close()
+        tmp = self.wal_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(file_header.pack(wal_magic, self.generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.wal_path)
+        self.wal = open(self.wal_path, "r+b")
+        self.wal.seek(0, os.SEEK_END)
+        self.records_since_snapshot = 0
+
+    def _append(self, kind, payload):
+        self.wal.write(frame(kind, payload))
+        self.records_since_snapshot += 1
+
+    def log_patient(self, patient):
+        self._append(PATIENT, encode_patient(patient))
+
+    def log_symptoms(self, id, symptoms, published):
+        self._append(SYMPTOMS, encode_symptoms(id, symptoms, published))
+
+    def log_match(self, pattern):
+        self._append(MATCH, encode_match(pattern))
+
+    def log_remove(self, id):
+        self._append(REMOVE, id_struct.pack(id))
+
+    def log_discharge(self, id, deadline):
+        self._append(DISCHARGE, discharge_struct.pack(id, deadline))
+
+    def commit(self):
+        self.wal.flush()
+        if self.fsync:
+            os.fsync(self.wal.fileno())
+
+    def snapshot_due(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, units, next_patient_id, discharges=()):
+        # units: Patient_unit-like objects (patient, symptoms, published); discharges: [(id, deadline)]
+        self.commit()
+        body = []
+        for unit in units:
+            body.append(frame(PATIENT, encode_patient(unit.patient)))
+            body.append(frame(SYMPTOMS, encode_symptoms(unit.patient.id, unit.symptoms, unit.published)))
+            body.append(frame(STATE, encode_state(unit.patient)))
+        for id, deadline in discharges:
+            body.append(frame(DISCHARGE, discharge_struct.pack(id, deadline)))
+
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(file_header.pack(snapshot_magic, self.generation + 1))
+            f.write(snapshot_header.pack(next_patient_id, len(body)))
+            f.write(b"".join(body))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+        self.generation += 1
+        self._start_wal()
+
+    def close(self):
+        if self.wal:
+            self.commit()
+            self.wal.close()
+            self.wal = None
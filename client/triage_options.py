@@ -0,0 +1,81 @@
+# Options offered by the edit panel: display label -> value published to the CEP engine.
+
+# These symptoms are only for mental, palpitations, asthma, allergy and diarrhea and vomit emergencies. The complete list of symptoms is in the Manchester Triage handbook.
+specific_symptoms = {
+    "High risk of self-harm": "self-harm high risk",
+    "High risk of harming others": "other-harm high risk",
+    "Violence": "violence",
+    "Moderate risk of self-harm": "self-harm moderate risk",
+    "Moderate risk of harming others": "other-harm moderate risk",
+    "Significant distress": "significant distress",
+    "Significant psychiatric history": "significant psychiatric history",
+    "Agressive demeanor": "agressive demeanor",
+    "Crying easily": "crying easily",
+    "Recent risk of self-harm": "recent self-harm risk",
+    "Recent risk of harming others": "recent other-harm risk",
+    "Moderate distress": "moderate distress",
+    "Disruptive demeanor": "disruptive demeanor",
+    "Crying": "crying",
+    "Abnormal pulse": "abnormal pulse",
+    "Intoxication history": "intoxication history",
+    "Chest pain": "chest pain",
+    "Palpitations": "palpitations",
+    "Significant cardiac history": "significant cardiac history",
+    "Relative cardiac history": "relative cardiac history",
+    "Difficulty speaking": "difficulty speaking",
+    "Significant respiratory history": "significant respiratory history",
+    "Sunken ribs": "sunken ribs",
+    "Ineffective medication": "ineffective medication",
+    "Nostril flare": "nostril flare",
+    "Dry cough": "dry cough",
+    "Wet cough": "wet cough",
+    "Swollen face": "swollen face",
+    "Skin rash": "skin rash",
+    "Swollen hands": "swollen hands",
+    "Localized swelling": "localized swelling",
+    "Recent swelling": "recent swelling",
+    "Severe thirst": "severe thirst",
+    "Slenderness": "slenderness",
+    "Blood vomit": "blood vomit",
+    "Rectal bleeding leakage": "rectal bleeding leakage",
+    "Blood vomit history": "blood vomit history",
+    "Red or black deposition": "red or black deposition",
+    "Dehydration signs": "dehydration signs",
+    "Frequent deposition": "frequent deposition",
+    "Vomiting": "vomiting",
+    "Anorexia": "anorexia",
+    "Nausea": "nausea",
+    "Thrist": "thrist",
+    "Abdominal pain": "abdominal pain"
+}
+
+life_threat_options = {
+    "-": None,
+    "Shock": 2,
+    "Compromised": 0,
+    "Inadequate": 1,
+    "Difficult": 3
+}
+
+consciousness_options = {
+    "-": None,
+    "Fitting": 0,
+    "Unresponsive": 1,
+    "Alt. Responsive": 2,
+    "History": 3
+}
+
+haemorrhage_options = {
+    "-": None,
+    "Extreme": 0,
+    "Major": 1,
+    "Minor": 2
+}
+
+pain_level_options = {
+    "-": None,
+    "Severe": 0,
+    "Moderate": 1,
+    "Mild Pain": 2,
+    "Mild Itch": 3
+}
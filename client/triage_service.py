@@ -0,0 +1,453 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import triage_options
+import symptom_registry
+from triage_core import Triage_core
+from triage_log import Triage_log
+from metrics import Metrics, Prometheus_exporter
+from cep_manager import Cep_manager, ConnectionError, connection_factory
+from broker_pool import Connection_pool, parse_endpoints
+from stations import Station_routing, StationError
+from retention import Retention, Retention_policy, Patient_archive, reasons
+
+# Headless triage: the same Triage_core as the Tk client behind an asyncio HTTP/1.1 JSON API, for
+# registration kiosks and ambulance feeds.
+#
+#   POST   /patients        {"ssn", "age", "sex": "Male"|"Female", "longitude", "latitude"} or a list of them
+#                           -> {"ids": [...]}
+#   POST   /symptoms        [{"patient": id, "life_threat", "consciousness", "haemorrhage", "pain_level",
+#                           "temperature", "specific": [...]}, ...], missing fields are left as they are
+#                           -> {"results": [{"patient", "ok"} or {"patient", "error"}]}; 400 when an id
+#                           is not an integer
+#   GET    /patients        ?order=id|urgency&offset=0&limit=100
+#   GET    /patients/near   ?latitude=&longitude= and radius_km= for every patient in range, or k= (default 1)
+#                           for the nearest ones; min_level= to skip the less urgent. Patients without
+#                           coordinates and discharged ones are left out
+#                           -> {"patients": [patient with "distance_km"], nearest first}
+#   GET    /patients/<id>
+#   DELETE /patients/<id>
+#   POST   /patients/<id>/discharge   Archived and removed by the retention policy (see retention.py), at once
+#                           without one
+#   GET    /events          Server-sent events: "update" with the patient's level and classification after
+#                           every match, "removed" when a patient goes (with the reason when it expired);
+#                           ?patients=1,2 to follow only some
+#
+# Everything runs on the event loop thread; matches are queued by the subscriber thread and applied every
+# refresh_ms like the Tk client does. Each bulk request is published as one CEP batch and committed to the
+# triage log once. Every event stream has a bounded queue and a client that falls that far behind is
+# disconnected rather than slowing the others down.
+
+max_body = 8 * 1024 * 1024
+
+status_text = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class Http_error(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+def option_values(options):
+    return {value for value in options.values() if value is not None}
+
+symptom_fields = {
+    "life_threat": option_values(triage_options.life_threat_options),
+    "consciousness": option_values(triage_options.consciousness_options),
+    "haemorrhage": option_values(triage_options.haemorrhage_options),
+    "pain_level": option_values(triage_options.pain_level_options),
+}
+
+def text_field(value):
+    return "" if value is None else str(value)
+
+def update_symptoms(symptoms, data):
+    # Validates everything before touching the symptoms, so a bad item changes nothing
+    changes = dict()
+    for key, allowed in symptom_fields.items():
+        if key in data:
+            if data[key] is not None and data[key] not in allowed:
+                raise Http_error(400, "Invalid " + key + " " + repr(data[key]))
+            changes[key] = data[key]
+    if "temperature" in data:
+        try:
+            changes["temperature"] = None if data["temperature"] is None else round(float(data["temperature"]), 1)
+        except (TypeError, ValueError):
+            raise Http_error(400, "Invalid temperature " + repr(data["temperature"]))
+    if "specific" in data:
+        specific = data["specific"] or []
+        if not isinstance(specific, list) or any(name not in symptom_registry.shared() for name in specific):
+            raise Http_error(400, "Invalid specific symptoms " + repr(specific))
+        changes["specific"] = list(dict.fromkeys(specific))
+    for key, value in changes.items():
+        setattr(symptoms, key, value)
+
+def patient_json(unit):
+    patient = unit.patient
+    symptoms = unit.symptoms
+    return {
+        "id": patient.id,
+        "ssn": patient.ssn or None,
+        "age": patient.age or None,
+        "sex": patient.get_sex(),
+        "longitude": patient.longitude or None,
+        "latitude": patient.latitude or None,
+        "level": patient.emergency_level,
+        "classification": str(patient.emergency_category) if patient.category_factors else None,
+        "factors": patient.category_factors,
+        "symptoms": {
+            "life_threat": symptoms.life_threat,
+            "consciousness": symptoms.consciousness,
+            "haemorrhage": symptoms.haemorrhage,
+            "pain_level": symptoms.pain_level,
+            "temperature": symptoms.temperature,
+            "specific": list(symptoms.specific),
+        },
+    }
+
+def update_json(unit):
+    patient = unit.patient
+    return {"patient": patient.id, "level": patient.emergency_level, "classification": str(patient.emergency_category) if patient.category_factors else None, "factors": patient.category_factors}
+
+def sse(event, data):
+    return ("event: " + event + "\ndata: " + json.dumps(data) + "\n\n").encode("utf-8")
+
+class Stream:
+    def __init__(self, patients, size):
+        self.patients = patients # None for all
+        self.queue = asyncio.Queue(size)
+        self.closed = False
+
+class Triage_service:
+    refresh_ms = 16
+    expire_seconds = 1.0
+    heartbeat = 15.0
+
+    def __init__(self, core, stream_queue_size=1000):
+        self.core = core
+        self.cep_manager = core.cep_manager
+        self.stream_queue_size = stream_queue_size
+        self.streams = set()
+        self.server = None
+
+    async def serve(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        drain = asyncio.ensure_future(self.drain_loop())
+        print("Triage service listening on http://" + host + ":" + str(port))
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            drain.cancel()
+
+    async def drain_loop(self):
+        expire_at = 0.0
+        while True:
+            await asyncio.sleep(self.refresh_ms / 1000)
+            if self.cep_manager.batch_interval:
+                self.cep_manager.flush_due()
+            if self.core.retention is not None and time.monotonic() >= expire_at:
+                self.expire()
+                expire_at = time.monotonic() + self.expire_seconds
+            patterns = self.core.drain()
+            if not patterns:
+                continue
+            ids = list(dict.fromkeys(int(pattern["patient"]) for pattern in patterns))
+            for id in ids:
+                unit = self.core.patients.get(id)
+                if unit is not None:
+                    self.broadcast(id, sse("update", update_json(unit)))
+            self.cep_manager.patterns_displayed(ids)
+
+    def expire(self):
+        for id, reason in self.core.expire():
+            self.broadcast(id, sse("removed", {"patient": id, "reason": reasons[reason]}))
+
+    def broadcast(self, id, message):
+        for stream in list(self.streams):
+            if stream.patients is not None and id not in stream.patients:
+                continue
+            try:
+                stream.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow to keep up: drop the client instead of buffering without bound
+                stream.closed = True
+                self.streams.discard(stream)
+                stream.queue.get_nowait()
+                stream.queue.put_nowait(None)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body, keep_alive = request
+                url = urlsplit(target)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+                if method == "GET" and url.path == "/events":
+                    await self.stream(writer, query)
+                    break
+
+                try:
+                    status, payload = self.route(method, url.path, query, body)
+                except Http_error as e:
+                    status, payload = e.status, {"error": str(e)}
+                except StationError as e:
+                    status, payload = 503, {"error": str(e)}
+                except Exception as e:
+                    print("Request " + method + " " + url.path + " failed: " + repr(e))
+                    status, payload = 500, {"error": "Internal error"}
+                self.respond(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        except Http_error as e:
+            self.respond(writer, e.status, {"error": str(e)}, False)
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise Http_error(400, "Malformed request line")
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            raise Http_error(400, "Invalid Content-Length")
+        if length < 0:
+            raise Http_error(400, "Invalid Content-Length")
+        if length > max_body:
+            raise Http_error(413, "Body larger than " + str(max_body) + " bytes")
+        body = await reader.readexactly(length) if length else b""
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method, target, headers, body, keep_alive
+
+    def respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode("utf-8")
+        head = "HTTP/1.1 " + str(status) + " " + status_text.get(status, "") + "\r\nContent-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\n"
+        head += ("Connection: keep-alive" if keep_alive else "Connection: close") + "\r\n\r\n"
+        writer.write(head.encode("latin-1") + body)
+
+    def route(self, method, path, query, body):
+        parts = [part for part in path.split("/") if part]
+        if parts == ["patients"]:
+            if method == "POST":
+                return 201, self.create_patients(self.parse(body))
+            if method == "GET":
+                return 200, self.list_patients(query)
+        elif parts == ["patients", "near"]:
+            if method == "GET":
+                return 200, self.near_patients(query)
+        elif len(parts) == 2 and parts[0] == "patients":
+            id = self.patient_id(parts[1])
+            if method == "GET":
+                return 200, patient_json(self.core.patients[id])
+            if method == "DELETE":
+                self.core.remove_patient(id)
+                self.core.commit()
+                self.broadcast(id, sse("removed", {"patient": id}))
+                return 200, {"removed": id}
+        elif len(parts) == 3 and parts[0] == "patients" and parts[2] == "discharge":
+            id = self.patient_id(parts[1])
+            if method == "POST":
+                self.core.discharge(id)
+                self.core.commit()
+                if id not in self.core.patients:
+                    self.broadcast(id, sse("removed", {"patient": id}))
+                else:
+                    self.expire()
+                return 200, {"discharged": id}
+        elif parts == ["symptoms"]:
+            if method == "POST":
+                return 200, self.post_symptoms(self.parse(body))
+        else:
+            raise Http_error(404, "No such endpoint " + path)
+        raise Http_error(405, method + " not allowed on " + path)
+
+    @staticmethod
+    def parse(body):
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise Http_error(400, "Body is not valid JSON")
+
+    def patient_id(self, text):
+        try:
+            id = int(text)
+        except ValueError:
+            raise Http_error(400, "Invalid patient id " + repr(text))
+        if id not in self.core.patients:
+            raise Http_error(404, "Patient " + str(id) + " not found")
+        return id
+
+    def create_patients(self, data):
+        items = data if isinstance(data, list) else [data]
+        for item in items:
+            if not isinstance(item, dict) or item.get("sex", "Male") not in ("Male", "Female"):
+                raise Http_error(400, "Invalid patient " + repr(item))
+            if item.get("age") is not None and not str(item["age"]).isdigit():
+                raise Http_error(400, "Invalid age " + repr(item["age"]))
+        ids = []
+        with self.cep_manager.batch():
+            for item in items:
+                patient = self.core.add_patient(ssn=text_field(item.get("ssn")), age=text_field(item.get("age")), is_male=item.get("sex", "Male") == "Male",
+                                                longitude=text_field(item.get("longitude")), latitude=text_field(item.get("latitude")))
+                ids.append(patient.id)
+        self.core.commit()
+        return {"ids": ids}
+
+    def post_symptoms(self, data):
+        items = data if isinstance(data, list) else [data]
+        for item in items:
+            # JSON true is an int to Python, and a float would index the store's columns
+            id = item.get("patient") if isinstance(item, dict) else None
+            if isinstance(id, bool) or not isinstance(id, int):
+                raise Http_error(400, "Invalid patient id " + repr(id))
+        results = []
+        with self.cep_manager.batch():
+            for item in items:
+                id = item["patient"]
+                try:
+                    if id not in self.core.patients:
+                        raise Http_error(404, "Patient " + str(id) + " not found")
+                    update_symptoms(self.core.patients[id].symptoms, item)
+                    self.core.submit_symptoms(id)
+                    results.append({"patient": id, "ok": True})
+                except Http_error as e:
+                    results.append({"patient": id, "error": str(e)})
+        self.core.commit()
+        return {"results": results}
+
+    def list_patients(self, query):
+        order = self.core.priority if query.get("order") == "urgency" else self.core.id_order
+        try:
+            offset = max(0, int(query.get("offset", 0)))
+            limit = max(0, int(query.get("limit", 100)))
+        except ValueError:
+            raise Http_error(400, "Invalid offset or limit")
+        end = min(len(order), offset + limit)
+        return {"total": len(order), "patients": [patient_json(self.core.patients[order.at(k)]) for k in range(offset, end)]}
+
+    def near_patients(self, query):
+        try:
+            latitude, longitude = float(query["latitude"]), float(query["longitude"])
+            radius = float(query["radius_km"]) if "radius_km" in query else None
+            k = int(query.get("k", 1))
+            min_level = int(query["min_level"]) if "min_level" in query else None
+        except (KeyError, ValueError):
+            raise Http_error(400, "Expected latitude, longitude and a numeric radius_km, k or min_level")
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise Http_error(400, "Invalid coordinates")
+        if radius is not None:
+            found = self.core.spatial.within(latitude, longitude, radius, min_level)
+        else:
+            found = self.core.spatial.nearest(latitude, longitude, k, min_level)
+        return {"patients": [dict(patient_json(self.core.patients[id]), distance_km=round(distance, 3)) for distance, id in found]}
+
+    async def stream(self, writer, query):
+        patients = None
+        if query.get("patients"):
+            try:
+                patients = {int(id) for id in query["patients"].split(",")}
+            except ValueError:
+                raise Http_error(400, "Invalid patients filter")
+        stream = Stream(patients, self.stream_queue_size)
+        self.streams.add(stream)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+        try:
+            await writer.drain()
+            while not stream.closed:
+                try:
+                    message = await asyncio.wait_for(stream.queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    message = b": keep-alive\n\n"
+                if message is None:
+                    break
+                # Send whatever else is already queued along with it
+                while not stream.queue.empty():
+                    more = stream.queue.get_nowait()
+                    if more is None:
+                        stream.closed = True
+                        break
+                    message += more
+                writer.write(message)
+                await writer.drain()
+        finally:
+            self.streams.discard(stream)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emergency Triage HTTP service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--local", action="store_true", help="Match the patterns with the in-process CEP engine instead of RabbitMQ")
+    parser.add_argument("--batch-size", type=int, default=None, help="Publish events in batches of this many events")
+    parser.add_argument("--batch-interval", type=float, default=None, help="Publish pending events at least every this many seconds (0.05 with only --batch-size)")
+    parser.add_argument("--envelope", action="store_true", help="Pack each batch of events into a single AMQP message")
+    parser.add_argument("--blocking-publish", action="store_true", help="Publish on the event loop thread instead of the background I/O thread")
+    parser.add_argument("--publish-queue-size", type=int, default=10000, help="Capacity of the background publish queue")
+    parser.add_argument("--overflow", choices=["block", "drop_newest", "drop_oldest", "raise"], default="block", help="What to do when the background publish queue is full (drops are counted and reported)")
+    parser.add_argument("--state-dir", default=None, help="Keep a write-ahead log and snapshots of the triage state in this directory and restore it on start")
+    parser.add_argument("--stream-queue-size", type=int, default=1000, help="Updates buffered per event stream before a slow client is dropped")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this port")
+    parser.add_argument("--station", type=int, default=None, help="Station number when several stations share the CEP engine")
+    parser.add_argument("--partitions", type=int, default=1, help="Number of CEP partitions (with --station)")
+    parser.add_argument("--binary", action="store_true", help="Publish the events in the compact binary wire format instead of JSON")
+    parser.add_argument("--brokers", default=None, help="RabbitMQ endpoints to fail over between, host[:port],... (the default server otherwise)")
+    parser.add_argument("--retry-buffer-size", type=int, default=10000, help="Messages kept in memory while RabbitMQ is unreachable")
+    parser.add_argument("--retry-file", default=None, help="Spill the messages that do not fit the retry buffer to this file, and keep them across restarts")
+    parser.add_argument("--prefetch", type=int, default=None, help="Matches in flight from RabbitMQ, acked in batches once handled (default: ack each on arrival)")
+    parser.add_argument("--ack-batch", type=int, default=100, help="Matches per ack with --prefetch")
+    parser.add_argument("--retention-hours", type=float, default=None, help="Archive and remove patients idle for this many hours (8 matches the CEP windows)")
+    parser.add_argument("--max-patients", type=int, default=None, help="Archive and remove the least recently active patients past this many")
+    parser.add_argument("--discharge-grace", type=float, default=0.0, help="Seconds a discharged patient stays before it is archived")
+    parser.add_argument("--archive", default=None, help="Append the expired patients to this file (default: patients.archive in --state-dir)")
+    args = parser.parse_args()
+
+    triage_log = Triage_log(args.state_dir) if args.state_dir else None
+    metrics = Metrics() if args.metrics_port else None
+    exporter = Prometheus_exporter(metrics, args.metrics_port) if args.metrics_port else None
+    routing = Station_routing(args.station, args.partitions) if args.station is not None else None
+    connect = Connection_pool(parse_endpoints(args.brokers)).connect if args.brokers else connection_factory
+    retention, archive = None, None
+    if args.retention_hours is not None or args.max_patients is not None:
+        retention = Retention(Retention_policy(args.retention_hours * 3600 if args.retention_hours is not None else None, args.max_patients, args.discharge_grace))
+        archive_path = args.archive or (os.path.join(args.state_dir, "patients.archive") if args.state_dir else None)
+        archive = Patient_archive(archive_path) if archive_path else None
+
+    try:
+        with Cep_manager(local=args.local, batch_size=args.batch_size, batch_interval=args.batch_interval, envelope=args.envelope,
+                         async_publish=not args.blocking_publish, publish_queue_size=args.publish_queue_size, overflow=args.overflow, metrics=metrics, routing=routing, binary=args.binary, connect=connect, retry_buffer_size=args.retry_buffer_size, retry_path=args.retry_file, prefetch=args.prefetch, ack_batch=args.ack_batch) as cep_manager:
+            core = Triage_core(cep_manager, triage_log, retention, archive)
+            service = Triage_service(core, args.stream_queue_size)
+            if metrics:
+                metrics.gauge("service_event_streams", lambda: len(service.streams))
+            try:
+                asyncio.run(service.serve(args.host, args.port))
+            except KeyboardInterrupt:
+                pass
+            core.close()
+    except ConnectionError:
+            print("Could not connect to RabbitMQ. Please start the server and try again.")
+            exit()
+    finally:
+        if exporter:
+            exporter.close()
@@ -0,0 +1,27 @@
+from collections import deque
+
+# Hands CEP matches from the subscriber thread to the Tk thread. put() is a deque append, which is atomic
+# in CPython, so the subscriber never takes a lock. The Tk loop drains the queue on a timer, and matches
+# for the same patient and stream (and class) are merged on the way out: the latest one wins, as the
+# engine reports the current level and factors, which go down again when symptoms are retracted.
+
+class Coalescing_queue:
+    def __init__(self):
+        self.items = deque()
+
+    def put(self, pattern):
+        self.items.append(pattern)
+
+    def __len__(self):
+        return len(self.items)
+
+    def drain(self):
+        merged = dict()
+        popleft = self.items.popleft
+        while True:
+            try:
+                pattern = popleft()
+            except IndexError:
+                break
+            merged[(int(pattern["patient"]), pattern["stream"], pattern.get("class"))] = pattern
+        return list(merged.values())
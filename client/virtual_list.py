@@ -0,0 +1,176 @@
+import customtkinter as ctk
+
+from fenwick import Fenwick, capacity_for
+
+class Id_order:
+    # Ids in ascending order over a Fenwick tree of slots: insert, remove, position and k-th lookup are
+    # O(log n). Ids normally arrive in increasing order (next_patient_id) and just take the next slot.
+    def __init__(self, ids=()):
+        self.rebuild(sorted(ids))
+
+    def rebuild(self, ids):
+        self.ids = list(ids) # slot: id, None once removed
+        self.max_id = self.ids[-1] if self.ids else None
+        self.slot_of = {id: slot for slot, id in enumerate(self.ids)}
+        self.tree = Fenwick(capacity_for(len(self.ids)))
+        for slot in range(len(self.ids)):
+            self.tree.update(slot + 1, 1)
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, id):
+        return id in self.slot_of
+
+    def add(self, id):
+        if id in self.slot_of:
+            return
+        if self.max_id is not None and id < self.max_id:
+            self.rebuild(sorted(list(self.slot_of) + [id]))
+            return
+        self.max_id = id
+        if len(self.ids) >= self.tree.capacity:
+            self.rebuild([i for i in self.ids if i is not None] + [id])
+            return
+        self.slot_of[id] = len(self.ids)
+        self.ids.append(id)
+        self.tree.update(len(self.ids), 1)
+
+    def remove(self, id):
+        slot = self.slot_of.pop(id, None)
+        if slot is None:
+            return
+        self.ids[slot] = None
+        self.tree.update(slot + 1, -1)
+        # Keep the slot array dense enough that tombstones never dominate
+        if len(self.ids) > 64 and len(self.slot_of) < len(self.ids) // 4:
+            self.rebuild([i for i in self.ids if i is not None])
+
+    def index(self, id):
+        return self.tree.prefix(self.slot_of[id] + 1) - 1
+
+    def at(self, k):
+        # Id at position k (0-based)
+        if not 0 <= k < len(self.slot_of):
+            raise IndexError(k)
+        return self.ids[self.tree.find(k + 1) - 1]
+
+class Row:
+    # A pooled row of widgets. set_text/set_option only touch Tk when the value actually changes.
+    def __init__(self, widgets):
+        self.widgets = widgets
+        self.id = None
+        self.cache = dict()
+
+    def set_text(self, column, text):
+        self.set_option(column, "text", text)
+
+    def set_option(self, column, option, value):
+        key = (column, option)
+        if self.cache.get(key) != value:
+            self.cache[key] = value
+            self.widgets[column].configure(**{option: value})
+
+class Virtual_list(ctk.CTkFrame):
+    # Only builds widgets for the rows that fit on screen and reuses them while scrolling.
+    # make_header(parent) and make_row(parent) -> [widgets, one per column]; fill_row(row, id) writes an id
+    # into a pooled row. The order (len, at, index) is owned by the caller, who calls redraw() after changing it.
+    def __init__(self, parent, make_header, make_row, fill_row, order=None, row_height=30, **kwargs):
+        ctk.CTkFrame.__init__(self, parent, **kwargs)
+        self.make_row = make_row
+        self.fill_row = fill_row
+        self.order = order if order is not None else Id_order()
+        self.row_height = row_height
+        self.first = 0
+        self.visible = 1
+        self.rows = []
+
+        self.grid_propagate(False)
+        header = make_header(self)
+        for column in range(len(header)):
+            self.grid_columnconfigure(column, weight=1)
+            header[column].grid(row=0, column=column, sticky="nsew")
+        self.columns = len(header)
+        self.header_height = header[0].winfo_reqheight() if header else 0
+
+        self.scrollbar = ctk.CTkScrollbar(self, orientation="vertical", command=self.yview)
+        self.scrollbar.grid(row=0, column=self.columns, rowspan=1, sticky="ns")
+
+        self.bind("<Configure>", self.on_configure)
+        self.bind_wheel(self)
+
+    def bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", self.on_mouse_wheel)
+        widget.bind("<Button-4>", lambda event: self.yview("scroll", -1, "units"))
+        widget.bind("<Button-5>", lambda event: self.yview("scroll", 1, "units"))
+
+    def on_mouse_wheel(self, event):
+        self.yview("scroll", -1 if event.delta > 0 else 1, "units")
+
+    def on_configure(self, event):
+        visible = max(1, (event.height - self.header_height) // self.row_height)
+        if visible != self.visible or not self.rows:
+            self.visible = visible
+            self.scrollbar.grid_configure(rowspan=visible + 1)
+            self.redraw()
+
+    def yview(self, *args):
+        total = len(self.order)
+        if args[0] == "moveto":
+            first = int(float(args[1]) * total)
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self.visible if args[2] == "pages" else 1)
+            first = self.first + step
+        else:
+            return
+        self.scroll_to(first)
+
+    def scroll_to(self, first):
+        self.first = max(0, min(first, len(self.order) - self.visible))
+        self.redraw()
+
+    def see(self, id):
+        index = self.order.index(id)
+        if index < self.first:
+            self.scroll_to(index)
+        elif index >= self.first + self.visible:
+            self.scroll_to(index - self.visible + 1)
+
+    def set_order(self, order):
+        self.order = order
+        self.redraw()
+
+    def refresh(self, id):
+        for row in self.rows:
+            if row.id == id:
+                self.fill_row(row, id)
+                return
+
+    def redraw(self):
+        total = len(self.order)
+        self.first = max(0, min(self.first, total - self.visible))
+        shown = min(self.visible, total - self.first)
+
+        while len(self.rows) < shown:
+            row = Row(self.make_row(self))
+            for widget in row.widgets:
+                self.bind_wheel(widget)
+            self.rows.append(row)
+
+        for i, row in enumerate(self.rows):
+            if i < shown:
+                id = self.order.at(self.first + i)
+                if row.id is None:
+                    for column, widget in enumerate(row.widgets):
+                        widget.grid(row=i + 1, column=column, sticky="nsew", padx=1 if column == 0 else 0, pady=1 if column == 0 else 0)
+                row.id = id
+                self.fill_row(row, id)
+            elif row.id is not None:
+                row.id = None
+                for widget in row.widgets:
+                    widget.grid_remove()
+
+        if total:
+            self.scrollbar.set(self.first / total, min(1.0, (self.first + self.visible) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
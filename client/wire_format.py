@@ -0,0 +1,286 @@
+import json
+import struct
+import zlib
+
+import mule_format
+from cep_engine import Cep_engine, default_schemas_dir, default_patterns_dir, event_type_aliases
+
+# Compact binary alternative to the JSON event bodies (and to the map format of the matches).
+#
+# Both ends build the same tables from the .epl files: event types are numbered in schema name order, and
+# every string constant of the patterns (symptom names, classes, streams) gets a small code. A message
+# starts with magic, kind, a checksum of those tables (so mismatched .epl files fail loudly instead of
+# decoding garbage) and an event count. An event is its type code and patient id, a bitmap of the
+# non-null fields and the fields in schema order: Integer i, Long q, Float f, Double d, Boolean ?, and
+# String as an interned code (H) or, for strings the patterns never mention, 0xFFFF plus the utf-8 text.
+# Bit 7 of the bitmap flags a trailing correlation id (I, see metrics.Latency_tracker).
+#
+# A temperature event is 11 bytes instead of about 70 of JSON; a symptom event 9 instead of about 75.
+#
+# Opt-in with Cep_manager(binary=True). Consumers tell the formats apart by the first byte (events_of(),
+# patterns_of()), so JSON and binary publishers can share the queues.
+
+magic = 0xCE
+EVENTS, MATCHES = 1, 2
+message_header = struct.Struct("<BBHH") # magic, kind, table checksum, count
+event_header = struct.Struct("<Bi") # type code, patient
+length_struct = struct.Struct("<H")
+cid_struct = struct.Struct("<I")
+escape = 0xFFFF
+cid_bit = 0x80
+
+field_codes = {"Integer": "i", "Long": "q", "Float": "f", "Double": "d", "Boolean": "?"}
+casts = {"i": int, "q": int, "f": float, "d": float, "?": bool}
+streams = ("Level", "Classification")
+
+class WireError(Exception):
+    pass
+
+def is_binary(body):
+    # JSON and map format bodies start with '{' or '['
+    return body[:1] == bytes((magic,))
+
+shared_format = None
+
+def shared():
+    # Built on first use, reading the .epl files takes a while
+    global shared_format
+    if shared_format is None:
+        shared_format = Wire_format()
+    return shared_format
+
+def events_of(body):
+    if is_binary(body):
+        return shared().decode_events(body)
+    events = json.loads(body)
+    return events if isinstance(events, list) else [events]
+
+def patterns_of(body):
+    if is_binary(body):
+        return shared().decode_matches(body)
+    return [mule_format.decode(body)["stmt0_out0"]]
+
+def string_constants(node, found):
+    if isinstance(node, tuple):
+        if len(node) == 2 and node[0] == "const" and isinstance(node[1], str):
+            if node[1] not in found:
+                found.append(node[1])
+            return found
+    if isinstance(node, (tuple, list)):
+        for child in node:
+            string_constants(child, found)
+    return found
+
+def float32(value):
+    # Floats travel as float32 (Float in the schemas); 7 significant digits bring back the value that was sent
+    return float("%.7g" % value)
+
+class Event_codec:
+    def __init__(self, code, name, fields, wire):
+        self.code = code
+        self.name = name
+        self.fields = [(field, field_type) for field, field_type in fields if field != "patient"]
+        if len(self.fields) > 7:
+            raise WireError(name + " has more than 7 fields")
+        self.wire = wire
+        self.all_present = (1 << len(self.fields)) - 1
+
+        # Fast path: every field present and fixed size (interned strings included) packs with one Struct
+        codes = ""
+        for field, field_type in self.fields:
+            codes += "H" if field_type == "String" else field_codes.get(field_type, "")
+        self.fixed = struct.Struct("<BiB" + codes) if len(codes) == len(self.fields) else None
+        self.fixed_cid = struct.Struct("<BiB" + codes + "I") if self.fixed else None
+        self.strings = [i for i, (field, field_type) in enumerate(self.fields) if field_type == "String"]
+        self.floats = [i for i, (field, field_type) in enumerate(self.fields) if field_type == "Float"]
+        self.names = [field for field, _ in self.fields]
+
+    def encode(self, event, out):
+        patient = event["patient"]
+        values = [event.get(field) for field, _ in self.fields]
+        cid = event.get("cid")
+        if self.fixed and None not in values:
+            codes = self.wire.string_codes
+            try:
+                for i in self.strings:
+                    values[i] = codes[values[i]]
+                if cid is None:
+                    out.append(self.fixed.pack(self.code, patient, self.all_present, *values))
+                else:
+                    out.append(self.fixed_cid.pack(self.code, patient, self.all_present | cid_bit, *values, cid))
+                return
+            except (KeyError, TypeError, struct.error):
+                # A string the patterns never mention, or a value that needs casting
+                values = [event.get(field) for field, _ in self.fields]
+
+        bitmap = 0
+        parts = []
+        for i, ((field, field_type), value) in enumerate(zip(self.fields, values)):
+            if value is None:
+                continue
+            if field_type == "String":
+                parts.append(self.wire.pack_string(value))
+            else:
+                # Cast like the engine's schema coercion does ("40.4" for a Float), unparsable values are null
+                code = field_codes[field_type]
+                try:
+                    parts.append(struct.pack("<" + code, casts[code](value)))
+                except (ValueError, TypeError, struct.error):
+                    continue
+            bitmap |= 1 << i
+        if cid is not None:
+            bitmap |= cid_bit
+            parts.append(cid_struct.pack(cid))
+        out.append(event_header.pack(self.code, patient) + bytes((bitmap,)) + b"".join(parts))
+
+    def decode(self, body, offset):
+        bitmap = body[offset + event_header.size]
+        if self.fixed and bitmap & ~cid_bit == self.all_present:
+            fixed = self.fixed_cid if bitmap & cid_bit else self.fixed
+            values = list(fixed.unpack_from(body, offset))
+            cid = values.pop() if bitmap & cid_bit else None
+            patient = values[1]
+            values = values[3:]
+            # An escaped string has its text inline, only the generic path below reads that
+            if escape not in [values[i] for i in self.strings]:
+                for i in self.strings:
+                    values[i] = self.wire.strings[values[i]]
+                for i in self.floats:
+                    values[i] = float32(values[i])
+                event = {"eventTypeName": self.name, "patient": patient}
+                event.update(zip(self.names, values))
+                if cid is not None:
+                    event["cid"] = cid
+                return event, offset + fixed.size
+
+        _, patient = event_header.unpack_from(body, offset)
+        offset += event_header.size
+        bitmap = body[offset]
+        offset += 1
+        event = {"eventTypeName": self.name, "patient": patient}
+        for i, (field, field_type) in enumerate(self.fields):
+            if not bitmap & (1 << i):
+                event[field] = None
+            elif field_type == "String":
+                event[field], offset = self.wire.unpack_string(body, offset)
+            else:
+                code = field_codes[field_type]
+                (value,) = struct.unpack_from("<" + code, body, offset)
+                offset += struct.calcsize(code)
+                event[field] = float32(value) if code == "f" else value
+        if bitmap & cid_bit:
+            (event["cid"],) = cid_struct.unpack_from(body, offset)
+            offset += cid_struct.size
+        return event, offset
+
+class Wire_format:
+    def __init__(self, schemas_dir=default_schemas_dir, patterns_dir=default_patterns_dir):
+        schemas = {statement[1]: statement[2] for statement in Cep_engine.load_dir(schemas_dir) if statement[0] == "schema"}
+        self.strings = string_constants(Cep_engine.load_dir(patterns_dir), [])
+        for stream in streams:
+            if stream not in self.strings:
+                self.strings.append(stream)
+        self.string_codes = {name: i for i, name in enumerate(self.strings)}
+
+        self.codecs = dict() # event type: Event_codec
+        self.by_code = dict() # code: Event_codec
+        for code, name in enumerate(sorted(schemas), start=1):
+            codec = Event_codec(code, name, schemas[name], self)
+            self.codecs[name] = codec
+            self.by_code[code] = codec
+        for alias, name in event_type_aliases.items():
+            if name in self.codecs:
+                self.codecs[alias] = self.codecs[name]
+
+        tables = "|".join(sorted(schemas)) + "#" + "|".join(self.strings)
+        self.checksum = zlib.crc32(tables.encode("utf-8")) & 0xFFFF
+
+    def pack_string(self, value):
+        code = self.string_codes.get(value)
+        if code is not None:
+            return length_struct.pack(code)
+        data = str(value).encode("utf-8")
+        return length_struct.pack(escape) + length_struct.pack(len(data)) + data
+
+    def unpack_string(self, body, offset):
+        (code,) = length_struct.unpack_from(body, offset)
+        offset += length_struct.size
+        if code != escape:
+            return self.strings[code], offset
+        (length,) = length_struct.unpack_from(body, offset)
+        offset += length_struct.size
+        return bytes(body[offset:offset + length]).decode("utf-8"), offset + length
+
+    def header(self, kind, count):
+        return message_header.pack(magic, kind, self.checksum, count)
+
+    def check_header(self, body, kind):
+        if len(body) < message_header.size:
+            raise WireError("Message too short")
+        first, found, checksum, count = message_header.unpack_from(body, 0)
+        if first != magic or found != kind:
+            raise WireError("Not a binary " + ("event" if kind == EVENTS else "match") + " message")
+        if checksum != self.checksum:
+            raise WireError("Message built from different .epl files (checksum " + hex(checksum) + ", expected " + hex(self.checksum) + ")")
+        return count
+
+    def encode_events(self, events):
+        out = [self.header(EVENTS, len(events))]
+        for event in events:
+            codec = self.codecs.get(event["eventTypeName"])
+            if codec is None:
+                raise WireError("Unknown event type " + event["eventTypeName"])
+            codec.encode(event, out)
+        return b"".join(out)
+
+    def decode_events(self, body):
+        count = self.check_header(body, EVENTS)
+        offset = message_header.size
+        events = []
+        try:
+            for _ in range(count):
+                codec = self.by_code.get(body[offset])
+                if codec is None:
+                    raise WireError("Unknown event type code " + str(body[offset]))
+                event, offset = codec.decode(body, offset)
+                events.append(event)
+        except (struct.error, IndexError) as e:
+            raise WireError("Truncated event message") from e
+        return events
+
+    # Matches: stream code (B), patient (i), then the level (i), or the factors (i) and the class (string),
+    # then the source (string, empty for none). A retracted level comes back as 0 instead of null.
+
+    def encode_matches(self, patterns):
+        out = [self.header(MATCHES, len(patterns))]
+        for pattern in patterns:
+            stream = pattern["stream"]
+            if stream == "Level":
+                out.append(struct.pack("<Bii", 0, int(pattern["patient"]), int(pattern["level"] or 0)))
+            elif stream == "Classification":
+                out.append(struct.pack("<Bii", 1, int(pattern["patient"]), int(pattern["factors"] or 0)) + self.pack_string(pattern["class"]))
+            else:
+                raise WireError("Unknown match stream " + repr(stream))
+            out.append(self.pack_string(pattern.get("source") or ""))
+        return b"".join(out)
+
+    def decode_matches(self, body):
+        count = self.check_header(body, MATCHES)
+        offset = message_header.size
+        patterns = []
+        try:
+            for _ in range(count):
+                stream, patient, value = struct.unpack_from("<Bii", body, offset)
+                offset += 9
+                if stream == 0:
+                    patterns.append({"stream": "Level", "patient": patient, "level": value})
+                elif stream == 1:
+                    name, offset = self.unpack_string(body, offset)
+                    patterns.append({"stream": "Classification", "patient": patient, "class": name, "factors": value})
+                else:
+                    raise WireError("Unknown match stream code " + str(stream))
+                source, offset = self.unpack_string(body, offset)
+                patterns[-1]["source"] = source or None
+        except (struct.error, IndexError) as e:
+            raise WireError("Truncated match message") from e
+        return patterns
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The client modules import each other by their flat names, as when run from the client directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "client"))
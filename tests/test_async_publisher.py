@@ -0,0 +1,105 @@
+import time
+from threading import Event, Thread
+
+import pytest
+
+from cep_manager import Async_publisher, PublishOverflow
+from fake_broker import Fake_broker
+
+class Stalled_broker:
+    # A fake broker whose channels hang in basic_publish until release(), like a broker applying flow control
+    def __init__(self):
+        self.broker = Fake_broker()
+        self.flowing = Event()
+        self.stuck = Event() # Set once a publish is waiting
+
+    def connect(self):
+        connection, channel = self.broker.connection_factory()
+        basic_publish = channel.basic_publish
+        def publish(*args, **kwargs):
+            self.stuck.set()
+            self.flowing.wait()
+            basic_publish(*args, **kwargs)
+        channel.basic_publish = publish
+        return connection, channel
+
+    def release(self):
+        self.flowing.set()
+
+    def received(self):
+        bodies = []
+        while self.broker.depth("Messages"):
+            bodies.append(self.broker.get("Messages", 0)[0])
+        return bodies
+
+def body(n):
+    return str(n).encode("ascii")
+
+def stalled(overflow, block_timeout=None):
+    # An Async_publisher with one message stuck on the broker and its queue of two full behind it
+    broker = Stalled_broker()
+    publisher = Async_publisher(maxsize=2, overflow=overflow, block_timeout=block_timeout, connect=broker.connect)
+    publisher.publish("Messages", [body(1)])
+    assert broker.stuck.wait(5)
+    assert publisher.publish("Messages", [body(2)]) and publisher.publish("Messages", [body(3)])
+    return broker, publisher
+
+def finish(broker, publisher, timeout=5.0):
+    broker.release()
+    deadline = time.monotonic() + timeout
+    while publisher.metrics()["published"] + publisher.metrics()["dropped"] < publisher.enqueued and time.monotonic() < deadline:
+        time.sleep(0.01)
+    publisher.close()
+    return broker.received()
+
+def test_drop_newest_refuses_the_new_message():
+    broker, publisher = stalled("drop_newest")
+    assert not publisher.publish("Messages", [body(4)])
+    metrics = publisher.metrics()
+    assert metrics["dropped"] == 1 and metrics["enqueued"] == 3 and metrics["high_water"] == 2 and metrics["depth"] == 2
+    assert finish(broker, publisher) == [body(1), body(2), body(3)]
+
+def test_drop_oldest_makes_room_for_the_new_message():
+    broker, publisher = stalled("drop_oldest")
+    assert publisher.publish("Messages", [body(4)])
+    assert publisher.metrics()["dropped"] == 1 and publisher.metrics()["enqueued"] == 4
+    assert finish(broker, publisher) == [body(1), body(3), body(4)]
+
+def test_raise_leaves_the_queue_alone():
+    broker, publisher = stalled("raise")
+    with pytest.raises(PublishOverflow):
+        publisher.publish("Messages", [body(4)])
+    assert publisher.metrics()["dropped"] == 0
+    assert finish(broker, publisher) == [body(1), body(2), body(3)]
+
+def test_block_gives_up_after_the_timeout():
+    broker, publisher = stalled("block", block_timeout=0.2)
+    start = time.perf_counter()
+    assert not publisher.publish("Messages", [body(4)])
+    waited = time.perf_counter() - start
+    metrics = publisher.metrics()
+    assert waited >= 0.2 and metrics["dropped"] == 1
+    assert 0.2 <= metrics["blocked_seconds"] <= waited
+    assert finish(broker, publisher) == [body(1), body(2), body(3)]
+
+def test_block_waits_until_there_is_room():
+    broker, publisher = stalled("block")
+    results = []
+    blocked = Thread(target=lambda: results.append(publisher.publish("Messages", [body(4)])))
+    blocked.start()
+    time.sleep(0.1)
+    assert not results # Still waiting for the stalled broker
+    broker.release()
+    blocked.join(timeout=5)
+    assert results == [True] and publisher.metrics()["blocked_seconds"] >= 0.1
+    assert finish(broker, publisher) == [body(1), body(2), body(3), body(4)]
+
+def test_close_does_not_hang_on_a_stalled_broker():
+    broker, publisher = stalled("drop_newest")
+    start = time.monotonic()
+    publisher.close(timeout=0.2)
+    assert time.monotonic() - start < 1.0
+    assert publisher.metrics()["dropped"] == 2 # What was still queued
+    broker.release()
+    publisher.thread.join(timeout=5)
+    assert broker.received() == [body(1)]
@@ -0,0 +1,37 @@
+import random
+
+import numpy as np
+
+from batch_triage import Batch_triage
+from cep_manager import Cep_manager
+from triage_core import Triage_core
+
+def test_batch_matches_the_engine_per_event():
+    # The same patients through the local engine, one event at a time, and through Batch_triage
+    random.seed(1)
+    core = Triage_core(Cep_manager(local=True))
+    names = core.patients.registry.names
+    for i in range(150):
+        patient = core.add_patient("s" + str(i), str(random.randint(0, 90)), i % 2 == 0, "", "")
+        symptoms = core.patients[patient.id].symptoms
+        symptoms.life_threat = random.choice((None, 0, 1))
+        symptoms.consciousness = random.choice((None, 0, 1, 2))
+        symptoms.haemorrhage = random.choice((None, 0, 1, 2))
+        symptoms.temperature = random.choice((None, 34.5, 36.6, 38.2, 39.5, 41.5))
+        symptoms.pain_level = random.choice((None, 0, 1, 2, 3))
+        symptoms.specific = random.sample(names, random.randint(0, 3))
+        core.submit_symptoms(patient.id)
+    core.drain()
+
+    result = Batch_triage().triage(**core.patients.triage_columns())
+    assert result.level.any() and result.factors.any()
+    for id, level, factors in zip(result.patient, result.level, result.factors):
+        patient = core.patients[int(id)].patient
+        assert int(level) == patient.emergency_level
+        assert int(factors) == patient.category_factors
+
+def test_encode_sets_the_symptom_bits():
+    batch = Batch_triage()
+    bits = batch.encode([[batch.vocabulary[0], batch.vocabulary[3]], []])
+    assert int(np.asarray(bits).reshape(2, -1)[0, 0]) == 0b1001
+    assert not np.asarray(bits).reshape(2, -1)[1].any()
@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from broker_pool import Backoff, Connection_pool, ConnectionError, Retry_buffer
+from cep_manager import Blocking_publisher
+from fake_broker import Fake_broker
+
+def drain(broker, queue):
+    bodies = []
+    while broker.depth(queue):
+        bodies.append(broker.get(queue, 0)[0])
+    return bodies
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def item(n):
+    return ("Messages", [str(n).encode("ascii")], None, False, "")
+
+def test_pool_fails_over_and_sticks_to_the_endpoint_that_works():
+    broker = Fake_broker()
+    pool = Connection_pool([("a", 1), ("b", 2)], open_connection=broker.open_connection)
+    broker.disconnect(("a", 1), outage=True)
+    connection, _ = pool.connect()
+    assert connection.endpoint == ("b", 2) and pool.failures == 1
+    broker.restore()
+    connection, _ = pool.connect()
+    assert connection.endpoint == ("b", 2) and pool.failures == 1
+
+    broker.disconnect(outage=True)
+    with pytest.raises(ConnectionError):
+        pool.connect()
+
+def test_backoff_doubles_with_jitter_up_to_the_maximum():
+    backoff = Backoff(initial=1.0, maximum=4.0)
+    for delay in (1.0, 2.0, 4.0, 4.0):
+        assert delay / 2 <= backoff.next() <= delay
+    backoff.reset()
+    assert backoff.next() <= 1.0
+
+def test_retry_buffer_keeps_order_across_the_spill_file(tmp_path):
+    path = str(tmp_path / "retry.bin")
+    buffer = Retry_buffer(capacity=2, path=path)
+    for n in range(7):
+        buffer.append(item(n))
+    assert len(buffer) == 7 and buffer.dropped == 0
+    assert [buffer.pop()[1][0] for _ in range(3)] == [b"0", b"1", b"2"]
+    buffer.close()
+
+    # The next start picks up what was left, in order
+    reloaded = Retry_buffer(capacity=2, path=path)
+    assert len(reloaded) == 4
+    assert [reloaded.pop()[1][0] for _ in range(4)] == [b"3", b"4", b"5", b"6"]
+
+def test_retry_buffer_without_a_path_drops_the_newest():
+    buffer = Retry_buffer(capacity=2)
+    for n in range(4):
+        buffer.append(item(n))
+    assert buffer.dropped == 2
+    assert [buffer.pop()[1][0] for _ in range(2)] == [b"0", b"1"]
+
+def test_publisher_buffers_an_outage_and_sends_each_message_once_in_order():
+    broker = Fake_broker()
+    publisher = Blocking_publisher(broker.connection_factory)
+    for n in range(3):
+        publisher.publish(*item(n))
+    broker.disconnect(outage=True) # Mid-publish: the connection drops and stays down
+    for n in range(3, 8):
+        publisher.publish(*item(n))
+    assert len(publisher.retry_buffer) == 5 and not publisher.retry()
+
+    broker.restore()
+    assert wait_until(publisher.retry)
+    assert drain(broker, "Messages") == [str(n).encode("ascii") for n in range(8)]
+    assert publisher.reconnects == 1 and publisher.error is None
+    publisher.close()
+
+def test_spilled_messages_are_sent_after_a_restart(tmp_path):
+    path = str(tmp_path / "retry.bin")
+    broker = Fake_broker()
+    broker.disconnect(outage=True)
+    publisher = Blocking_publisher(broker.connection_factory, Retry_buffer(capacity=2, path=path), required=False)
+    for n in range(6):
+        publisher.publish(*item(n))
+    publisher.close()
+    assert drain(broker, "Messages") == []
+
+    broker.restore()
+    publisher = Blocking_publisher(broker.connection_factory, Retry_buffer(capacity=2, path=path), required=False)
+    assert len(publisher.retry_buffer) == 6
+    assert wait_until(publisher.retry)
+    assert drain(broker, "Messages") == [str(n).encode("ascii") for n in range(6)]
+    publisher.close()
+
+def test_reconnect_does_not_block_the_caller():
+    # retry() runs on the Tk thread: a slow connect must happen elsewhere
+    broker = Fake_broker()
+    slow = [False]
+    def connect():
+        if slow[0]:
+            time.sleep(0.5)
+        return broker.connection_factory()
+    publisher = Blocking_publisher(connect)
+    broker.disconnect()
+    slow[0] = True
+    start = time.monotonic()
+    publisher.publish(*item(0)) # Finds the connection gone
+    publisher.retry_at = 0.0 # Backoff over
+    assert not publisher.retry() and publisher.connecting
+    assert time.monotonic() - start < 0.2
+
+    assert wait_until(publisher.retry)
+    assert drain(broker, "Messages") == [b"0"]
+    publisher.close()
@@ -0,0 +1,63 @@
+import pytest
+
+from cep_engine import Cep_engine, Parser, EplError
+
+def engine():
+    out = []
+    cep = Cep_engine(clock=lambda: 0.0)
+    cep.set_output(out.append)
+    return cep, out
+
+def latest(out, stream):
+    # patient: level, or (patient, class): factors, as last reported
+    current = dict()
+    for pattern in out:
+        if pattern["stream"] == stream == "Level":
+            current[pattern["patient"]] = pattern["level"]
+        elif pattern["stream"] == stream == "Classification":
+            current[(pattern["patient"], pattern["class"])] = pattern["factors"]
+    return current
+
+def test_symptoms_raise_level_and_classification():
+    cep, out = engine()
+    cep.send({"eventTypeName": "Patient", "patient": 1, "age": 480})
+    cep.send({"eventTypeName": "Symptom", "patient": 1, "name": "chest pain"})
+    cep.send({"eventTypeName": "Symptom", "patient": 1, "name": "palpitations"})
+    cep.send({"eventTypeName": "Pain", "patient": 1, "type": 2})
+    assert latest(out, "Level")[1] == 4
+    assert latest(out, "Classification")[(1, "palpitations")] == 2
+
+def test_patients_are_grouped_apart():
+    cep, out = engine()
+    cep.send({"eventTypeName": "Symptom", "patient": 1, "name": "chest pain"})
+    cep.send({"eventTypeName": "Symptom", "patient": 2, "name": "palpitations"})
+    classes = latest(out, "Classification")
+    assert classes.get((1, "palpitations")) == 1
+    assert classes.get((2, "palpitations")) == 1
+
+def test_retraction_lowers_level_and_factors():
+    cep, out = engine()
+    cep.send({"eventTypeName": "Patient", "patient": 1, "age": 480})
+    cep.send({"eventTypeName": "Symptom", "patient": 1, "name": "chest pain"})
+    cep.send({"eventTypeName": "Symptom", "patient": 1, "name": "palpitations"})
+    cep.send({"eventTypeName": "Pain", "patient": 1, "type": 2})
+    out.clear()
+    cep.send({"eventTypeName": "Retraction", "patient": 1, "source": "chest pain"})
+    assert latest(out, "Level")[1] == 3
+    assert latest(out, "Classification")[(1, "palpitations")] == 1
+
+def test_retracting_everything_clears_the_level():
+    cep, out = engine()
+    cep.send({"eventTypeName": "Symptom", "patient": 1, "name": "chest pain"})
+    out.clear()
+    cep.send({"eventTypeName": "Retraction", "patient": 1, "source": "chest pain"})
+    assert not latest(out, "Level")[1]
+
+def test_named_windows_parse():
+    statements = Parser("create window W.win:length(5) as Symptom; insert into W select * from Symptom where patient = 1;").statements()
+    assert [statement[0] for statement in statements] == ["window", "insert"]
+
+def test_delete_needs_a_named_window():
+    cep = Cep_engine(clock=lambda: 0.0)
+    with pytest.raises(EplError):
+        cep.add_statement(Parser("on Retraction r delete from Symptom s where s.patient = r.patient;").statements()[0])
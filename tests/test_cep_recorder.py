@@ -0,0 +1,58 @@
+import pytest
+
+import cep_recorder
+from cep_recorder import Recorder, Replayer, Engine_target, read_records, OUT, IN
+
+def body(n):
+    return b'{"eventTypeName": "Temperature", "patient": ' + str(n).encode("ascii") + b', "value": 38.5}'
+
+def record(path, count):
+    recorder = Recorder(path)
+    for n in range(count):
+        recorder.record_out("Messages", body(n))
+    recorder.record_in("MuleOut", "{stmt0_out0={stream=Level, patient=0, level=3}}")
+    return recorder
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "traffic.rec")
+    record(path, 10).close()
+    _, records = read_records(path)
+    assert [record.body for record in records if record.direction == OUT] == [body(n) for n in range(10)]
+    assert records[-1].direction == IN and records[-1].queue == "MuleOut"
+
+def test_recording_that_was_never_closed(tmp_path, monkeypatch):
+    # The process died: only the periodic flushes reached the file
+    monkeypatch.setattr(cep_recorder, "flush_interval", 0.0)
+    path = str(tmp_path / "traffic.rec")
+    recorder = record(path, 2000)
+    _, records = read_records(path)
+    assert len(records) == 2001
+    recorder.close()
+
+@pytest.mark.parametrize("cut", [1, 7, 300])
+def test_truncated_recording_keeps_the_complete_records(tmp_path, cut):
+    path = str(tmp_path / "traffic.rec")
+    recorder = record(path, 2000)
+    recorder.file.flush()
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) - cut])
+    _, records = read_records(path)
+    assert 0 < len(records) <= 2001
+    assert [record.body for record in records[:-1]] == [body(n) for n in range(len(records) - 1)]
+    recorder.close()
+
+def test_replay_into_the_engine_reproduces_the_matches(tmp_path):
+    path = str(tmp_path / "traffic.rec")
+    recorder = Recorder(path)
+    recorder.record_out("Messages", b'{"eventTypeName": "Symptom", "patient": 4, "name": "chest pain"}')
+    recorder.record_in("MuleOut", "{stmt0_out0={stream=Level, patient=4, level=4, source=chest pain}}")
+    recorder.record_in("MuleOut", "{stmt0_out0={stream=Classification, patient=4, class=palpitations, factors=1, source=chest pain}}")
+    recorder.close()
+
+    replayer = Replayer(path)
+    target = Engine_target()
+    replayer.replay(target, speed=None)
+    missing, _ = replayer.compare(target.matches)
+    assert not missing and target.event_counts["Symptom"] == 1
@@ -0,0 +1,40 @@
+from cep_manager import Cep_manager
+from metrics import Metrics
+
+def tracked():
+    metrics = Metrics()
+    manager = Cep_manager(local=True, metrics=metrics)
+    matches = []
+    manager.start_consuming(matches.append)
+    return metrics, manager, matches
+
+def latencies(metrics, name):
+    # event type: number of timed matches
+    return {entry["labels"]["type"]: entry["count"] for entry in metrics.snapshot()["histograms"] if entry["name"] == name}
+
+def in_flight(metrics):
+    return [entry["value"] for entry in metrics.snapshot()["gauges"] if entry["name"] == "cep_events_in_flight"][0]
+
+def test_each_match_is_attributed_to_the_event_that_caused_it():
+    metrics, manager, matches = tracked()
+    manager.publish_life_threat(1, 0)
+    manager.publish_temperature(1, 39.5)
+    manager.publish_specific_symptom(1, "palpitations")
+    assert [match["source"] for match in matches if match["stream"] == "Level"] == ["LifeThreat", "Temperature", "palpitations"]
+    assert latencies(metrics, "cep_match_latency_seconds") == {"LifeThreat": 1, "Temperature": 1, "Symptom": 1}
+    assert in_flight(metrics) == 0
+
+    manager.publish_retraction(1, "palpitations")
+    assert latencies(metrics, "cep_match_latency_seconds")["Retraction"] == 1
+    manager.patterns_displayed([1])
+    assert latencies(metrics, "cep_display_latency_seconds") == {"Retraction": 1}
+
+def test_events_without_a_match_are_dropped_when_the_patient_goes():
+    metrics, manager, matches = tracked()
+    manager.publish_temperature(1, 36.6) # Normal: no level
+    manager.publish_temperature(2, 36.6)
+    manager.publish_temperature(2, 36.8) # Replaces the pending one
+    assert in_flight(metrics) == 2 and not matches
+    manager.patient_removed(1)
+    manager.patient_removed(2)
+    assert in_flight(metrics) == 0 and manager.latency.in_flight == {}
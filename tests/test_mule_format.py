@@ -0,0 +1,24 @@
+import pytest
+
+import mule_format
+
+def test_decodes_a_match():
+    message = "{stmt0_out0={stream=Classification, patient=3, class=self-harm high risk, factors=2}}"
+    assert mule_format.decode(message) == {"stmt0_out0": {"stream": "Classification", "patient": 3, "class": "self-harm high risk", "factors": 2}}
+
+def test_values_come_back_typed():
+    decoded = mule_format.decode(b"{a=-4, b=2.5, c=true, d=false, e=null, f=, g=12abc}")
+    assert decoded == {"a": -4, "b": 2.5, "c": True, "d": False, "e": None, "f": None, "g": "12abc"}
+
+@pytest.mark.parametrize("value", [
+    {"stmt0_out0": {"stream": "Level", "patient": 7, "level": 4}},
+    {"stmt0_out0": {"stream": "Classification", "patient": 0, "class": "very hot", "factors": None}},
+    {"outer": {"inner": {"text": "abdominal pain in adults", "n": -1.25}}, "flag": True},
+])
+def test_encode_decode_round_trip(value):
+    assert mule_format.decode(mule_format.encode(value)) == value
+
+@pytest.mark.parametrize("message", ["{stmt0_out0={stream=Level", "", "{a=1}}"])
+def test_malformed_messages_fail(message):
+    with pytest.raises(mule_format.DecodeError):
+        mule_format.decode(message)
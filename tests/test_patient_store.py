@@ -0,0 +1,78 @@
+import pytest
+
+from patient_store import Patient_store, Symptoms, EmergencyType
+
+def test_patient_fields_read_back_as_given():
+    store = Patient_store()
+    patient = store.add(3, "281234567840", "45", False, "-0.37", "39.47").patient
+    assert (patient.id, patient.ssn, patient.age, patient.is_male) == (3, "281234567840", "45", False)
+    assert (patient.longitude, patient.latitude) == ("-0.37", "39.47")
+    assert (patient.emergency_level, patient.emergency_category, patient.category_factors) == (0, EmergencyType.Generic, 0)
+    assert patient.get_sex() == "Female"
+
+    blank = store.add(4, "", "", True, "", "").patient
+    assert (blank.ssn, blank.age, blank.longitude, blank.latitude) == ("", "", "", "")
+
+def test_views_write_through():
+    store = Patient_store()
+    store.add(1, "s", "30", True)
+    patient = store[1].patient
+    patient.emergency_level = 4
+    patient.emergency_category = "palpitations"
+    patient.category_factors = 2
+    again = store[1].patient
+    assert (again.emergency_level, again.emergency_category, again.category_factors) == (4, "palpitations", 2)
+
+def test_symptoms_default_and_assign():
+    store = Patient_store()
+    unit = store.add(1, "s", "30", True)
+    symptoms = unit.symptoms
+    assert (symptoms.life_threat, symptoms.temperature, symptoms.specific) == (None, 36.1, [])
+
+    unit.symptoms = Symptoms(life_threat=1, pain_level=0, temperature=None, specific=["palpitations", "chest pain"])
+    symptoms = unit.symptoms
+    assert (symptoms.life_threat, symptoms.pain_level, symptoms.temperature) == (1, 0, None)
+    assert sorted(symptoms.specific) == ["chest pain", "palpitations"]
+    assert unit.published.specific == [] # The other side is untouched
+
+def test_unknown_symptom_is_rejected_without_registering():
+    store = Patient_store()
+    unit = store.add(1, "s", "30", True)
+    known = len(store.registry)
+    with pytest.raises(KeyError):
+        unit.symptoms.specific = ["not a symptom"]
+    assert len(store.registry) == known and store.words == 1
+
+def test_mapping_semantics_and_growth():
+    store = Patient_store(capacity=4)
+    for id in range(100):
+        store.add(id * 3, "s" + str(id), str(id), id % 2 == 0)
+    assert len(store) == 100 and list(store) == [id * 3 for id in range(100)]
+    store.remove(30)
+    assert 30 not in store and store.get(30) is None and len(store) == 99
+    with pytest.raises(KeyError):
+        store[30]
+    assert store[33].patient.ssn == "s11"
+    store.add(30, "again", "1", True)
+    assert store[30].patient.ssn == "again"
+
+def test_select_and_level_counts():
+    store = Patient_store()
+    for id, level in enumerate((5, 0, 5, 3)):
+        unit = store.add(id, "s", "30", True)
+        unit.patient.emergency_level = level
+        unit.published = Symptoms(specific=["chest pain"] if id % 2 else [])
+    assert list(store.select(level=5)) == [0, 2]
+    assert list(store.select(min_level=3)) == [0, 2, 3]
+    assert list(store.select(symptom="chest pain")) == [1, 3]
+    assert list(store.select(symptom="not a symptom")) == []
+    assert list(store.level_counts()) == [1, 0, 0, 1, 0, 2]
+
+def test_reading_class_factors_stores_nothing():
+    store = Patient_store()
+    unit = store.add(1, "s", "30", True)
+    assert unit.class_factors == {} and not store.class_factors
+    unit.class_factors = {"asthma": 1}
+    assert store[1].class_factors == {"asthma": 1}
+    unit.class_factors = {}
+    assert not store.class_factors
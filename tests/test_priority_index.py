@@ -0,0 +1,40 @@
+import random
+
+from priority_index import Priority_index
+
+def test_matches_a_sorted_list_under_random_changes():
+    # Model: id -> (level, arrival), ordered by level descending then arrival
+    random.seed(8)
+    index = Priority_index()
+    model = dict()
+    arrivals = 0
+    for step in range(3000):
+        op = random.random()
+        id = random.randrange(300)
+        if op < 0.45:
+            level = random.randint(0, 5)
+            if id in model:
+                model[id] = (level, model[id][1]) # An add of a known id is an update
+            else:
+                model[id] = (level, arrivals)
+                arrivals += 1
+            index.add(id, level)
+        elif op < 0.7 and id in model:
+            level = random.randint(0, 5)
+            model[id] = (level, model[id][1])
+            index.update(id, level)
+        elif op < 0.9:
+            model.pop(id, None)
+            index.remove(id)
+        else:
+            expected = min(model, key=lambda i: (-model[i][0], model[i][1])) if model else None
+            assert index.pop() == expected
+            model.pop(expected, None)
+
+        if step % 50 == 0:
+            order = sorted(model, key=lambda i: (-model[i][0], model[i][1]))
+            assert list(index) == order and len(index) == len(order)
+            assert [index.at(k) for k in range(len(order))] == order
+            assert all(index.index(id) == k for k, id in enumerate(order))
+            assert index.top(5) == order[:5]
+            assert all(index.level(id) == model[id][0] for id in order)
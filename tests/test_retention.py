@@ -0,0 +1,90 @@
+from cep_manager import Cep_manager
+from retention import Retention, Retention_policy, Patient_archive, read_archive, IDLE, DISCHARGED, OVERFLOW
+from triage_core import Triage_core
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_patients_expire_in_deadline_order():
+    clock = Clock()
+    retention = Retention(Retention_policy(idle_seconds=100, discharge_grace=10), clock)
+    for id in (1, 2, 3):
+        retention.touch(id)
+        clock.now += 1
+    retention.touch(1) # Active again at 1003
+    retention.discharge(3) # Gone at 1013
+    assert retention.expired() == []
+    assert retention.expired(1013) == [(3, DISCHARGED)]
+    assert retention.expired(1101) == [(2, IDLE)]
+    assert retention.expired(1200) == [(1, IDLE)] and len(retention) == 0
+
+def test_overflow_lets_discharged_patients_go_first():
+    clock = Clock()
+    retention = Retention(Retention_policy(idle_seconds=None, max_patients=3, discharge_grace=3600), clock)
+    for id in range(5):
+        retention.touch(id)
+        clock.now += 1
+    retention.touch(0)
+    retention.discharge(4)
+    assert retention.expired() == [(4, DISCHARGED), (1, OVERFLOW)]
+    assert sorted(retention.deadlines) == [0, 2, 3]
+    retention.touch(2)
+    retention.touch(5)
+    assert retention.expired() == [(3, OVERFLOW)]
+
+def test_the_heap_is_rebuilt_when_stale_entries_pile_up():
+    clock = Clock()
+    retention = Retention(Retention_policy(idle_seconds=100), clock)
+    for id in range(10):
+        retention.touch(id)
+    for n in range(1000):
+        clock.now += 0.1
+        retention.touch(n % 10)
+        assert len(retention.heap) <= 2 * len(retention) + 64
+    # Only the live deadlines count
+    assert retention.expired(clock.now + 99) == []
+    assert sorted(id for id, _ in retention.expired(clock.now + 100)) == list(range(10))
+
+def archived_core(path, clock):
+    return Triage_core(Cep_manager(local=True), retention=Retention(Retention_policy(idle_seconds=60), clock), archive=Patient_archive(path, fsync=False))
+
+def test_expired_patients_round_trip_through_the_archive(tmp_path):
+    path = str(tmp_path / "patients.archive")
+    clock = Clock()
+    core = archived_core(path, clock)
+    first = core.add_patient("ssn-1", "30", True, "", "").id
+    core.patients[first].symptoms.specific = ["chest pain"]
+    core.submit_symptoms(first)
+    core.drain()
+    clock.now += 30
+    second = core.add_patient("ssn-2", "70", False, "", "").id
+    assert core.expire(clock.now + 31) == [(first, IDLE)]
+    assert core.expire(clock.now + 61) == [(second, IDLE)]
+    assert len(core.patients) == 0
+    core.archive.close()
+
+    entries = list(read_archive(path))
+    assert [entry["id"] for entry in entries] == [first, second]
+    assert [entry["reason"] for entry in entries] == ["idle", "idle"]
+    assert entries[0]["patient"]["ssn"] == "ssn-1" and not entries[1]["patient"]["is_male"]
+    assert entries[0]["level"] == 4 and entries[0]["time"] == clock.now + 31
+
+def test_a_torn_archive_entry_is_cut_off_on_reopen(tmp_path):
+    path = str(tmp_path / "patients.archive")
+    clock = Clock()
+    core = archived_core(path, clock)
+    core.add_patient("ssn-1", "30", True, "", "")
+    core.expire(clock.now + 61)
+    core.archive.close()
+    with open(path, "ab") as f:
+        f.write(b"\x10\x05junk") # An EXPIRED record cut short by a crash
+
+    core = archived_core(path, clock)
+    core.add_patient("ssn-2", "30", True, "", "")
+    core.expire(clock.now + 61)
+    core.archive.close()
+    assert [entry["patient"]["ssn"] for entry in read_archive(path)] == ["ssn-1", "ssn-2"]
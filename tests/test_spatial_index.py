@@ -0,0 +1,47 @@
+import random
+
+from spatial_index import Spatial_index, distance_km
+
+def brute_force(points, latitude, longitude, min_level=None):
+    # Sorted [(distance_km, id)] of every point
+    return sorted((distance_km(latitude, longitude, lat, lon), id) for id, (lat, lon, level) in points.items() if min_level is None or level >= min_level)
+
+def near_edges():
+    # A point close to a pole or to the antimeridian, or anywhere
+    kind = random.random()
+    if kind < 0.35:
+        return random.choice((-1, 1)) * random.uniform(88.5, 90.0), random.uniform(-180, 180)
+    if kind < 0.7:
+        return random.uniform(-70, 70), random.choice((-1, 1)) * random.uniform(178.5, 180.0)
+    return random.uniform(-90, 90), random.uniform(-180, 180)
+
+def test_matches_brute_force_near_the_poles_and_the_antimeridian():
+    random.seed(23)
+    index = Spatial_index(cell_km=20.0, latitude=45.0)
+    points = dict()
+    for id in range(600):
+        latitude, longitude = near_edges()
+        points[id] = (latitude, longitude, random.randint(0, 5))
+        index.add(id, *points[id])
+    for id in random.sample(range(600), 100):
+        del points[id]
+        index.remove(id)
+    for id in random.sample(sorted(points), 100):
+        level = random.randint(0, 5)
+        points[id] = points[id][:2] + (level,)
+        index.update(id, level)
+
+    for _ in range(200):
+        latitude, longitude = near_edges()
+        min_level = random.choice((None, 3))
+        everything = brute_force(points, latitude, longitude, min_level)
+        radius = random.choice((5.0, 50.0, 300.0))
+        # Points right on the circle may fall either way with rounding
+        expected = {id for distance, id in everything if distance < radius - 1e-6}
+        found = {id for distance, id in index.within(latitude, longitude, radius, min_level)}
+        assert expected <= found <= expected | {id for distance, id in everything if abs(distance - radius) <= 1e-6}
+
+        k = random.randint(1, 5)
+        nearest = index.nearest(latitude, longitude, k, min_level)
+        assert len(nearest) == min(k, len(everything))
+        assert [round(distance, 6) for distance, _ in nearest] == [round(distance, 6) for distance, _ in everything[:k]]
@@ -0,0 +1,101 @@
+import time
+from threading import Event, Thread
+
+import mule_format
+from cep_manager import PikaSubscriber
+from fake_broker import Fake_broker
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def match(patient):
+    return mule_format.encode({"stmt0_out0": {"stream": "Level", "patient": patient, "level": 3}})
+
+class Subscribed:
+    # A PikaSubscriber consuming MuleOut from a fake broker on its own thread, with every channel it opened
+    # and every ack it sent
+    def __init__(self, broker, callback, prefetch=10, ack_batch=3):
+        self.broker = broker
+        self.channels = []
+        self.acks = [] # (channel number, delivery tag, multiple)
+        self.subscriber = PikaSubscriber(self.connect, prefetch=prefetch, ack_batch=ack_batch, lag_interval=0.05)
+        self.thread = Thread(target=self.subscriber.consume, args=(callback,))
+        self.thread.start()
+
+    def connect(self):
+        connection, channel = self.broker.connection_factory()
+        number = len(self.channels)
+        basic_ack = channel.basic_ack
+        def ack(delivery_tag=0, multiple=False):
+            self.acks.append((number, delivery_tag, multiple))
+            basic_ack(delivery_tag, multiple)
+        channel.basic_ack = ack
+        self.channels.append(channel)
+        return connection, channel
+
+    def close(self):
+        self.subscriber.close()
+        self.thread.join(timeout=5)
+        assert not self.thread.is_alive()
+
+def test_matches_are_acked_in_batches_after_they_are_handled():
+    broker = Fake_broker()
+    for patient in range(7):
+        broker.publish("MuleOut", match(patient))
+    handled = []
+    def callback(pattern):
+        # Nothing is acked before it is handled
+        assert broker.acked <= len(handled)
+        time.sleep(0.01)
+        handled.append(pattern["patient"])
+    subscribed = Subscribed(broker, callback)
+    assert wait_until(lambda: broker.acked == 7)
+    assert handled == list(range(7)) and broker.depth("MuleOut") == 0
+    acks = subscribed.acks
+    assert all(multiple for _, _, multiple in acks) and len(acks) < 7
+    assert [tag for _, tag, _ in acks] == sorted(tag for _, tag, _ in acks)
+    subscribed.close()
+
+def test_a_failing_match_is_requeued_once_then_dropped():
+    broker = Fake_broker()
+    broker.publish("MuleOut", match(1))
+    broker.publish("MuleOut", match(2))
+    calls = []
+    def callback(pattern):
+        calls.append(pattern["patient"])
+        if pattern["patient"] == 1:
+            raise ValueError("bad match")
+    subscribed = Subscribed(broker, callback)
+    assert wait_until(lambda: broker.acked == 1 and not subscribed.channels[0].unacked)
+    assert sorted(calls) == [1, 1, 2]
+    assert broker.depth("MuleOut") == 0
+    subscribed.close()
+
+def test_acks_from_before_a_reconnect_are_not_sent_on_the_new_channel():
+    broker = Fake_broker()
+    for patient in range(4):
+        broker.publish("MuleOut", match(patient))
+    handled = []
+    release = Event()
+    def callback(pattern):
+        if not handled:
+            release.wait(5) # Still on the first match when the connection drops
+        handled.append(pattern["patient"])
+    subscribed = Subscribed(broker, callback, prefetch=4, ack_batch=100)
+    assert wait_until(lambda: len(subscribed.channels[0].unacked) == 4)
+    broker.disconnect()
+    assert wait_until(lambda: subscribed.subscriber.generation == 2)
+    release.set()
+
+    # The old deliveries come back redelivered on the new channel and only its own tags are acked there
+    assert wait_until(lambda: broker.acked == 4 and broker.depth("MuleOut") == 0)
+    assert set(handled) == {0, 1, 2, 3}
+    assert subscribed.subscriber.reconnects == 1
+    assert all(number == 1 for number, _, _ in subscribed.acks)
+    assert not subscribed.channels[1].unacked
+    subscribed.close()
@@ -0,0 +1,46 @@
+from cep_manager import Cep_manager
+from triage_core import Triage_core
+
+def triage():
+    core = Triage_core(Cep_manager(local=True))
+    retracted = []
+    publish_retraction = core.cep_manager.publish_retraction
+    def spy(id, source):
+        retracted.append((id, source))
+        publish_retraction(id, source)
+    core.cep_manager.publish_retraction = spy
+    return core, retracted
+
+def submit(core, id, **changes):
+    symptoms = core.patients[id].symptoms
+    for key, value in changes.items():
+        setattr(symptoms, key, value)
+    core.submit_symptoms(id)
+    core.drain()
+    return core.patients[id].patient
+
+def test_clearing_and_deselecting_lower_the_level_and_factors():
+    core, retracted = triage()
+    id = core.add_patient("s", "40", True, "", "").id
+    patient = submit(core, id, life_threat=0, specific=["chest pain", "palpitations"])
+    assert patient.emergency_level == 5 and patient.category_factors == 2
+
+    patient = submit(core, id, life_threat=None)
+    assert patient.emergency_level == 4 and retracted == [(id, "LifeThreat")]
+
+    patient = submit(core, id, specific=["palpitations"])
+    assert patient.emergency_level == 3 and patient.category_factors == 1
+    assert retracted[1:] == [(id, "chest pain")]
+
+def test_a_changed_value_retracts_the_old_one_once():
+    core, retracted = triage()
+    id = core.add_patient("s", "40", True, "", "").id
+    patient = submit(core, id, pain_level=0)
+    assert patient.emergency_level == 4 and not retracted
+
+    patient = submit(core, id, pain_level=2)
+    assert patient.emergency_level == 2 and retracted == [(id, "Pain")]
+
+    # Nothing changed: nothing is published again
+    patient = submit(core, id)
+    assert patient.emergency_level == 2 and retracted == [(id, "Pain")]
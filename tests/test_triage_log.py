@@ -0,0 +1,108 @@
+import os
+
+from cep_manager import Cep_manager
+from patient_store import Patient_store, Symptoms
+from retention import Retention, Retention_policy
+from triage_core import Triage_core
+from triage_log import Triage_log
+from triage_service import patient_json
+
+class Replay:
+    def __init__(self, log):
+        self.records = []
+        self.next_patient_id = log.recover(lambda fields: self.records.append(("patient", fields["id"])),
+                                           lambda id, symptoms, published: self.records.append(("symptoms", id, symptoms["temperature"], symptoms["specific"])),
+                                           lambda pattern: self.records.append(("match", pattern["patient"], pattern.get("level"))),
+                                           lambda id: self.records.append(("remove", id)),
+                                           lambda id, level, factors, category: self.records.append(("state", id, level)))
+
+def write_log(directory):
+    store = Patient_store()
+    log = Triage_log(directory, fsync=False)
+    log.recover(*[lambda *args: None] * 5)
+    for id in range(3):
+        unit = store.add(id, "s" + str(id), "40", True, "", "")
+        log.log_patient(unit.patient)
+        unit.symptoms = Symptoms(temperature=39.0 + id, specific=["chest pain"])
+        log.log_symptoms(id, unit.symptoms, unit.published)
+    log.log_match({"stream": "Level", "patient": 1, "level": 4})
+    log.log_remove(0)
+    log.close()
+    return log
+
+expected = [("patient", 0), ("symptoms", 0, 39.0, ["chest pain"]), ("patient", 1), ("symptoms", 1, 40.0, ["chest pain"]),
+            ("patient", 2), ("symptoms", 2, 41.0, ["chest pain"]), ("match", 1, 4), ("remove", 0)]
+
+def test_log_replays_in_order(tmp_path):
+    write_log(str(tmp_path))
+    replay = Replay(Triage_log(str(tmp_path), fsync=False))
+    assert replay.records == expected
+    assert replay.next_patient_id == 3
+
+def test_torn_tail_is_cut_off(tmp_path):
+    log = write_log(str(tmp_path))
+    size = os.path.getsize(log.wal_path)
+    with open(log.wal_path, "ab") as f:
+        f.write(b"\x02\x40\x00\x00\x00junk") # A record header promising more than was written
+    log = Triage_log(str(tmp_path), fsync=False)
+    assert Replay(log).records == expected
+    assert os.path.getsize(log.wal_path) == size
+
+    # Appending after the cut keeps the log readable
+    log.log_remove(2)
+    log.close()
+    assert Replay(Triage_log(str(tmp_path), fsync=False)).records == expected + [("remove", 2)]
+
+def test_corrupt_record_ends_the_replay(tmp_path):
+    log = write_log(str(tmp_path))
+    with open(log.wal_path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes((last[0] ^ 0xFF,)))
+    assert Replay(Triage_log(str(tmp_path), fsync=False)).records == expected[:-1]
+
+def state(core):
+    return [patient_json(unit) for unit in core.patients.values()]
+
+def test_snapshot_and_log_tail_restore_the_state(tmp_path):
+    core = Triage_core(Cep_manager(local=True), Triage_log(str(tmp_path), snapshot_every=25, fsync=False))
+    for i in range(40):
+        patient = core.add_patient("s" + str(i), str(i), i % 2 == 0, "", "")
+        symptoms = core.patients[patient.id].symptoms
+        symptoms.temperature = 35.0 + i % 7
+        symptoms.specific = ["chest pain", "palpitations"] if i % 3 == 0 else []
+        core.submit_symptoms(patient.id)
+        if i % 5 == 0:
+            core.remove_patient(i // 2)
+    core.drain()
+    core.patients[39].symptoms.temperature = 41.0
+    core.submit_symptoms(39)
+    core.drain()
+    core.remove_patient(38)
+    assert core.log.generation > 0 and core.log.records_since_snapshot > 0
+    before = state(core)
+    core.log.close() # No final snapshot: the log tail is replayed on top of the last one
+
+    restored = Triage_core(Cep_manager(local=True), Triage_log(str(tmp_path), fsync=False))
+    assert state(restored) == before
+    assert restored.next_patient_id == core.next_patient_id
+
+def test_discharge_survives_a_restart(tmp_path):
+    clock = [1000.0]
+    def open_core():
+        retention = Retention(Retention_policy(idle_seconds=100, discharge_grace=10), clock=lambda: clock[0])
+        return Triage_core(Cep_manager(local=True), Triage_log(str(tmp_path), fsync=False), retention)
+
+    core = open_core()
+    for i in range(3):
+        core.add_patient("s" + str(i), "40", True, "", "")
+    core.discharge(1)
+    core.commit()
+    core.log.close()
+
+    core = open_core()
+    assert core.expire(1011) == [(1, 2)]
+    core.discharge(2)
+    core.close() # Through a snapshot this time
+    assert open_core().expire(1011) == [(2, 2)]
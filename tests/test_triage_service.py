@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+from cep_manager import Cep_manager
+from triage_core import Triage_core
+from triage_service import Triage_service, max_body, sse
+
+class Writer:
+    # Collects what the service writes; drain() waits while `stalled` is clear, like a client that stops reading
+    def __init__(self, stalled=False):
+        self.data = b""
+        self.closed = False
+        self.drains = 0
+        self.flowing = asyncio.Event()
+        if not stalled:
+            self.flowing.set()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        self.drains += 1
+        if self.drains > 1:
+            await self.flowing.wait()
+
+    def close(self):
+        self.closed = True
+
+def service():
+    return Triage_service(Triage_core(Cep_manager(local=True)), stream_queue_size=2)
+
+def raw_request(method, path, payload=None, headers=""):
+    body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+    head = method + " " + path + " HTTP/1.1\r\nContent-Length: " + str(len(body)) + "\r\n" + headers + "\r\n"
+    return head.encode("latin-1") + body
+
+def responses(data):
+    # [(status, payload)] of the HTTP responses in data
+    result = []
+    while data:
+        head, _, data = data.partition(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        length = int([line for line in lines if line.startswith("Content-Length:")][0].split(":")[1])
+        result.append((int(lines[0].split()[1]), json.loads(data[:length])))
+        data = data[length:]
+    return result
+
+def exchange(triage, *requests):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(requests))
+        reader.feed_eof()
+        writer = Writer()
+        await triage.handle(reader, writer)
+        assert writer.closed
+        return responses(writer.data)
+    return asyncio.run(run())
+
+def test_patients_and_symptoms_over_one_connection():
+    triage = service()
+    (status, created), (symptoms_status, results) = exchange(triage,
+        raw_request("POST", "/patients", [{"age": "30"}, {"age": "70", "sex": "Female"}]),
+        raw_request("POST", "/symptoms", [{"patient": 1, "specific": ["chest pain"]}]))
+    assert status == 201 and created == {"ids": [0, 1]}
+    assert symptoms_status == 200 and results == {"results": [{"patient": 1, "ok": True}]}
+    triage.core.drain()
+    assert triage.core.patients[1].patient.emergency_level == 4
+
+def test_bad_ids_are_rejected():
+    triage = service()
+    exchange(triage, raw_request("POST", "/patients", {"age": "30"}))
+    for bad in ("1", 1.0, True, None):
+        [(status, payload)] = exchange(triage, raw_request("POST", "/symptoms", [{"patient": 0}, {"patient": bad}]))
+        assert status == 400 and "Invalid patient id" in payload["error"]
+    [(status, _)] = exchange(triage, raw_request("GET", "/patients/abc"))
+    assert status == 400
+    [(status, _)] = exchange(triage, raw_request("GET", "/patients/7"))
+    assert status == 404
+
+def test_a_batch_reports_each_item():
+    triage = service()
+    exchange(triage, raw_request("POST", "/patients", [{"age": "30"}, {"age": "40"}]))
+    [(status, payload)] = exchange(triage, raw_request("POST", "/symptoms", [
+        {"patient": 0, "pain_level": 1},
+        {"patient": 9, "pain_level": 1},
+        {"patient": 1, "pain_level": 99},
+        {"patient": 1, "temperature": 39.5},
+    ]))
+    assert status == 200
+    results = payload["results"]
+    assert results[0] == {"patient": 0, "ok": True} and results[3] == {"patient": 1, "ok": True}
+    assert "not found" in results[1]["error"] and "Invalid pain_level" in results[2]["error"]
+    # The bad item changed nothing
+    assert triage.core.patients[1].symptoms.pain_level is None
+
+def test_oversized_and_malformed_bodies():
+    triage = service()
+    [(status, _)] = exchange(triage, b"POST /patients HTTP/1.1\r\nContent-Length: " + str(max_body + 1).encode("ascii") + b"\r\n\r\n")
+    assert status == 413
+    for length in (b"ten", b"-1"):
+        [(status, payload)] = exchange(triage, b"POST /patients HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n")
+        assert status == 400 and payload["error"] == "Invalid Content-Length"
+    [(status, _)] = exchange(triage, b"POST /patients HTTP/1.1\r\nContent-Length: 1\r\n\r\n{")
+    assert status == 400
+
+def test_a_slow_event_stream_is_dropped():
+    triage = service()
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw_request("GET", "/events"))
+        writer = Writer(stalled=True)
+        task = asyncio.ensure_future(triage.handle(reader, writer))
+        while not triage.streams:
+            await asyncio.sleep(0)
+        [stream] = triage.streams
+        triage.broadcast(1, sse("update", {"patient": 1}))
+        while writer.drains < 2:
+            await asyncio.sleep(0) # Written, and stuck in drain()
+        for patient in (2, 3, 4):
+            triage.broadcast(patient, sse("update", {"patient": patient}))
+        assert stream.closed and not triage.streams
+        writer.flowing.set()
+        await asyncio.wait_for(task, 1.0)
+        return writer
+    writer = asyncio.run(run())
+    assert writer.closed
+    assert b'{"patient": 1}' in writer.data
+    assert all(b'{"patient": ' + str(patient).encode("ascii") + b'}' not in writer.data for patient in (2, 3, 4))
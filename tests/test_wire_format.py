@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import cep_events
+import wire_format
+
+events = [
+    {"eventTypeName": "Patient", "patient": 5, "ssn": "281234567840", "age": 40, "is_male": True, "latitude": 39.5, "longitude": -0.25},
+    {"eventTypeName": "Temperature", "patient": 3, "value": 38.5, "cid": 7},
+    {"eventTypeName": "Symptom", "patient": 3, "name": "chest pain"},
+    {"eventTypeName": "Symptom", "patient": 3, "name": "left knee"}, # Not in the patterns: sent as text
+    {"eventTypeName": "Pain", "patient": 3, "type": None},
+    {"eventTypeName": "Retraction", "patient": 3, "source": "chest pain"},
+]
+
+def test_events_round_trip():
+    wire = wire_format.shared()
+    assert wire.decode_events(wire.encode_events(events)) == events
+
+def test_binary_and_json_bodies_decode_the_same():
+    wire = wire_format.shared()
+    assert wire_format.events_of(wire.encode_events(events)) == wire_format.events_of(json.dumps(events).encode("utf-8"))
+
+def test_generated_event_classes_encode_the_same():
+    wire = wire_format.shared()
+    event = cep_events.shared().Temperature(patient=3, value=38.5, cid=7)
+    assert wire.decode_events(wire.encode_events([event.as_dict()])) == [json.loads(event.to_bytes())]
+
+def test_binary_is_smaller():
+    wire = wire_format.shared()
+    event = {"eventTypeName": "Temperature", "patient": 3, "value": 38.5}
+    assert len(wire.encode_events([event])) < len(json.dumps(event))
+
+def test_matches_round_trip():
+    wire = wire_format.shared()
+    matches = [
+        {"stream": "Level", "patient": 3, "level": 4, "source": "Pain"},
+        {"stream": "Classification", "patient": 3, "class": "palpitations", "factors": 2, "source": "chest pain"},
+        {"stream": "Classification", "patient": 9, "class": "not a pattern class", "factors": 1, "source": None},
+    ]
+    body = wire.encode_matches(matches)
+    assert wire.decode_matches(body) == matches
+    assert wire_format.patterns_of(body) == matches
+
+def test_other_tables_are_rejected():
+    wire = wire_format.shared()
+    body = bytearray(wire.encode_events(events))
+    body[2] ^= 0xFF # Checksum of the .epl tables
+    with pytest.raises(wire_format.WireError):
+        wire.decode_events(bytes(body))
+
+def test_truncated_message_fails():
+    wire = wire_format.shared()
+    with pytest.raises(wire_format.WireError):
+        wire.decode_events(wire.encode_events(events)[:-3])